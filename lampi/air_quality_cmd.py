@@ -68,6 +68,8 @@ class AirQualityCmd:
 
         # Optionally indicate the source client for tracking
         self.received_sensor_state['client'] = MQTT_CLIENT_ID
+        # the trace belongs to the reading we received, not this update
+        self.received_sensor_state.pop(TRACE_KEY, None)
 
         # Publish the updated sensor state
         self.client.publish(TOPIC_SET_SENSOR_DATA,
@@ -1,3 +1,5 @@
+import os
+import time
 import paho.mqtt.client
 
 DEVICE_ID_FILENAME = '/sys/class/net/eth0/address'
@@ -5,6 +7,8 @@ DEVICE_ID_FILENAME = '/sys/class/net/eth0/address'
 TOPIC_SET_SENSOR_DATA = "lampi/set_sensor_data"
 TOPIC_LAMPI_CHANGE_NOTIFICATION = "lampi/changed"
 TOPIC_LAMPI_ASSOCIATED = "lampi/associated"
+TOPIC_LAMPI_TELEMETRY = "lampi/telemetry"
+TOPIC_LAMPI_SAMPLE_RATE = "lampi/sample_rate"
 
 def get_device_id():
     with open(DEVICE_ID_FILENAME) as f:
@@ -23,3 +27,39 @@ MQTT_VERSION = paho.mqtt.client.MQTTv311
 MQTT_BROKER_HOST = "localhost"
 MQTT_BROKER_PORT = 1883
 MQTT_BROKER_KEEP_ALIVE_SECS = 60
+
+# Same-device fast path (see local_ipc.py), enabled with LAMPI_LOCAL_IPC=1
+LOCAL_IPC_ENABLED = os.environ.get('LAMPI_LOCAL_IPC') == '1'
+LOCAL_IPC_DIR = os.environ.get('LAMPI_LOCAL_IPC_DIR', '/tmp/lampi-ipc')
+
+# End-to-end latency tracing: each reading carries
+#   "trace": {"captured": <epoch secs>, "hops": [[<hop>, <epoch secs>], ...]}
+# and every process on the path appends the time it handled the reading.
+TRACE_KEY = 'trace'
+HOP_READ_SENSOR = 'read_sensor'
+HOP_SERVICE_RECV = 'service_recv'
+HOP_SERVICE_PUB = 'service_pub'
+
+# Acquisition stats read_sensor attaches to each reading it sends, for the
+# health record: {"read_ms": <duration of the latest BME280 sample>,
+# "pm_good": <frames>, "pm_bad": <frames>}, the frame counts being those
+# parsed since the previous reading it sent.
+SENSOR_STATS_KEY = 'sensor'
+
+def new_trace(captured):
+    return {'captured': round(captured, 4), 'hops': []}
+
+def add_hop(trace, hop):
+    # traces come from other processes, so one without hops, or that is
+    # not a dict at all, must not cost the reading
+    if isinstance(trace, dict):
+        trace.setdefault('hops', []).append([hop, round(time.time(), 4)])
+    return trace
+
+def trace_captured(trace):
+    """The trace's capture time, or None if it has no usable one."""
+    captured = trace.get('captured') if isinstance(trace, dict) else None
+    if isinstance(captured, bool) or \
+            not isinstance(captured, (int, float)):
+        return None
+    return captured
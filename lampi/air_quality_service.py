@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+import argparse
+import threading
 import time
 import json
-import pigpio
 import paho.mqtt.client as mqtt
-import shelve
 
 from air_quality_common import *
+import sensor_backends
+from state_journal import StateJournal
+from aqi_engine import AirQualityEngine, AQI_CATEGORIES, load_config
+from device_health import HealthReporter, ReadingStats
 
 PIN_R = 19
 PIN_G = 26
@@ -16,43 +20,69 @@ PWM_FREQUENCY = 1000
 SENSOR_STATE_FILENAME = "sensor_state"
 MQTT_CLIENT_ID = "lampi"
 MAX_STARTUP_WAIT_SECS = 10.0
+# after a power loss the recovered state is at most this stale
+SENSOR_STATE_MAX_STALENESS_SECS = 5.0
+# readings per second the sensor reader is expected to deliver
+EXPECTED_READING_RATE = 1.0
+SENSOR_STATE_KEYS = ('pm25', 'pm10', 'temperature', 'humidity',
+                     'pressure', 'altitude')
 
 class InvalidSensorData(Exception):
     pass
 
 class LampDriver:
-    def __init__(self):
-        self._gpio = pigpio.pi()
-        for pin in PINS:
-            self._gpio.set_mode(pin, pigpio.OUTPUT)
-            self._gpio.set_PWM_frequency(pin, PWM_FREQUENCY)
-            self._gpio.set_PWM_range(pin, PWM_RANGE)
-            self._gpio.set_PWM_dutycycle(pin, 0)
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = sensor_backends.PigpioPWMBackend()
+        self._pwm = backend
+        self._pwm.setup(PINS, PWM_FREQUENCY, PWM_RANGE)
+        self._duty_cycles = (0, 0, 0)
 
     def change_color(self, red_dc, green_dc, blue_dc):
-        for pin, dc in zip(PINS, (red_dc, green_dc, blue_dc)):
-            self._gpio.set_PWM_dutycycle(pin, dc)
+        # only touch the pins whose duty cycle actually changes
+        new_duty_cycles = (red_dc, green_dc, blue_dc)
+        for pin, old, new in zip(PINS, self._duty_cycles, new_duty_cycles):
+            if old != new:
+                self._pwm.set_duty_cycle(pin, new)
+        self._duty_cycles = new_duty_cycles
 
 
 class AirQualityService:
-    def __init__(self):
-        # thresholds (µg/m3 for PM, % for humidity)
-        self.PM25_DANGER = 75.0
-        self.PM10_DANGER = 150.0
-        self.HUMIDITY_WARNING = 80.0
+    def __init__(self, lamp_backend=None, aqi_config=None):
+        # streaming NowCast/AQI with hysteresis decides the lamp colour
+        self.aqi_engine = AirQualityEngine(aqi_config)
 
         # lamp controller
-        self.lamp = LampDriver()
+        self.lamp = LampDriver(lamp_backend)
 
         # MQTT client
         self._client = self._create_and_configure_broker_client()
 
-        # persistent state store
-        self.db = shelve.open(SENSOR_STATE_FILENAME, writeback=True)
-        for key in ('pm25', 'pm10', 'temperature', 'humidity',
-                    'pressure', 'altitude'):
-            if key not in self.db:
-                self.db[key] = 0.0
+        # readings can arrive on the paho thread and the local IPC thread
+        self._lock = threading.Lock()
+        self._local_subscriber = None
+        self._local_publisher = None
+        if LOCAL_IPC_ENABLED:
+            import local_ipc
+            self._local_publisher = local_ipc.LocalPublisher(
+                local_ipc.CHANNEL_STATE)
+            self._local_subscriber = local_ipc.LocalSubscriber(
+                local_ipc.CHANNEL_SENSOR_DATA, MQTT_CLIENT_ID,
+                self.on_local_sensor_data, sender_hop=HOP_READ_SENSOR)
+
+        # persistent state store: in memory, journaled in coalesced flushes
+        self.db = StateJournal(
+            SENSOR_STATE_FILENAME,
+            defaults={key: 0.0 for key in SENSOR_STATE_KEYS},
+            max_staleness=SENSOR_STATE_MAX_STALENESS_SECS)
+        self._update_aqi()
+
+        # periodic health record for the backend
+        self._reading_stats = ReadingStats()
+        self._health_reporter = HealthReporter(
+            self._client, self._reading_stats, self.db,
+            expected_rate=EXPECTED_READING_RATE)
+        self._connects = 0
 
         # publish initial state & lamp colour
         self.publish_state()
@@ -70,6 +100,10 @@ class AirQualityService:
             TOPIC_SET_SENSOR_DATA,
             self.on_message_sensor_data
         )
+        client.message_callback_add(
+            TOPIC_LAMPI_SAMPLE_RATE,
+            self.on_message_sample_rate
+        )
         client.on_message = self.default_on_message
         return client
 
@@ -92,14 +126,26 @@ class AirQualityService:
                 else:
                     raise
 
-        self._client.loop_forever()
+        if self._local_subscriber is not None:
+            self._local_subscriber.start()
+        self._health_reporter.start()
+        try:
+            self._client.loop_forever()
+        finally:
+            self._health_reporter.stop()
+            if self._local_subscriber is not None:
+                self._local_subscriber.close()
+            self.db.close()
 
     def on_connect(self, client, userdata, flags, rc):
+        self._connects += 1
+        self._health_reporter.reconnects = self._connects - 1
         self._client.publish(
             client_state_topic(MQTT_CLIENT_ID),
             "1", qos=2, retain=True
         )
         self._client.subscribe(TOPIC_SET_SENSOR_DATA, qos=1)
+        self._client.subscribe(TOPIC_LAMPI_SAMPLE_RATE, qos=1)
         self.publish_state()
         self._update_lamp_color()
 
@@ -111,51 +157,97 @@ class AirQualityService:
             payload = msg.payload.decode('utf-8')
             new_data = json.loads(payload)
 
-            required = ('pm25', 'pm10', 'temperature',
-                        'humidity', 'pressure', 'altitude')
-            for k in required:
+            for k in SENSOR_STATE_KEYS:
                 if k not in new_data:
                     raise InvalidSensorData(f"Missing key {k}")
                 new_data[k] = float(new_data[k])
 
-            for k in required:
-                self.db[k] = round(new_data[k], 2)
-
-            self.db.sync()
-            self.publish_state()
-            self._update_lamp_color()
+            self._apply_sensor_data(new_data)
 
         except (json.JSONDecodeError, InvalidSensorData) as e:
             print("Error processing sensor data:", e)
 
-    def publish_state(self):
-        state = {k: self.db[k] for k in (
-            'pm25', 'pm10', 'temperature',
-            'humidity', 'pressure', 'altitude'
-        )}
+    def on_message_sample_rate(self, client, userdata, msg):
+        # keep the health record's expected rate in step with read_sensor
+        try:
+            period = float(json.loads(msg.payload.decode('utf-8'))['period'])
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+            print("Invalid sample rate message:", e)
+            return
+        if period > 0:
+            self._health_reporter.expected_rate = 1.0 / period
+
+    def on_local_sensor_data(self, new_data):
+        # already decoded, typed and complete
+        self._apply_sensor_data(new_data)
+
+    def _apply_sensor_data(self, new_data):
+        # readings injected with air_quality_cmd have no trace of their own
+        trace = new_data.get(TRACE_KEY)
+        if not trace or not isinstance(trace, dict):
+            trace = new_trace(time.time())
+        add_hop(trace, HOP_SERVICE_RECV)
+        self._reading_stats.add(trace_captured(trace),
+                                new_data.get(SENSOR_STATS_KEY))
+        with self._lock:
+            self.db.update({k: round(new_data[k], 2)
+                            for k in SENSOR_STATE_KEYS})
+            self._update_aqi()
+            self.publish_state(add_hop(trace, HOP_SERVICE_PUB))
+            self._update_lamp_color()
+
+    def publish_state(self, trace=None):
+        state = {k: self.db[k] for k in SENSOR_STATE_KEYS}
+        if trace is not None:
+            state[TRACE_KEY] = trace
+        state['aqi'] = self.aqi_engine.aqi
+        state['aqi_category'] = AQI_CATEGORIES[self.aqi_engine.category][1]
+        if self._local_publisher is not None:
+            state['aqi_category_index'] = self.aqi_engine.category
+            self._local_publisher.publish(state)
+            del state['aqi_category_index']
+        # still published over MQTT for the cloud bridge and air_quality_cmd
         self._client.publish(
             TOPIC_LAMPI_CHANGE_NOTIFICATION,
             json.dumps(state).encode('utf-8'),
             qos=1, retain=True
         )
 
-    def _update_lamp_color(self):
-        h = self.db['humidity']
-        p25 = self.db['pm25']
-        p10 = self.db['pm10']
-
-        # Humidity warning (yellow)
-        if h > self.HUMIDITY_WARNING:
-            colour = (PWM_RANGE, PWM_RANGE, 0)
-        # Danger from particulates (red)
-        elif p25 > self.PM25_DANGER or p10 > self.PM10_DANGER:
-            colour = (PWM_RANGE, 0, 0)
-        # All good (green)
-        else:
-            colour = (0, PWM_RANGE, 0)
+    def _update_aqi(self):
+        self.aqi_engine.update(self.db['pm25'], self.db['pm10'],
+                               self.db['humidity'])
 
+    def _update_lamp_color(self):
+        colour = tuple(round(c * PWM_RANGE) for c in self.aqi_engine.colour)
         self.lamp.change_color(*colour)
 
 
+def build_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Air quality service driving the lamp colour."
+    )
+    parser.add_argument('--lamp', choices=('pigpio', 'null'),
+                        default='pigpio',
+                        help='Lamp PWM backend (null runs without a Pi)')
+    parser.add_argument('--record-lamp', metavar='TRACE', default=None,
+                        help='Record lamp PWM writes to TRACE')
+    parser.add_argument('--aqi-config', metavar='JSON', default=None,
+                        help='AQI colour breakpoints and hysteresis settings')
+    return parser
+
+
+def build_lamp_backend(args):
+    if args.lamp == 'null':
+        backend = sensor_backends.NullPWMBackend()
+    else:
+        backend = sensor_backends.PigpioPWMBackend()
+    if args.record_lamp:
+        backend = sensor_backends.RecordingPWMBackend(
+            backend, sensor_backends.TraceWriter(args.record_lamp))
+    return backend
+
+
 if __name__ == '__main__':
-    AirQualityService().serve()
+    args = build_argument_parser().parse_args()
+    AirQualityService(build_lamp_backend(args),
+                      load_config(args.aqi_config)).serve()
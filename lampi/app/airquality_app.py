@@ -1,24 +1,84 @@
 import json
+import threading
+import time
 import pigpio
 
 from kivy.app import App
-from kivy.properties import NumericProperty, BooleanProperty, StringProperty
+from kivy.properties import (NumericProperty, BooleanProperty, StringProperty,
+                             ListProperty)
 from kivy.clock import Clock
 from kivy.uix.popup import Popup
 from kivy.uix.label import Label
 from paho.mqtt.client import Client
 from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.widget import Widget
 
 
 from air_quality_common import *
 import app.lampi_util
+from app.history_buffer import MetricHistory, HISTORY_LEVELS, sparkline_points
 
 MQTT_CLIENT_ID = "lampi_ui"
+# upper bound on how often sensor updates are applied to the UI
+UI_MAX_REFRESH_HZ = 10.0
+GPIO_BUTTON = 17
+# the button level must be stable this long before an edge is reported
+GPIO_DEBOUNCE_US = 20000
+
+# state key -> (app property, conversion)
+SENSOR_UI_FIELDS = (
+    ('pm25', 'pm25', float),
+    ('pm10', 'pm10', float),
+    ('temperature', 'temperature', float),
+    ('humidity', 'humidity', float),
+    ('pressure', 'pressure', round),
+    ('altitude', 'altitude', float),
+)
+
+class Sparkline(Widget):
+    # bound to a single canvas Line in airquality.kv, updated in place
+    points = ListProperty([])
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._values = []
+        self.bind(pos=self._redraw, size=self._redraw)
+
+    def set_values(self, values):
+        self._values = values
+        self._redraw()
+
+    def _redraw(self, *args):
+        self.points = sparkline_points(self._values, self.x, self.y,
+                                       self.width, self.height)
+
 
 class Card(BoxLayout):
     sensor_title = StringProperty("")
     sensor_reading = StringProperty("")
-    
+    # app property whose history is drawn, and which history level
+    metric = StringProperty("")
+    history_window = StringProperty(HISTORY_LEVELS[0][0])
+
+    def on_touch_down(self, touch):
+        # tap a card to cycle through the 1h / 24h sparklines
+        if self.collide_point(*touch.pos):
+            names = [name for name, _, _ in HISTORY_LEVELS]
+            index = names.index(self.history_window)
+            self.history_window = names[(index + 1) % len(names)]
+            return True
+        return super().on_touch_down(touch)
+
+    def on_history_window(self, instance, value):
+        self.refresh_sparkline()
+
+    def refresh_sparkline(self):
+        app = App.get_running_app()
+        if self.metric in app.histories:
+            self.ids.sparkline.set_values(
+                app.histories[self.metric].values(self.history_window))
+
+
 class AirQualityApp(App):
     # Define sensor properties
     pm25 = NumericProperty(0)      # for PM2.5 readings
@@ -33,9 +93,24 @@ class AirQualityApp(App):
     gpio17_pressed = BooleanProperty(False)
 
     def on_start(self):
+        # fixed-size, multi-resolution history for the card sparklines
+        self.histories = {prop: MetricHistory()
+                          for _, prop, _ in SENSOR_UI_FIELDS}
+
+        # latest-wins mailbox: the MQTT thread overwrites it and the UI
+        # thread drains it at most UI_MAX_REFRESH_HZ times a second
+        self._sensor_mailbox = None
+        self._sensor_mailbox_lock = threading.Lock()
+        self._drain_sensor_mailbox_trigger = Clock.create_trigger(
+            self._drain_sensor_mailbox, 1.0 / UI_MAX_REFRESH_HZ)
+
         self.mqtt_broker_bridged = False
         self._associated = True
         self.association_code = None
+        # association changes arrive on the paho thread; the trigger applies
+        # them on the Kivy thread
+        self._apply_associated_trigger = Clock.create_trigger(
+            self._apply_associated)
         self.mqtt = Client(client_id=MQTT_CLIENT_ID)
         self.mqtt.enable_logger()
         self.mqtt.will_set(client_state_topic(MQTT_CLIENT_ID), "0",
@@ -45,11 +120,24 @@ class AirQualityApp(App):
                           keepalive=MQTT_BROKER_KEEP_ALIVE_SECS)
         self.mqtt.loop_start()
 
+        self._local_subscriber = None
+        if LOCAL_IPC_ENABLED:
+            # sensor state straight from the service, no broker round-trip
+            import local_ipc
+            self._local_subscriber = local_ipc.LocalSubscriber(
+                local_ipc.CHANNEL_STATE, MQTT_CLIENT_ID,
+                self.receive_local_sensor_data, sender_hop=HOP_SERVICE_PUB)
+            self._local_subscriber.start()
+
         # Set up GPIO and device status popup
         self.set_up_gpio_and_device_status_popup()
         self.associated_status_popup = self._build_associated_status_popup()
         self.associated_status_popup.bind(on_open=self.update_popup_associated)
-        Clock.schedule_interval(self._poll_associated, 0.1)
+        self._apply_associated_trigger()
+
+    def on_stop(self):
+        if self._local_subscriber is not None:
+            self._local_subscriber.close()
 
     def _build_associated_status_popup(self):
         return Popup(
@@ -64,7 +152,9 @@ class AirQualityApp(App):
         self.mqtt.publish(client_state_topic(MQTT_CLIENT_ID), b"1",
                           qos=2, retain=True)
         # Subscribe to the sensor change notifications from the sensor publishing script.
-        self.mqtt.message_callback_add(TOPIC_LAMPI_CHANGE_NOTIFICATION, self.receive_sensor_data)
+        if not LOCAL_IPC_ENABLED:
+            self.mqtt.message_callback_add(TOPIC_LAMPI_CHANGE_NOTIFICATION,
+                                           self.receive_sensor_data)
         # Subscribe to the MQTT bridge connection status and association topics.
         self.mqtt.message_callback_add(broker_bridge_connection_topic(),
                                        self.receive_bridge_connection_status)
@@ -72,10 +162,11 @@ class AirQualityApp(App):
                                        self.receive_associated)
 
         self.mqtt.subscribe(broker_bridge_connection_topic(), qos=1)
-        self.mqtt.subscribe(TOPIC_LAMPI_CHANGE_NOTIFICATION, qos=1)
+        if not LOCAL_IPC_ENABLED:
+            self.mqtt.subscribe(TOPIC_LAMPI_CHANGE_NOTIFICATION, qos=1)
         self.mqtt.subscribe(TOPIC_LAMPI_ASSOCIATED, qos=2)
 
-    def _poll_associated(self, dt):
+    def _apply_associated(self, dt):
         # Synchronize changes from MQTT callbacks (in a different thread) to the UI.
         self.device_associated = self._associated
 
@@ -88,6 +179,7 @@ class AirQualityApp(App):
             else:
                 self.association_code = None
             self._associated = new_associated['associated']
+            self._apply_associated_trigger()
 
     def on_device_associated(self, instance, value):
         if value:
@@ -110,30 +202,63 @@ class AirQualityApp(App):
         self.mqtt_broker_bridged = (message.payload == b"1")
 
     def receive_sensor_data(self, client, userdata, message):
-        # Process incoming sensor data.
-        new_state = json.loads(message.payload.decode('utf-8'))
-        Clock.schedule_once(lambda dt: self._update_ui(new_state), 0.01)
+        # Runs on the paho thread: just replace the pending payload.  The
+        # trigger is a no-op if a drain is already scheduled, so a burst of
+        # messages costs one UI update and one JSON decode.
+        with self._sensor_mailbox_lock:
+            self._sensor_mailbox = message.payload
+        self._drain_sensor_mailbox_trigger()
+
+    def receive_local_sensor_data(self, new_state):
+        # Runs on the local IPC thread; the record is already decoded.
+        with self._sensor_mailbox_lock:
+            self._sensor_mailbox = new_state
+        self._drain_sensor_mailbox_trigger()
+
+    def _drain_sensor_mailbox(self, dt):
+        with self._sensor_mailbox_lock:
+            payload, self._sensor_mailbox = self._sensor_mailbox, None
+        if payload is None:
+            return
+        if isinstance(payload, dict):
+            self._update_ui(payload)
+            return
+        try:
+            new_state = json.loads(payload.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print("Error decoding sensor data:", e)
+            return
+        self._update_ui(new_state)
 
     def _update_ui(self, new_state):
-        if 'pm25' in new_state:
-            self.pm25 = new_state['pm25']
-        if 'pm10' in new_state:
-            self.pm10 = new_state['pm10']
-        if 'temperature' in new_state:
-            self.temperature = new_state['temperature']
-        if 'humidity' in new_state:
-            self.humidity = new_state['humidity']
-        if 'pressure' in new_state:
-            self.pressure = round(new_state['pressure'])
-        if 'altitude' in new_state:
-            self.altitude = new_state['altitude']
+        # only set properties whose values changed, so unchanged cards are
+        # not re-rendered
+        now = time.time()
+        for key, prop, convert in SENSOR_UI_FIELDS:
+            if key in new_state:
+                value = convert(new_state[key])
+                if getattr(self, prop) != value:
+                    setattr(self, prop, value)
+                # sparklines only redraw when a history bucket closes
+                changed = self.histories[prop].add(value, now)
+                card = self.root.ids.get(prop + '_card')
+                if card is not None and card.history_window in changed:
+                    card.refresh_sparkline()
 
     def set_up_gpio_and_device_status_popup(self):
         self.pi = pigpio.pi()
         # GPIO17 can be used as a hardware trigger for showing the network status.
-        self.pi.set_mode(17, pigpio.INPUT)
-        self.pi.set_pull_up_down(17, pigpio.PUD_UP)
-        Clock.schedule_interval(self._poll_gpio, 0.05)
+        self.pi.set_mode(GPIO_BUTTON, pigpio.INPUT)
+        self.pi.set_pull_up_down(GPIO_BUTTON, pigpio.PUD_UP)
+        # edge-triggered: pigpiod's glitch filter debounces the button and
+        # it calls back on its own thread, which hands off to the Kivy thread
+        self.pi.set_glitch_filter(GPIO_BUTTON, GPIO_DEBOUNCE_US)
+        self._gpio17_level = self.pi.read(GPIO_BUTTON)
+        self._apply_gpio_trigger = Clock.create_trigger(self._apply_gpio)
+        self._gpio_callback = self.pi.callback(GPIO_BUTTON,
+                                               pigpio.EITHER_EDGE,
+                                               self._on_gpio_edge)
+        self._apply_gpio_trigger()
         self.network_status_popup = self._build_network_status_popup()
         self.network_status_popup.bind(on_open=self.update_popup_ip_address)
 
@@ -165,9 +290,15 @@ class AirQualityApp(App):
         else:
             self.network_status_popup.dismiss()
 
-    def _poll_gpio(self, _delta_time):
-        # GPIO17 is used as a hardware button.
-        self.gpio17_pressed = not self.pi.read(17)
+    def _on_gpio_edge(self, gpio, level, tick):
+        # Runs on the pigpio callback thread; level 2 is a watchdog timeout.
+        if level in (0, 1):
+            self._gpio17_level = level
+            self._apply_gpio_trigger()
+
+    def _apply_gpio(self, _delta_time):
+        # GPIO17 is used as a hardware button (active low).
+        self.gpio17_pressed = not self._gpio17_level
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+from array import array
+
+# (name, bucket seconds, buckets) -- each level spans buckets * seconds
+HISTORY_LEVELS = (
+    ("1h", 10, 360),
+    ("24h", 240, 360),
+)
+
+
+class RingBuffer:
+    """Fixed-size float ring buffer; memory never grows."""
+
+    def __init__(self, capacity):
+        self._values = array('f', [0.0] * capacity)
+        self._index = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        self._values[self._index] = value
+        self._index = (self._index + 1) % len(self._values)
+        self._count = min(self._count + 1, len(self._values))
+
+    def values(self):
+        """Return the contents oldest first."""
+        if self._count < len(self._values):
+            return self._values[:self._count]
+        return self._values[self._index:] + self._values[:self._index]
+
+
+class MetricHistory:
+    """Multi-resolution history of one metric.
+
+    Every level averages the raw samples into fixed-width time buckets and
+    keeps the most recent bucket means in its own ring buffer, so the 24 h
+    view costs the same memory as the 1 h view.
+    """
+
+    def __init__(self, levels=HISTORY_LEVELS):
+        self._levels = {}
+        for name, bucket_secs, buckets in levels:
+            self._levels[name] = {
+                'bucket_secs': bucket_secs,
+                'ring': RingBuffer(buckets),
+                'bucket': None,
+                'sum': 0.0,
+                'count': 0,
+            }
+
+    def add(self, value, now):
+        """Add a sample; return the names of levels that gained a point."""
+        changed = []
+        for name, level in self._levels.items():
+            bucket = int(now // level['bucket_secs'])
+            if level['bucket'] is not None and bucket != level['bucket'] \
+                    and level['count']:
+                level['ring'].append(level['sum'] / level['count'])
+                level['sum'] = 0.0
+                level['count'] = 0
+                changed.append(name)
+            level['bucket'] = bucket
+            level['sum'] += value
+            level['count'] += 1
+        return changed
+
+    def values(self, name):
+        return self._levels[name]['ring'].values()
+
+
+def sparkline_points(values, x, y, width, height):
+    """Scale ``values`` into a flat [x0, y0, x1, y1, ...] list for a Line."""
+    n = len(values)
+    if n < 2 or width <= 0 or height <= 0:
+        return []
+    lo = min(values)
+    hi = max(values)
+    span = (hi - lo) or 1.0
+    step = width / (n - 1)
+    points = [0.0] * (2 * n)
+    for i, v in enumerate(values):
+        points[2 * i] = x + i * step
+        points[2 * i + 1] = y + (v - lo) / span * height
+    return points
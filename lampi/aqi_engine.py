@@ -0,0 +1,248 @@
+"""Streaming EPA NowCast / AQI engine that drives the lamp colour.
+
+Each reading is folded into O(1)-update accumulators: a running mean for
+the current hour and a 12-slot ring of completed hourly means per
+pollutant (the NowCast window), plus a short rolling mean for humidity.
+The current partial hour counts as the most recent NowCast hour, so the
+lamp responds within the hour rather than only at hour boundaries.
+
+The AQI category only changes after the new category has been sustained
+for ``hysteresis_secs``; within the current category the colour follows
+the AQI along a graded, configurable colour scale.
+"""
+import json
+import time
+from array import array
+from collections import deque
+
+NOWCAST_HOURS = 12
+SECS_PER_HOUR = 3600
+
+# (concentration low, concentration high, AQI low, AQI high), EPA 2024
+PM25_BREAKPOINTS = (
+    (0.0, 9.0, 0, 50),
+    (9.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 125.4, 151, 200),
+    (125.5, 225.4, 201, 300),
+    (225.5, 325.4, 301, 500),
+)
+PM10_BREAKPOINTS = (
+    (0, 54, 0, 50),
+    (55, 154, 51, 100),
+    (155, 254, 101, 150),
+    (255, 354, 151, 200),
+    (355, 424, 201, 300),
+    (425, 604, 301, 500),
+)
+
+AQI_CATEGORIES = (
+    # (upper AQI bound, name)
+    (50, "Good"),
+    (100, "Moderate"),
+    (150, "Unhealthy for Sensitive Groups"),
+    (200, "Unhealthy"),
+    (300, "Very Unhealthy"),
+    (500, "Hazardous"),
+)
+
+DEFAULT_CONFIG = {
+    # (AQI, (r, g, b)) stops, colours as 0..1 fractions of full brightness
+    "colour_stops": [
+        [0, [0.0, 1.0, 0.0]],
+        [50, [0.6, 1.0, 0.0]],
+        [100, [1.0, 1.0, 0.0]],
+        [150, [1.0, 0.5, 0.0]],
+        [200, [1.0, 0.0, 0.0]],
+        [300, [0.56, 0.25, 0.6]],
+        [500, [0.5, 0.0, 0.14]],
+    ],
+    "humidity_warning": 80.0,
+    "humidity_colour": [1.0, 1.0, 0.0],
+    "humidity_window_secs": 300,
+    "hysteresis_secs": 60.0,
+}
+
+
+def load_config(path=None):
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def aqi_from_concentration(concentration, breakpoints):
+    """Piecewise-linear EPA AQI; values above the table are capped."""
+    for c_lo, c_hi, i_lo, i_hi in breakpoints:
+        if concentration <= c_hi:
+            concentration = max(concentration, c_lo)
+            return round((i_hi - i_lo) / (c_hi - c_lo)
+                         * (concentration - c_lo) + i_lo)
+    return breakpoints[-1][3]
+
+
+def aqi_category(aqi):
+    for index, (upper, _) in enumerate(AQI_CATEGORIES):
+        if aqi <= upper:
+            return index
+    return len(AQI_CATEGORIES) - 1
+
+
+class RollingMean:
+    """Mean of the samples from the last ``window_secs`` seconds, with
+    amortised O(1) updates whatever the sample rate."""
+
+    def __init__(self, window_secs):
+        self._window = window_secs
+        # (time, value), oldest first
+        self._samples = deque()
+        self._sum = 0.0
+
+    def add(self, value, now):
+        self._samples.append((now, value))
+        self._sum += value
+        # always keep the newest sample, however slow the readings
+        while len(self._samples) > 1 and \
+                self._samples[0][0] <= now - self._window:
+            self._sum -= self._samples.popleft()[1]
+
+    @property
+    def mean(self):
+        return self._sum / len(self._samples) if self._samples else None
+
+
+class NowCast:
+    """EPA NowCast over hourly means, updated one reading at a time."""
+
+    def __init__(self):
+        self._hours = array('d', [0.0] * NOWCAST_HOURS)
+        self._valid = array('b', [0] * NOWCAST_HOURS)
+        self._newest = 0
+        self._hour = None
+        self._hour_sum = 0.0
+        self._hour_count = 0
+
+    def add(self, value, now):
+        hour = int(now // SECS_PER_HOUR)
+        if self._hour is None:
+            self._hour = hour
+        elif hour != self._hour:
+            self._close_hours(hour)
+        self._hour_sum += value
+        self._hour_count += 1
+
+    def _close_hours(self, hour):
+        # push the finished hour, then mark any hours without data missing
+        elapsed = min(hour - self._hour, NOWCAST_HOURS)
+        for i in range(elapsed):
+            self._newest = (self._newest + 1) % NOWCAST_HOURS
+            if i == 0 and self._hour_count:
+                self._hours[self._newest] = self._hour_sum / self._hour_count
+                self._valid[self._newest] = 1
+            else:
+                self._valid[self._newest] = 0
+        self._hour = hour
+        self._hour_sum = 0.0
+        self._hour_count = 0
+
+    def value(self):
+        """NowCast concentration, or None without enough recent data."""
+        concentrations = []
+        if self._hour_count:
+            concentrations.append(self._hour_sum / self._hour_count)
+        for i in range(NOWCAST_HOURS - len(concentrations)):
+            slot = (self._newest - i) % NOWCAST_HOURS
+            concentrations.append(self._hours[slot]
+                                  if self._valid[slot] else None)
+        # EPA requires two of the three most recent hours; until then fall
+        # back to the current hour's mean
+        if sum(c is not None for c in concentrations[:3]) < 2:
+            return concentrations[0]
+        present = [c for c in concentrations if c is not None]
+        c_min, c_max = min(present), max(present)
+        weight = max(c_min / c_max, 0.5) if c_max > 0 else 1.0
+        numerator = denominator = 0.0
+        factor = 1.0
+        for c in concentrations:
+            if c is not None:
+                numerator += factor * c
+                denominator += factor
+            factor *= weight
+        return numerator / denominator
+
+
+class AirQualityEngine:
+    def __init__(self, config=None):
+        self.config = config or load_config()
+        self._stops = sorted((aqi, tuple(rgb))
+                             for aqi, rgb in self.config["colour_stops"])
+        self._pm25 = NowCast()
+        self._pm10 = NowCast()
+        self._humidity = RollingMean(self.config["humidity_window_secs"])
+
+        self.aqi = 0
+        self.category = 0
+        self.humidity_warning = False
+        # (candidate, first seen) for transitions not yet sustained
+        self._pending_category = None
+        self._pending_humidity = None
+        self._started = False
+
+    def update(self, pm25, pm10, humidity, now=None):
+        now = time.time() if now is None else now
+        self._pm25.add(pm25, now)
+        self._pm10.add(pm10, now)
+        self._humidity.add(humidity, now)
+
+        self.aqi = max(
+            aqi_from_concentration(self._pm25.value(), PM25_BREAKPOINTS),
+            aqi_from_concentration(self._pm10.value(), PM10_BREAKPOINTS))
+        if not self._started:
+            # nothing to debounce against yet
+            self._started = True
+            self.category = aqi_category(self.aqi)
+            self.humidity_warning = (self._humidity.mean
+                                     > self.config["humidity_warning"])
+            return
+        self.category = self._apply_hysteresis(
+            'category', self.category, aqi_category(self.aqi), now)
+        self.humidity_warning = self._apply_hysteresis(
+            'humidity', self.humidity_warning,
+            self._humidity.mean > self.config["humidity_warning"], now)
+
+    def _apply_hysteresis(self, name, current, candidate, now):
+        # a change is only accepted once it has held for hysteresis_secs
+        pending = getattr(self, '_pending_' + name, None)
+        if candidate == current:
+            setattr(self, '_pending_' + name, None)
+            return current
+        if pending is None or pending[0] != candidate:
+            setattr(self, '_pending_' + name, (candidate, now))
+            return current
+        if now - pending[1] >= self.config["hysteresis_secs"]:
+            setattr(self, '_pending_' + name, None)
+            return candidate
+        return current
+
+    @property
+    def colour(self):
+        """Lamp colour as (r, g, b) fractions of full brightness."""
+        if self.humidity_warning:
+            return tuple(self.config["humidity_colour"])
+        # keep the graded colour inside the (hysteresis-filtered) category
+        lower = AQI_CATEGORIES[self.category - 1][0] + 1 \
+            if self.category else 0
+        upper = AQI_CATEGORIES[self.category][0]
+        return self._interpolate(min(max(self.aqi, lower), upper))
+
+    def _interpolate(self, aqi):
+        stops = self._stops
+        if aqi <= stops[0][0]:
+            return stops[0][1]
+        for (a_lo, c_lo), (a_hi, c_hi) in zip(stops, stops[1:]):
+            if aqi <= a_hi:
+                t = (aqi - a_lo) / (a_hi - a_lo)
+                return tuple(lo + (hi - lo) * t
+                             for lo, hi in zip(c_lo, c_hi))
+        return stops[-1][1]
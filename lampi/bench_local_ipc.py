@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Compare the local IPC fast path with the broker over the whole pipeline.
+
+Drives N readings along read_sensor -> air_quality_service -> UI over each
+transport, with each stage doing what its process does with a reading:
+the sensor stage stamps the trace and sends the reading, the service stage
+decodes it, updates the AQI engine and sends the state, and the UI stage
+decodes the state.  Reports capture-to-UI latency (p50/p99), the p50 of
+each hop, and CPU time per reading.  The stages run as threads of this
+process, so the CPU figure covers all three and excludes the broker; the
+MQTT path needs a broker on MQTT_BROKER_HOST:MQTT_BROKER_PORT.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+# keep benchmark sockets away from the live channels
+os.environ.setdefault('LAMPI_LOCAL_IPC_DIR', tempfile.mkdtemp())
+
+from air_quality_common import (
+    MQTT_BROKER_HOST,
+    MQTT_BROKER_PORT,
+    MQTT_BROKER_KEEP_ALIVE_SECS,
+    MQTT_VERSION,
+    TRACE_KEY,
+    HOP_READ_SENSOR,
+    HOP_SERVICE_RECV,
+    HOP_SERVICE_PUB,
+    new_trace,
+    add_hop,
+)
+from aqi_engine import AirQualityEngine
+
+BENCH_SENSOR_TOPIC = "lampi/bench/set_sensor_data"
+BENCH_STATE_TOPIC = "lampi/bench/changed"
+BENCH_SENSOR_CHANNEL = "bench_sensor_data"
+BENCH_STATE_CHANNEL = "bench_state"
+SAMPLE_READING = {"pm25": 12.3, "pm10": 20.1, "temperature": 21.5,
+                  "humidity": 45.2, "pressure": 1013.2, "altitude": 120.0}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(name, results, cpu_secs, count):
+    end_to_end = results['end_to_end']
+    if not end_to_end:
+        print("{:<6} no readings arrived".format(name))
+        return
+    print("{:<6} n={:<6} p50={:8.1f}us p99={:8.1f}us cpu/reading={:6.1f}us"
+          .format(name, len(end_to_end),
+                  percentile(end_to_end, 0.5) * 1e6,
+                  percentile(end_to_end, 0.99) * 1e6,
+                  cpu_secs / count * 1e6))
+    print("       sensor->service p50={:8.1f}us  service->ui p50={:8.1f}us"
+          .format(percentile(results['to_service'], 0.5) * 1e6,
+                  percentile(results['to_ui'], 0.5) * 1e6))
+
+
+class Pipeline:
+    """The per-reading work of each stage, shared by both transports."""
+
+    def __init__(self, count):
+        self.count = count
+        self.engine = AirQualityEngine()
+        self.results = {'end_to_end': [], 'to_service': [], 'to_ui': []}
+        self.done = threading.Event()
+
+    def sensor_reading(self):
+        # read_sensor: the reading leaves as soon as it is captured
+        reading = dict(SAMPLE_READING, **{TRACE_KEY: new_trace(time.time())})
+        add_hop(reading[TRACE_KEY], HOP_READ_SENSOR)
+        return reading
+
+    def service_state(self, reading, sent_at):
+        # air_quality_service
+        trace = reading[TRACE_KEY]
+        add_hop(trace, HOP_SERVICE_RECV)
+        self.results['to_service'].append(time.time() - sent_at)
+        self.engine.update(reading['pm25'], reading['pm10'],
+                           reading['humidity'])
+        state = {k: reading[k] for k in SAMPLE_READING}
+        state['aqi'] = self.engine.aqi
+        state['aqi_category_index'] = self.engine.category
+        state[TRACE_KEY] = add_hop(trace, HOP_SERVICE_PUB)
+        return state
+
+    def ui_received(self, state, sent_at):
+        now = time.time()
+        self.results['to_ui'].append(now - sent_at)
+        self.results['end_to_end'].append(now - state[TRACE_KEY]['captured'])
+        if len(self.results['end_to_end']) >= self.count:
+            self.done.set()
+
+
+def bench_local_ipc(count, interval):
+    import local_ipc
+    pipeline = Pipeline(count)
+    state_publisher = local_ipc.LocalPublisher(BENCH_STATE_CHANNEL)
+
+    def on_reading(reading):
+        # the record's send time stands in for read_sensor's hop
+        state_publisher.publish(pipeline.service_state(
+            reading, reading['sent_at']))
+
+    def on_state(state):
+        pipeline.ui_received(state, state['sent_at'])
+
+    service = local_ipc.LocalSubscriber(BENCH_SENSOR_CHANNEL, 'service',
+                                        on_reading,
+                                        sender_hop=HOP_READ_SENSOR)
+    ui = local_ipc.LocalSubscriber(BENCH_STATE_CHANNEL, 'ui', on_state,
+                                   sender_hop=HOP_SERVICE_PUB)
+    service.start()
+    ui.start()
+    sensor_publisher = local_ipc.LocalPublisher(BENCH_SENSOR_CHANNEL)
+    cpu_start = time.process_time()
+    for _ in range(count):
+        sensor_publisher.publish(pipeline.sensor_reading())
+        time.sleep(interval)
+    pipeline.done.wait(5)
+    cpu = time.process_time() - cpu_start
+    for endpoint in (service, ui, sensor_publisher, state_publisher):
+        endpoint.close()
+    report("ipc", pipeline.results, cpu, count)
+
+
+def bench_mqtt(count, interval):
+    import paho.mqtt.client as mqtt
+    pipeline = Pipeline(count)
+    subscribed = threading.Event()
+    clients = []
+
+    def connect(client_id, **callbacks):
+        client = mqtt.Client(client_id=client_id, protocol=MQTT_VERSION)
+        for name, callback in callbacks.items():
+            setattr(client, name, callback)
+        client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT,
+                       MQTT_BROKER_KEEP_ALIVE_SECS)
+        client.loop_start()
+        clients.append(client)
+        return client
+
+    def on_reading(client, userdata, msg):
+        reading = json.loads(msg.payload.decode('utf-8'))
+        state = pipeline.service_state(
+            reading, reading[TRACE_KEY]['hops'][-1][1])
+        client.publish(BENCH_STATE_TOPIC, json.dumps(state).encode('utf-8'),
+                       qos=1)
+
+    def on_state(client, userdata, msg):
+        state = json.loads(msg.payload.decode('utf-8'))
+        pipeline.ui_received(state, state[TRACE_KEY]['hops'][-1][1])
+
+    pending = [2]
+
+    def on_subscribe(*args):
+        pending[0] -= 1
+        if not pending[0]:
+            subscribed.set()
+
+    service = connect("bench_service", on_message=on_reading,
+                      on_subscribe=on_subscribe)
+    ui = connect("bench_ui", on_message=on_state, on_subscribe=on_subscribe)
+    service.subscribe(BENCH_SENSOR_TOPIC, qos=1)
+    ui.subscribe(BENCH_STATE_TOPIC, qos=1)
+    sensor = connect("bench_sensor")
+    subscribed.wait(5)
+
+    cpu_start = time.process_time()
+    for _ in range(count):
+        sensor.publish(BENCH_SENSOR_TOPIC,
+                       json.dumps(pipeline.sensor_reading()).encode('utf-8'),
+                       qos=1)
+        time.sleep(interval)
+    pipeline.done.wait(5)
+    cpu = time.process_time() - cpu_start
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+    report("mqtt", pipeline.results, cpu, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help='Seconds between readings')
+    parser.add_argument('--skip-mqtt', action='store_true')
+    args = parser.parse_args()
+
+    bench_local_ipc(args.count, args.interval)
+    if not args.skip_mqtt:
+        bench_mqtt(args.count, args.interval)
+
+
+if __name__ == '__main__':
+    main()
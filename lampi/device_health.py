@@ -0,0 +1,167 @@
+"""Periodic device health record for the backend.
+
+``ReadingStats`` is fed by the service on every reading; ``HealthReporter``
+publishes a compact JSON record on ``TOPIC_LAMPI_TELEMETRY`` every
+``interval`` seconds with the reading rate and jitter, the capture-to-service
+latency of the pipeline, the sensor read time and PM frame counts reported
+by read_sensor, MQTT queue depth and reconnects, state journal flush time
+and basic system load.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+from air_quality_common import TOPIC_LAMPI_TELEMETRY
+
+TELEMETRY_INTERVAL_SECS = 60.0
+CPU_TEMP_FILENAME = '/sys/class/thermal/thermal_zone0/temp'
+MEMINFO_FILENAME = '/proc/meminfo'
+
+
+class ReadingStats:
+    """Accumulates per-reading timings between health reports."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._count = 0
+        self._last_arrival = None
+        self._gap_sum = 0.0
+        self._gap_sq_sum = 0.0
+        self._gaps = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._latencies = 0
+        self._read_sum = 0.0
+        self._read_max = 0.0
+        self._reads = 0
+        self._good_frames = 0
+        self._bad_frames = 0
+        self._window_start = time.monotonic()
+
+    def add(self, captured=None, sensor=None):
+        """Count a reading captured at epoch time ``captured``; ``sensor``
+        is the SENSOR_STATS_KEY entry read_sensor sent with it, if any."""
+        now = time.monotonic()
+        with self._lock:
+            self._count += 1
+            if self._last_arrival is not None:
+                gap = now - self._last_arrival
+                self._gap_sum += gap
+                self._gap_sq_sum += gap * gap
+                self._gaps += 1
+            self._last_arrival = now
+            if captured:
+                latency = time.time() - captured
+                self._latency_sum += latency
+                self._latency_max = max(self._latency_max, latency)
+                self._latencies += 1
+            if sensor:
+                read_ms = sensor.get('read_ms')
+                if read_ms:
+                    self._read_sum += read_ms
+                    self._read_max = max(self._read_max, read_ms)
+                    self._reads += 1
+                self._good_frames += sensor.get('pm_good', 0)
+                self._bad_frames += sensor.get('pm_bad', 0)
+
+    def take(self):
+        """Return the stats for the window so far and start a new one."""
+        with self._lock:
+            elapsed = time.monotonic() - self._window_start
+            stats = {'rate': self._count / elapsed if elapsed else 0.0}
+            if self._gaps:
+                mean = self._gap_sum / self._gaps
+                variance = max(self._gap_sq_sum / self._gaps - mean * mean,
+                               0.0)
+                stats['jitter_ms'] = round(variance ** 0.5 * 1000, 1)
+            if self._latencies:
+                stats['pipeline_ms'] = round(
+                    self._latency_sum / self._latencies * 1000, 1)
+                stats['pipeline_max_ms'] = round(self._latency_max * 1000, 1)
+            if self._reads:
+                stats['read_ms'] = round(self._read_sum / self._reads, 1)
+                stats['read_max_ms'] = round(self._read_max, 1)
+            if self._good_frames or self._bad_frames:
+                stats['pm_good_frames'] = self._good_frames
+                stats['pm_bad_frames'] = self._bad_frames
+            last_arrival = self._last_arrival
+            self._reset()
+            # keep measuring the gap across the window boundary
+            self._last_arrival = last_arrival
+            return stats
+
+
+def _cpu_temperature():
+    try:
+        with open(CPU_TEMP_FILENAME) as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def _mem_available_mb():
+    try:
+        with open(MEMINFO_FILENAME) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def collect_system_health():
+    health = {
+        'cpu_temp': _cpu_temperature(),
+        'load': round(os.getloadavg()[0], 2),
+        'mem_mb': _mem_available_mb(),
+    }
+    try:
+        health['disk_mb'] = shutil.disk_usage('/').free // (1024 * 1024)
+    except OSError:
+        health['disk_mb'] = None
+    return health
+
+
+def mqtt_queue_depth(client):
+    # paho keeps unacknowledged QoS>0 messages and queued packets privately
+    return (len(getattr(client, '_out_messages', ()))
+            + len(getattr(client, '_out_packet', ())))
+
+
+class HealthReporter(threading.Thread):
+    def __init__(self, client, reading_stats, state_journal,
+                 expected_rate, interval=TELEMETRY_INTERVAL_SECS):
+        super().__init__(name="health-reporter", daemon=True)
+        self._client = client
+        self._stats = reading_stats
+        self._journal = state_journal
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.expected_rate = expected_rate
+        self.reconnects = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def build_record(self):
+        record = self._stats.take()
+        record['expected_rate'] = self.expected_rate
+        record['queue'] = mqtt_queue_depth(self._client)
+        record['reconnects'] = self.reconnects
+        record['flush_ms'] = round(self._journal.last_flush_secs * 1000, 1)
+        record.update(collect_system_health())
+        record['rate'] = round(record['rate'], 3)
+        return record
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self._client.publish(TOPIC_LAMPI_TELEMETRY,
+                                 json.dumps(self.build_record(),
+                                            separators=(',', ':')),
+                                 qos=0)
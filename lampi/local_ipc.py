@@ -0,0 +1,145 @@
+"""Broker-less fast path between processes on the same LAMPI.
+
+Each channel is a directory of Unix datagram sockets, one per subscriber.
+A publisher sends one fixed-size binary record to every subscriber socket
+it finds; sends never block and a full or missing subscriber just misses
+that record, which is fine because every record carries the whole latest
+state.  MQTT is still used for the cloud bridge and ``air_quality_cmd``.
+"""
+import errno
+import os
+import socket
+import struct
+import threading
+import time
+
+from air_quality_common import (LOCAL_IPC_DIR, TRACE_KEY, SENSOR_STATS_KEY,
+                                new_trace, trace_captured)
+
+CHANNEL_SENSOR_DATA = 'sensor_data'
+CHANNEL_STATE = 'state'
+
+STATE_FIELDS = ('pm25', 'pm10', 'temperature', 'humidity', 'pressure',
+                'altitude')
+# seq, capture time, publish time, six readings, AQI (-1 if unknown),
+# AQI category index, then read_sensor's acquisition stats (read time in
+# ms, good and bad PM frames; -1 if absent)
+_RECORD = struct.Struct('<Qdd6dhhdii')
+
+# how often a publisher rescans the channel for new subscribers
+SUBSCRIBER_RESCAN_SECS = 2.0
+
+
+def encode_state(seq, state):
+    captured = trace_captured(state.get(TRACE_KEY)) or 0.0
+    stats = state.get(SENSOR_STATS_KEY) or {}
+    return _RECORD.pack(seq, captured, time.time(),
+                        *(float(state[k]) for k in STATE_FIELDS),
+                        int(state.get('aqi', -1)),
+                        int(state.get('aqi_category_index', -1)),
+                        float(stats.get('read_ms', -1)),
+                        int(stats.get('pm_good', -1)),
+                        int(stats.get('pm_bad', -1)))
+
+
+def decode_state(data, sender_hop=None):
+    values = _RECORD.unpack(data)
+    state = dict(zip(STATE_FIELDS, values[3:9]))
+    state['seq'] = values[0]
+    state['sent_at'] = values[2]
+    if values[1]:
+        # rebuild the trace; the send time stands in for the sender's hop
+        state[TRACE_KEY] = new_trace(values[1])
+        if sender_hop:
+            state[TRACE_KEY]['hops'].append([sender_hop, values[2]])
+    if values[9] >= 0:
+        state['aqi'] = values[9]
+    if values[10] >= 0:
+        state['aqi_category_index'] = values[10]
+    if values[11] >= 0:
+        state[SENSOR_STATS_KEY] = {'read_ms': values[11],
+                                   'pm_good': values[12],
+                                   'pm_bad': values[13]}
+    return state
+
+
+def _channel_dir(channel):
+    return os.path.join(LOCAL_IPC_DIR, channel)
+
+
+class LocalPublisher:
+    def __init__(self, channel):
+        self._dir = _channel_dir(channel)
+        os.makedirs(self._dir, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._subscribers = []
+        self._last_scan = 0.0
+        self._seq = 0
+        self.dropped = 0
+
+    def _scan(self):
+        self._subscribers = [os.path.join(self._dir, name)
+                             for name in os.listdir(self._dir)
+                             if name.endswith('.sock')]
+        self._last_scan = time.monotonic()
+
+    def publish(self, state):
+        if time.monotonic() - self._last_scan > SUBSCRIBER_RESCAN_SECS:
+            self._scan()
+        self._seq += 1
+        record = encode_state(self._seq, state)
+        for path in self._subscribers:
+            try:
+                self._sock.sendto(record, path)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                    # subscriber went away; forget it until the next scan
+                    self._last_scan = 0.0
+                elif e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                    raise
+                self.dropped += 1
+
+    def close(self):
+        self._sock.close()
+
+
+class LocalSubscriber(threading.Thread):
+    """Receives records on its own thread and calls ``callback(state)``.
+
+    ``sender_hop`` names the publishing process in the rebuilt trace.
+    """
+
+    def __init__(self, channel, name, callback, sender_hop=None):
+        super().__init__(name="ipc-" + channel, daemon=True)
+        channel_dir = _channel_dir(channel)
+        os.makedirs(channel_dir, exist_ok=True)
+        self.path = os.path.join(channel_dir, name + '.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        # wake up periodically so close() can stop the thread
+        self._sock.settimeout(1.0)
+        self._callback = callback
+        self._sender_hop = sender_hop
+        self._stopped = False
+
+    def run(self):
+        while not self._stopped:
+            try:
+                data = self._sock.recv(_RECORD.size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) == _RECORD.size:
+                self._callback(decode_state(data, self._sender_hop))
+
+    def close(self):
+        self._stopped = True
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -1,79 +1,217 @@
 #!/usr/bin/env python3
-import time
+import argparse
+import threading
 import json
-import serial
-import board
-from adafruit_bme280 import basic as adafruit_bme280
 import paho.mqtt.client as mqtt
 
 from air_quality_common import (
     TOPIC_SET_SENSOR_DATA,
+    TOPIC_LAMPI_SAMPLE_RATE,
     MQTT_BROKER_HOST,
     MQTT_BROKER_PORT,
     MQTT_BROKER_KEEP_ALIVE_SECS,
-    MQTT_VERSION
+    MQTT_VERSION,
+    LOCAL_IPC_ENABLED,
+    TRACE_KEY,
+    SENSOR_STATS_KEY,
+    HOP_READ_SENSOR,
+    new_trace,
+    add_hop,
 )
+from sensor_acquisition import (
+    PMStreamReader,
+    EnvSampler,
+    FixedRateSchedule,
+    ReadingAverager,
+    DEFAULT_ENV_PERIOD_SECS,
+    DEFAULT_PUBLISH_PERIOD_SECS,
+)
+import sensor_backends
 
 MQTT_CLIENT_ID = "sensor_reader"
 
-class RealSensorReader:
-    def __init__(self,
-                 serial_port: str = '/dev/ttyUSB0',
-                 i2c_address: int = 0x76,
-                 sea_level_pressure: float = 1013.25):
-        # Serial port for PM sensor
-        self.ser = serial.Serial(serial_port, timeout=1)
-        # I²C BME280 for T/H/P/Altitude
-        i2c = board.I2C()  # uses board.SCL + board.SDA
-        self.bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c, address=i2c_address)
-        self.bme280.sea_level_pressure = sea_level_pressure
+class SensorReader:
+    def __init__(self, pm_backend, env_backend,
+                 env_period: float = DEFAULT_ENV_PERIOD_SECS,
+                 env_oversample: int = 1):
+        # background acquisition: the PM stream is parsed continuously and
+        # the environmental sensor is sampled on its own fixed-rate schedule,
+        # so read_all() never blocks on sensor I/O
+        self._backends = (pm_backend, env_backend)
+        self.pm_reader = PMStreamReader(pm_backend)
+        self.env_sampler = EnvSampler(env_backend, period=env_period,
+                                      oversample=env_oversample)
+        self._frames_reported = {"good_frames": 0, "bad_frames": 0}
+
+    def start(self):
+        self.pm_reader.start()
+        self.env_sampler.start()
+
+    def stop(self):
+        self.pm_reader.stop()
+        self.env_sampler.stop()
+
+    @property
+    def exhausted(self):
+        # only replay backends ever run out of data
+        return all(getattr(b, 'finished', False) for b in self._backends)
 
     def read_all(self) -> dict:
-        # Read the BME280
-        temperature = round(self.bme280.temperature, 2)
-        humidity    = round(self.bme280.relative_humidity, 2)
-        pressure    = round(self.bme280.pressure, 2)
-        altitude    = round(self.bme280.altitude, 2)
-
-        # Read 10 bytes from the PM sensor
-        buf = self.ser.read(10)
-        # bytes 2–3 little-endian → PM2.5, bytes 4–5 → PM10
-        pm25 = int.from_bytes(buf[2:4], byteorder='little') / 10
-        pm10 = int.from_bytes(buf[4:6], byteorder='little') / 10
+        """Return the latest good sample from each sensor, or None if either
+        sensor has not produced a sample yet."""
+        env = self.env_sampler.latest()
+        pm = self.pm_reader.latest()
+        if env is None or pm is None:
+            return None
+        values, env_time = env
+        pm25, pm10, pm_time = pm
 
         return {
-            "temperature": temperature,
-            "humidity":    humidity,
-            "pressure":    pressure,
-            "altitude":    altitude,
+            "temperature": round(values['temperature'], 2),
+            "humidity":    round(values['humidity'], 2),
+            "pressure":    round(values['pressure'], 2),
+            "altitude":    round(values['altitude'], 2),
             "pm25":        round(pm25, 2),
             "pm10":        round(pm10, 2),
-            "client":      MQTT_CLIENT_ID
+            "client":      MQTT_CLIENT_ID,
+            # the older of the two samples bounds the reading's age
+            TRACE_KEY:     new_trace(min(env_time, pm_time)),
         }
 
+    def take_stats(self) -> dict:
+        """Acquisition stats for the health record (SENSOR_STATS_KEY), with
+        PM frames counted since the previous call."""
+        frames = self.pm_reader.stats
+        good = frames["good_frames"] - self._frames_reported["good_frames"]
+        bad = frames["bad_frames"] - self._frames_reported["bad_frames"]
+        self._frames_reported = frames
+        return {
+            "read_ms": round(self.env_sampler.last_read_secs * 1000, 1),
+            "pm_good": good,
+            "pm_bad": bad,
+        }
+
+
+class RealSensorReader(SensorReader):
+    def __init__(self,
+                 serial_port: str = '/dev/ttyUSB0',
+                 i2c_address: int = 0x76,
+                 sea_level_pressure: float = 1013.25,
+                 **kwargs):
+        # Serial port for PM sensor, I²C BME280 for T/H/P/Altitude
+        super().__init__(
+            sensor_backends.SerialPMBackend(serial_port),
+            sensor_backends.BME280EnvBackend(i2c_address,
+                                             sea_level_pressure),
+            **kwargs)
+
 def on_connect(client, userdata, flags, rc):
     print("Connected to MQTT broker, result code =", rc)
+    # the backend switches us between a fast "watched" and a slow
+    # background publish period (retained, so we get it on every connect)
+    client.subscribe(TOPIC_LAMPI_SAMPLE_RATE, qos=1)
+
+def on_sample_rate(client, averager, message):
+    try:
+        period = float(json.loads(message.payload.decode('utf-8'))['period'])
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+        print("Invalid sample rate message:", e)
+        return
+    averager.set_period(period)
+    print("Publishing every {} readings".format(averager.ticks_per_publish))
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Read the air quality sensors and publish readings."
+    )
+    parser.add_argument('--publish-period', type=float,
+                        default=DEFAULT_PUBLISH_PERIOD_SECS,
+                        help='Seconds between readings; the backend may '
+                             'ask for a multiple of this (0 = unthrottled)')
+    parser.add_argument('--env-period', type=float,
+                        default=DEFAULT_ENV_PERIOD_SECS,
+                        help='Seconds between BME280 samples')
+    parser.add_argument('--env-oversample', type=int, default=1,
+                        help='BME280 reads averaged per sample')
+    parser.add_argument('--record', metavar='TRACE', default=None,
+                        help='Record the raw sensor session to TRACE')
+    parser.add_argument('--replay', metavar='TRACE', default=None,
+                        help='Replay a recorded trace instead of the sensors')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Replay speed multiplier (0 = as fast as '
+                             'possible)')
+    parser.add_argument('--no-loop', action='store_true',
+                        help='Stop replaying at the end of the trace')
+    return parser
+
+def build_sensor_reader(args):
+    kwargs = dict(env_period=args.env_period,
+                  env_oversample=args.env_oversample)
+    if args.replay:
+        pm, env = sensor_backends.open_replay(args.replay,
+                                              speed=args.replay_speed,
+                                              loop=not args.no_loop)
+        return SensorReader(pm, env, **kwargs), None
+    if args.record:
+        writer = sensor_backends.TraceWriter(args.record)
+        pm = sensor_backends.RecordingPMBackend(
+            sensor_backends.SerialPMBackend(), writer)
+        env = sensor_backends.RecordingEnvBackend(
+            sensor_backends.BME280EnvBackend(), writer)
+        return SensorReader(pm, env, **kwargs), writer
+    return RealSensorReader(**kwargs), None
 
 def main():
+    args = build_argument_parser().parse_args()
+
+    # readings are taken every publish period and averaged on-device when
+    # the backend asks for a slower rate
+    averager = ReadingAverager(args.publish_period)
+
     # MQTT setup
-    client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=MQTT_VERSION)
+    client = mqtt.Client(client_id=MQTT_CLIENT_ID, protocol=MQTT_VERSION,
+                         userdata=averager)
     client.on_connect = on_connect
+    client.message_callback_add(TOPIC_LAMPI_SAMPLE_RATE, on_sample_rate)
     client.enable_logger()
     client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_BROKER_KEEP_ALIVE_SECS)
     client.loop_start()
 
-    sensor = RealSensorReader()
+    sensor, trace_writer = build_sensor_reader(args)
+    sensor.start()
+
+    # with the local fast path the service gets readings without a broker
+    # hop; MQTT stays available for air_quality_cmd
+    local_publisher = None
+    if LOCAL_IPC_ENABLED:
+        import local_ipc
+        local_publisher = local_ipc.LocalPublisher(
+            local_ipc.CHANNEL_SENSOR_DATA)
 
+    stop_event = threading.Event()
+    schedule = FixedRateSchedule(args.publish_period)
     try:
-        while True:
+        while schedule.wait(stop_event) and not sensor.exhausted:
             data = sensor.read_all()
-            payload = json.dumps(data).encode('utf-8')
-            client.publish(TOPIC_SET_SENSOR_DATA, payload, qos=1)
+            if data is None:
+                continue
+            data = averager.add(data)
+            if data is None:
+                continue
+            data[SENSOR_STATS_KEY] = sensor.take_stats()
+            add_hop(data[TRACE_KEY], HOP_READ_SENSOR)
+            if local_publisher is not None:
+                local_publisher.publish(data)
+            else:
+                payload = json.dumps(data).encode('utf-8')
+                client.publish(TOPIC_SET_SENSOR_DATA, payload, qos=1)
             print("Published:", data)
-            time.sleep(1)
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
+        sensor.stop()
+        if trace_writer is not None:
+            trace_writer.close()
         client.loop_stop()
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+import threading
+import time
+
+# SDS011-style PM frame: AA C0 <pm25 lo> <pm25 hi> <pm10 lo> <pm10 hi>
+#                        <id lo> <id hi> <checksum> AB
+PM_FRAME_LEN = 10
+PM_FRAME_HEAD = 0xAA
+PM_FRAME_CMD = 0xC0
+PM_FRAME_TAIL = 0xAB
+
+DEFAULT_ENV_PERIOD_SECS = 1.0
+DEFAULT_PUBLISH_PERIOD_SECS = 1.0
+
+
+class PMFrameParser:
+    """Incremental parser for the PM sensor's serial stream.
+
+    Bytes can be fed in arbitrary chunks; the parser re-synchronises on the
+    frame header and only yields frames whose tail and checksum are valid.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.good_frames = 0
+        self.bad_frames = 0
+
+    def feed(self, data):
+        """Consume ``data`` and return a list of ``(pm25, pm10)`` tuples."""
+        self._buf.extend(data)
+        frames = []
+        buf = self._buf
+        while True:
+            start = buf.find(bytes((PM_FRAME_HEAD, PM_FRAME_CMD)))
+            if start < 0:
+                # keep a trailing header byte, it may be the start of a frame
+                keep = 1 if buf[-1:] == bytes((PM_FRAME_HEAD,)) else 0
+                del buf[:len(buf) - keep]
+                break
+            if start:
+                del buf[:start]
+            if len(buf) < PM_FRAME_LEN:
+                break
+            frame = buf[:PM_FRAME_LEN]
+            if (frame[9] == PM_FRAME_TAIL
+                    and sum(frame[2:8]) & 0xFF == frame[8]):
+                pm25 = int.from_bytes(frame[2:4], byteorder='little') / 10
+                pm10 = int.from_bytes(frame[4:6], byteorder='little') / 10
+                frames.append((pm25, pm10))
+                self.good_frames += 1
+                del buf[:PM_FRAME_LEN]
+            else:
+                # corrupt frame: drop the header and search for the next one
+                self.bad_frames += 1
+                del buf[:1]
+        return frames
+
+
+class FixedRateSchedule:
+    """Deadlines at a fixed period that do not accumulate drift.
+
+    Each deadline is computed from the start time rather than from when the
+    previous tick actually ran, so late wakeups do not push later ticks back.
+    If the caller falls more than a whole period behind, missed ticks are
+    skipped instead of firing in a burst.
+    """
+
+    def __init__(self, period, start=None):
+        self.period = period
+        self._next = (time.monotonic() if start is None else start) + period
+        self.missed = 0
+
+    def wait(self, stop_event):
+        """Sleep until the next deadline; return False if stopped."""
+        if self.period <= 0:
+            # unthrottled, e.g. when replaying a trace as fast as possible
+            return not stop_event.is_set()
+        now = time.monotonic()
+        if now > self._next + self.period:
+            skipped = int((now - self._next) // self.period)
+            self.missed += skipped
+            self._next += skipped * self.period
+        delay = self._next - now
+        self._next += self.period
+        if delay > 0:
+            return not stop_event.wait(delay)
+        return not stop_event.is_set()
+
+
+class PMStreamReader(threading.Thread):
+    """Continuously parses the PM serial stream and keeps the latest frame.
+
+    ``ser`` is a serial port or any PM backend from ``sensor_backends``.
+    """
+
+    def __init__(self, ser):
+        super().__init__(name="pm-stream", daemon=True)
+        self._ser = ser
+        self._parser = PMFrameParser()
+        self._lock = threading.Lock()
+        self._latest = None
+        self._stop_event = threading.Event()
+
+    @property
+    def stats(self):
+        return {"good_frames": self._parser.good_frames,
+                "bad_frames": self._parser.bad_frames}
+
+    def latest(self):
+        """Return ``(pm25, pm10, capture_time)`` or None."""
+        with self._lock:
+            return self._latest
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            # read whatever is buffered, or block (up to the port timeout)
+            # for at least one byte
+            data = self._ser.read(self._ser.in_waiting or 1)
+            if not data:
+                continue
+            frames = self._parser.feed(data)
+            if frames:
+                pm25, pm10 = frames[-1]
+                with self._lock:
+                    self._latest = (pm25, pm10, time.time())
+
+
+class EnvSampler(threading.Thread):
+    """Samples the BME280 on a fixed-rate schedule.
+
+    ``env_backend`` is any environmental backend from ``sensor_backends``.
+    With ``oversample`` > 1, each tick takes that many back-to-back readings
+    and stores their mean, which smooths out single-read noise.
+    """
+
+    FIELDS = ('temperature', 'humidity', 'pressure', 'altitude')
+
+    def __init__(self, env_backend, period=DEFAULT_ENV_PERIOD_SECS, oversample=1):
+        super().__init__(name="env-sampler", daemon=True)
+        self._env = env_backend
+        self._period = period
+        self._oversample = max(1, int(oversample))
+        self._lock = threading.Lock()
+        self._latest = None
+        self._stop_event = threading.Event()
+        self.schedule = None
+        self.last_read_secs = 0.0
+
+    def latest(self):
+        """Return ``(values_dict, capture_time)`` or None."""
+        with self._lock:
+            return self._latest
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _sample(self):
+        sums = [0.0] * len(self.FIELDS)
+        for _ in range(self._oversample):
+            for i, value in enumerate(self._env.read()):
+                sums[i] += value
+        return {field: total / self._oversample
+                for field, total in zip(self.FIELDS, sums)}
+
+    def run(self):
+        self.schedule = FixedRateSchedule(self._period,
+                                          start=time.monotonic()
+                                          - self._period)
+        while self.schedule.wait(self._stop_event):
+            started = time.monotonic()
+            try:
+                values = self._sample()
+            except OSError as e:
+                # transient I2C errors: keep the previous sample
+                print("BME280 read failed:", e)
+                continue
+            self.last_read_secs = time.monotonic() - started
+            with self._lock:
+                self._latest = (values, time.time())
+
+
+class ReadingAverager:
+    """Averages readings when publishing less often than sampling.
+
+    ``add()`` is called once per publish tick; it returns the mean of the
+    last ``ticks_per_publish`` readings once enough have been collected,
+    otherwise None.  The trace and other non-numeric fields come from the
+    newest reading.
+    """
+
+    FIELDS = ('temperature', 'humidity', 'pressure', 'altitude',
+              'pm25', 'pm10')
+
+    def __init__(self, base_period):
+        self.base_period = base_period
+        self.ticks_per_publish = 1
+        # set_period() runs on the MQTT client's thread, add() on the main
+        # loop's
+        self._lock = threading.Lock()
+        self._sums = dict.fromkeys(self.FIELDS, 0.0)
+        self._count = 0
+
+    def set_period(self, period):
+        """Publish every ``period`` seconds, in whole base periods.  A
+        partial average from the old period is dropped."""
+        if self.base_period <= 0:
+            return
+        ticks = max(1, round(period / self.base_period))
+        with self._lock:
+            if ticks != self.ticks_per_publish:
+                self.ticks_per_publish = ticks
+                self._reset()
+
+    def _reset(self):
+        self._sums = dict.fromkeys(self.FIELDS, 0.0)
+        self._count = 0
+
+    def add(self, reading):
+        with self._lock:
+            for field in self.FIELDS:
+                self._sums[field] += reading[field]
+            self._count += 1
+            if self._count < self.ticks_per_publish:
+                return None
+            averaged = dict(reading)
+            for field in self.FIELDS:
+                averaged[field] = round(self._sums[field] / self._count, 2)
+            self._reset()
+        return averaged
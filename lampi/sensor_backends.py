@@ -0,0 +1,308 @@
+"""Hardware backends for the PM sensor, environmental sensor and lamp PWM.
+
+The device code only talks to these small interfaces, so the same
+acquisition and lamp pipeline runs against real hardware on the Pi, against
+a recorded trace on any Linux box, or against a null lamp.
+
+PM backends look like a ``serial.Serial``: ``read(size)`` and
+``in_waiting``.  Environmental backends return
+``(temperature, humidity, pressure, altitude)`` from ``read()``.  PWM
+backends configure pins with ``setup()`` and drive them with
+``set_duty_cycle()``.
+
+Traces are a compact binary log: a magic header followed by records of
+``<kind:u8> <time:f64> <length:u16> <payload>``, where time is seconds since
+the start of the recording.
+"""
+import struct
+import threading
+import time
+
+TRACE_MAGIC = b'LAQTRACE1\n'
+_RECORD_HEADER = struct.Struct('<BdH')
+_ENV_PAYLOAD = struct.Struct('<4f')
+_PWM_PAYLOAD = struct.Struct('<HH')
+
+RECORD_PM = 1
+RECORD_ENV = 2
+RECORD_PWM = 3
+
+
+# -- real hardware ---------------------------------------------------------
+
+class SerialPMBackend:
+    def __init__(self, port='/dev/ttyUSB0', timeout=1):
+        import serial
+        self._ser = serial.Serial(port, timeout=timeout)
+
+    @property
+    def in_waiting(self):
+        return self._ser.in_waiting
+
+    def read(self, size=1):
+        return self._ser.read(size)
+
+
+class BME280EnvBackend:
+    def __init__(self, i2c_address=0x76, sea_level_pressure=1013.25):
+        import board
+        from adafruit_bme280 import basic as adafruit_bme280
+        i2c = board.I2C()  # uses board.SCL + board.SDA
+        self._bme280 = adafruit_bme280.Adafruit_BME280_I2C(
+            i2c, address=i2c_address)
+        self._bme280.sea_level_pressure = sea_level_pressure
+
+    def read(self):
+        return (self._bme280.temperature,
+                self._bme280.relative_humidity,
+                self._bme280.pressure,
+                self._bme280.altitude)
+
+
+class PigpioPWMBackend:
+    def __init__(self):
+        import pigpio
+        self._pigpio = pigpio
+        self._gpio = pigpio.pi()
+
+    def setup(self, pins, frequency, pwm_range):
+        for pin in pins:
+            self._gpio.set_mode(pin, self._pigpio.OUTPUT)
+            self._gpio.set_PWM_frequency(pin, frequency)
+            self._gpio.set_PWM_range(pin, pwm_range)
+            self._gpio.set_PWM_dutycycle(pin, 0)
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self._gpio.set_PWM_dutycycle(pin, duty_cycle)
+
+
+class NullPWMBackend:
+    """Keeps the duty cycles in memory; for running off the Pi."""
+
+    def __init__(self):
+        self.duty_cycles = {}
+        self.writes = 0
+
+    def setup(self, pins, frequency, pwm_range):
+        for pin in pins:
+            self.duty_cycles[pin] = 0
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self.duty_cycles[pin] = duty_cycle
+        self.writes += 1
+
+
+# -- recording -------------------------------------------------------------
+
+class TraceWriter:
+    def __init__(self, path):
+        self._f = open(path, 'wb')
+        self._f.write(TRACE_MAGIC)
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, kind, payload):
+        header = _RECORD_HEADER.pack(kind, time.monotonic() - self._start,
+                                     len(payload))
+        with self._lock:
+            self._f.write(header)
+            self._f.write(payload)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class RecordingPMBackend:
+    def __init__(self, backend, writer):
+        self._backend = backend
+        self._writer = writer
+
+    @property
+    def in_waiting(self):
+        return self._backend.in_waiting
+
+    def read(self, size=1):
+        data = self._backend.read(size)
+        if data:
+            self._writer.write(RECORD_PM, bytes(data))
+        return data
+
+
+class RecordingEnvBackend:
+    def __init__(self, backend, writer):
+        self._backend = backend
+        self._writer = writer
+
+    def read(self):
+        values = self._backend.read()
+        self._writer.write(RECORD_ENV, _ENV_PAYLOAD.pack(*values))
+        return values
+
+
+class RecordingPWMBackend:
+    def __init__(self, backend, writer):
+        self._backend = backend
+        self._writer = writer
+
+    def setup(self, pins, frequency, pwm_range):
+        self._backend.setup(pins, frequency, pwm_range)
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self._backend.set_duty_cycle(pin, duty_cycle)
+        self._writer.write(RECORD_PWM,
+                           _PWM_PAYLOAD.pack(pin, int(duty_cycle)))
+
+
+# -- replay ----------------------------------------------------------------
+
+def read_trace(path):
+    """Return the trace as a list of ``(kind, time, payload)`` records."""
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError("{} is not a sensor trace".format(path))
+    offset = len(TRACE_MAGIC)
+    while offset + _RECORD_HEADER.size <= len(data):
+        kind, t, length = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        records.append((kind, t, data[offset:offset + length]))
+        offset += length
+    return records
+
+
+class ReplayClock:
+    """Shared timeline for the replay backends.
+
+    ``speed`` scales trace time (1.0 plays back in real time); a speed of 0
+    plays back as fast as the consumers can read.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._start = time.monotonic()
+
+    def wait_until(self, trace_time):
+        if not self.speed:
+            return
+        delay = self._start + trace_time / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def elapsed(self):
+        if not self.speed:
+            return float('inf')
+        return (time.monotonic() - self._start) * self.speed
+
+
+class _ReplayStream:
+    def __init__(self, records, kind, loop):
+        self._records = [(t, payload) for k, t, payload in records
+                         if k == kind]
+        if not self._records:
+            raise ValueError("trace has no records of kind {}".format(kind))
+        # one average record interval past the last record, so a looped
+        # trace does not replay its last and first records simultaneously
+        first, last = self._records[0][0], self._records[-1][0]
+        interval = ((last - first) / (len(self._records) - 1)
+                    if len(self._records) > 1 else 0.0)
+        self._duration = last + (interval or 1.0)
+        self._loop = loop
+        self._index = 0
+        self._offset = 0.0
+        self.finished = False
+
+    def peek(self):
+        if self._index >= len(self._records):
+            if not self._loop:
+                self.finished = True
+                return None
+            self._index = 0
+            self._offset += self._duration
+        t, payload = self._records[self._index]
+        return t + self._offset, payload
+
+    def advance(self):
+        self._index += 1
+
+
+class ReplayPMBackend:
+    def __init__(self, records, clock, loop=True, timeout=1):
+        self._stream = _ReplayStream(records, RECORD_PM, loop)
+        self._clock = clock
+        self._timeout = timeout
+        self._pending = bytearray()
+
+    @property
+    def finished(self):
+        return self._stream.finished and not self._pending
+
+    @property
+    def in_waiting(self):
+        self._collect_due()
+        return len(self._pending)
+
+    def _collect_due(self):
+        if not self._clock.speed:
+            # as-fast-as-possible playback hands out one record per read()
+            return
+        now = self._clock.elapsed()
+        while True:
+            record = self._stream.peek()
+            if record is None or record[0] > now:
+                return
+            self._pending.extend(record[1])
+            self._stream.advance()
+
+    def read(self, size=1):
+        if not self._pending:
+            record = self._stream.peek()
+            if record is None:
+                time.sleep(self._timeout)
+                return b''
+            self._clock.wait_until(record[0])
+            self._collect_due()
+            if not self._pending:
+                # a clock running behind the next record: take it anyway
+                self._pending.extend(record[1])
+                self._stream.advance()
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+
+class ReplayEnvBackend:
+    def __init__(self, records, clock, loop=True):
+        self._stream = _ReplayStream(records, RECORD_ENV, loop)
+        self._clock = clock
+        self._last = None
+
+    @property
+    def finished(self):
+        return self._stream.finished
+
+    def read(self):
+        if self._clock.speed:
+            # real-time playback: return the latest sample as of now
+            now = self._clock.elapsed()
+            while True:
+                record = self._stream.peek()
+                if record is None or (record[0] > now and self._last):
+                    break
+                self._last = _ENV_PAYLOAD.unpack(record[1])
+                self._stream.advance()
+        else:
+            record = self._stream.peek()
+            if record is not None:
+                self._last = _ENV_PAYLOAD.unpack(record[1])
+                self._stream.advance()
+        return self._last
+
+
+def open_replay(path, speed=1.0, loop=True):
+    """Return ``(pm_backend, env_backend)`` replaying the trace at ``path``."""
+    records = read_trace(path)
+    clock = ReplayClock(speed)
+    return (ReplayPMBackend(records, clock, loop=loop),
+            ReplayEnvBackend(records, clock, loop=loop))
@@ -0,0 +1,142 @@
+"""Small crash-tolerant key/value state store for the device services.
+
+The current state lives in memory.  Updates are coalesced and appended to a
+journal at most once every ``max_staleness`` seconds, and the journal is
+folded into an atomically replaced snapshot every ``snapshot_interval``
+seconds.  After a power loss the recovered state is therefore at most
+``max_staleness`` seconds stale, while the SD card sees one small append
+per flush interval instead of a dbm rewrite per reading.
+
+Files: ``<path>.snapshot`` holds a JSON object of the whole state;
+``<path>.journal`` holds one JSON object of changed keys per line.
+Recovery loads the snapshot and replays the journal, dropping a torn last
+line.
+"""
+import json
+import os
+import threading
+import time
+
+DEFAULT_MAX_STALENESS_SECS = 5.0
+DEFAULT_SNAPSHOT_INTERVAL_SECS = 300.0
+
+
+class StateJournal:
+    def __init__(self, path, defaults,
+                 max_staleness=DEFAULT_MAX_STALENESS_SECS,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL_SECS):
+        self.max_staleness = max_staleness
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_path = path + '.snapshot'
+        self._journal_path = path + '.journal'
+        self._lock = threading.Lock()
+        # serialises journal and snapshot writes, never held by update()
+        self._io_lock = threading.Lock()
+        self._dirty = {}
+        self._state = dict(defaults)
+        self._state.update(self._recover())
+        self._journal = open(self._journal_path, 'a')
+        self._last_snapshot = time.monotonic()
+        # statistics for telemetry
+        self.last_flush_secs = 0.0
+        self.flushes = 0
+
+        self._stop_event = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         name="state-journal", daemon=True)
+        self._flusher.start()
+
+    def _recover(self):
+        state = {}
+        try:
+            with open(self._snapshot_path) as f:
+                state.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(self._journal_path, 'rb+') as f:
+                valid = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("incomplete line")
+                        state.update(json.loads(line))
+                    except ValueError:
+                        # torn write from a power loss; nothing after it.
+                        # Cut it off, or the next append would extend it
+                        # and be lost with it
+                        f.truncate(valid)
+                        break
+                    valid += len(line)
+        except OSError:
+            pass
+        return state
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._state[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._state
+
+    def snapshot(self):
+        """Return a copy of the current in-memory state."""
+        with self._lock:
+            return dict(self._state)
+
+    def update(self, changes):
+        with self._lock:
+            for key, value in changes.items():
+                if self._state.get(key) != value:
+                    self._state[key] = value
+                    self._dirty[key] = value
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.max_staleness):
+            self.flush()
+            if (time.monotonic() - self._last_snapshot
+                    >= self.snapshot_interval):
+                self.write_snapshot()
+
+    def _append(self, changes):
+        started = time.monotonic()
+        self._journal.write(json.dumps(changes) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.last_flush_secs = time.monotonic() - started
+        self.flushes += 1
+
+    def flush(self):
+        """Append the coalesced changes since the last flush and fsync."""
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                changes, self._dirty = self._dirty, {}
+            self._append(changes)
+
+    def write_snapshot(self):
+        """Atomically replace the snapshot and truncate the journal."""
+        # take the state and the pending changes together, so the journal
+        # and the snapshot agree exactly if we crash before truncating
+        with self._io_lock:
+            with self._lock:
+                changes, self._dirty = self._dirty, {}
+                state = dict(self._state)
+            if changes:
+                self._append(changes)
+            tmp_path = self._snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._snapshot_path)
+            self._journal.truncate(0)
+            self._last_snapshot = time.monotonic()
+
+    def close(self):
+        self._stop_event.set()
+        self._flusher.join()
+        self.write_snapshot()
+        self._journal.close()
@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from air_quality_common import (TRACE_KEY, HOP_SERVICE_RECV, HOP_SERVICE_PUB,
+                                TOPIC_LAMPI_CHANGE_NOTIFICATION, add_hop,
+                                new_trace, trace_captured)
+from air_quality_service import AirQualityService
+import sensor_backends
+
+READING = {"pm25": 12.0, "pm10": 20.0, "temperature": 21.5,
+           "humidity": 45.0, "pressure": 1013.2, "altitude": 120.0}
+
+
+class TraceTest(unittest.TestCase):
+    def test_add_hop(self):
+        trace = add_hop(new_trace(100.0), HOP_SERVICE_RECV)
+        self.assertEqual([hop for hop, _ in trace['hops']],
+                         [HOP_SERVICE_RECV])
+
+    def test_add_hop_to_trace_without_hops(self):
+        trace = add_hop({'captured': 100.0}, HOP_SERVICE_RECV)
+        self.assertEqual(len(trace['hops']), 1)
+
+    def test_add_hop_ignores_other_values(self):
+        self.assertEqual(add_hop('abc', HOP_SERVICE_RECV), 'abc')
+        self.assertIsNone(add_hop(None, HOP_SERVICE_RECV))
+
+    def test_trace_captured(self):
+        self.assertEqual(trace_captured({'captured': 100.5}), 100.5)
+        self.assertIsNone(trace_captured({'captured': 'x'}))
+        self.assertIsNone(trace_captured({'captured': True}))
+        self.assertIsNone(trace_captured({'hops': []}))
+        self.assertIsNone(trace_captured([100.0]))
+
+
+class SensorDataTest(unittest.TestCase):
+    def setUp(self):
+        # the service keeps its state journal in the working directory
+        cwd = os.getcwd()
+        directory = tempfile.TemporaryDirectory()
+        os.chdir(directory.name)
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        self.service = AirQualityService(sensor_backends.NullPWMBackend())
+        self.addCleanup(self.service.db.close)
+        self.service._client = mock.Mock()
+
+    def send(self, **extra):
+        msg = types.SimpleNamespace(
+            topic='lamp/set_sensor_data',
+            payload=json.dumps(dict(READING, **extra)).encode('utf-8'))
+        self.service.on_message_sensor_data(None, None, msg)
+
+    def published_state(self):
+        topic, payload = self.service._client.publish.call_args.args
+        self.assertEqual(topic, TOPIC_LAMPI_CHANGE_NOTIFICATION)
+        return json.loads(payload)
+
+    def test_trace_gets_service_hops(self):
+        self.send(trace=new_trace(100.0))
+        trace = self.published_state()[TRACE_KEY]
+        self.assertEqual(trace['captured'], 100.0)
+        self.assertEqual([hop for hop, _ in trace['hops']],
+                         [HOP_SERVICE_RECV, HOP_SERVICE_PUB])
+
+    def test_trace_without_hops(self):
+        self.send(trace={'captured': 100.0}, pm25=30.0)
+        self.assertEqual(self.service.db['pm25'], 30.0)
+        trace = self.published_state()[TRACE_KEY]
+        self.assertEqual(trace['captured'], 100.0)
+        self.assertEqual(len(trace['hops']), 2)
+
+    def test_malformed_traces_are_replaced(self):
+        for trace in ('abc', [1, 2], {}, None):
+            self.send(trace=trace, pm25=40.0)
+            self.assertEqual(self.service.db['pm25'], 40.0)
+            published = self.published_state()[TRACE_KEY]
+            self.assertEqual(len(published['hops']), 2)
+
+    def test_reading_without_trace(self):
+        self.send(pm25=50.0)
+        self.assertEqual(self.service.db['pm25'], 50.0)
+        self.assertIn(TRACE_KEY, self.published_state())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+from aqi_engine import (AirQualityEngine, NowCast, RollingMean,
+                        PM10_BREAKPOINTS, PM25_BREAKPOINTS, SECS_PER_HOUR,
+                        aqi_category, aqi_from_concentration, load_config)
+
+# an hour boundary, so tests can place readings in whole hours
+T0 = 1_700_000_000 // SECS_PER_HOUR * SECS_PER_HOUR
+
+
+class AqiTest(unittest.TestCase):
+    def test_breakpoints(self):
+        self.assertEqual(aqi_from_concentration(0.0, PM25_BREAKPOINTS), 0)
+        self.assertEqual(aqi_from_concentration(9.0, PM25_BREAKPOINTS), 50)
+        self.assertEqual(aqi_from_concentration(12.0, PM25_BREAKPOINTS), 56)
+        self.assertEqual(aqi_from_concentration(35.4, PM25_BREAKPOINTS), 100)
+        self.assertEqual(aqi_from_concentration(154, PM10_BREAKPOINTS), 100)
+
+    def test_between_rows_rounds_up_to_the_next(self):
+        # 9.05 falls between the 9.0 and 9.1 rows
+        self.assertEqual(aqi_from_concentration(9.05, PM25_BREAKPOINTS), 51)
+
+    def test_capped_above_table(self):
+        self.assertEqual(aqi_from_concentration(1000, PM25_BREAKPOINTS), 500)
+
+    def test_categories(self):
+        self.assertEqual([aqi_category(a) for a in (0, 50, 51, 101, 301)],
+                         [0, 0, 1, 2, 5])
+        self.assertEqual(aqi_category(900), 5)
+
+
+class NowCastTest(unittest.TestCase):
+    def test_steady_concentration(self):
+        nowcast = NowCast()
+        for t in range(T0, T0 + 3 * SECS_PER_HOUR, 60):
+            nowcast.add(20.0, t)
+        self.assertAlmostEqual(nowcast.value(), 20.0)
+
+    def test_weighting(self):
+        nowcast = NowCast()
+        nowcast.add(40.0, T0)
+        nowcast.add(40.0, T0 + SECS_PER_HOUR)
+        nowcast.add(10.0, T0 + 2 * SECS_PER_HOUR)
+        # weight max(10 / 40, 0.5) = 0.5, newest hour first
+        self.assertAlmostEqual(nowcast.value(),
+                               (10 + 0.5 * 40 + 0.25 * 40) / 1.75)
+
+    def test_missing_hours(self):
+        nowcast = NowCast()
+        nowcast.add(40.0, T0)
+        nowcast.add(10.0, T0 + 2 * SECS_PER_HOUR)
+        # two of the last three hours have data; the gap keeps its weight
+        self.assertAlmostEqual(nowcast.value(),
+                               (10 + 0.25 * 40) / (1 + 0.25))
+        nowcast.add(12.0, T0 + 5 * SECS_PER_HOUR)
+        # fewer than two of three: just the current hour
+        self.assertEqual(nowcast.value(), 12.0)
+
+    def test_empty(self):
+        self.assertIsNone(NowCast().value())
+
+
+class RollingMeanTest(unittest.TestCase):
+    def test_window_is_in_seconds(self):
+        mean = RollingMean(300)
+        for t in range(0, 3600, 60):
+            mean.add(float(t), t)
+        # only the last five minutes' samples, whatever the sample period
+        self.assertEqual(mean.mean, sum(range(3300, 3600, 60)) / 5)
+
+    def test_keeps_newest_sample(self):
+        mean = RollingMean(10)
+        mean.add(1.0, 0)
+        mean.add(3.0, 1000)
+        self.assertEqual(mean.mean, 3.0)
+
+
+class HysteresisTest(unittest.TestCase):
+    def engine(self):
+        config = load_config()
+        config["humidity_window_secs"] = 1
+        return AirQualityEngine(config)
+
+    def test_category_changes_once_sustained(self):
+        engine = self.engine()
+        engine.update(5.0, 5.0, 40.0, now=T0)
+        self.assertEqual(engine.category, 0)
+        for t in range(1, 121):
+            engine.update(300.0, 5.0, 40.0, now=T0 + t)
+            if t < 60:
+                self.assertEqual(engine.category, 0)
+        self.assertGreater(engine.category, 0)
+
+    def test_brief_change_is_ignored(self):
+        engine = self.engine()
+        engine.update(5.0, 5.0, 40.0, now=T0)
+        for t in range(1, 31):
+            engine.update(5.0, 5.0, 95.0, now=T0 + t)
+        for t in range(31, 200):
+            engine.update(5.0, 5.0, 40.0, now=T0 + t)
+            self.assertFalse(engine.humidity_warning)
+
+    def test_humidity_warning_once_sustained(self):
+        engine = self.engine()
+        engine.update(5.0, 5.0, 40.0, now=T0)
+        for t in range(1, 62):
+            engine.update(5.0, 5.0, 95.0, now=T0 + t)
+        self.assertTrue(engine.humidity_warning)
+        self.assertEqual(engine.colour,
+                         tuple(engine.config["humidity_colour"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
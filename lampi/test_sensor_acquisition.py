@@ -0,0 +1,120 @@
+import queue
+import time
+import unittest
+
+from read_sensor import SensorReader
+from sensor_acquisition import (PMFrameParser, ReadingAverager,
+                                PM_FRAME_HEAD, PM_FRAME_CMD, PM_FRAME_TAIL)
+
+
+def pm_frame(pm25, pm10, checksum=None):
+    body = (int(pm25 * 10).to_bytes(2, 'little')
+            + int(pm10 * 10).to_bytes(2, 'little') + b'\x01\x02')
+    if checksum is None:
+        checksum = sum(body) & 0xFF
+    return bytes((PM_FRAME_HEAD, PM_FRAME_CMD)) + body + \
+        bytes((checksum, PM_FRAME_TAIL))
+
+
+class PMFrameParserTest(unittest.TestCase):
+    def test_frames_split_across_reads(self):
+        parser = PMFrameParser()
+        data = pm_frame(12.3, 45.6) + pm_frame(7.0, 8.0)
+        frames = []
+        for i in range(0, len(data), 3):
+            frames += parser.feed(data[i:i + 3])
+        self.assertEqual(frames, [(12.3, 45.6), (7.0, 8.0)])
+        self.assertEqual((parser.good_frames, parser.bad_frames), (2, 0))
+
+    def test_resyncs_after_bad_checksum(self):
+        parser = PMFrameParser()
+        bad = pm_frame(99.9, 99.9, checksum=0)
+        self.assertEqual(parser.feed(bad + pm_frame(1.5, 2.5)),
+                         [(1.5, 2.5)])
+        self.assertEqual((parser.good_frames, parser.bad_frames), (1, 1))
+
+    def test_resyncs_on_header_inside_corrupt_frame(self):
+        # a frame cut short by a dropped byte, with the next frame's header
+        # where the old one's checksum should be
+        parser = PMFrameParser()
+        truncated = pm_frame(3.0, 4.0)[:7]
+        data = b'\x00\xff' + truncated + pm_frame(5.0, 6.0) + \
+            pm_frame(7.0, 8.0)
+        self.assertEqual(parser.feed(data), [(5.0, 6.0), (7.0, 8.0)])
+        self.assertEqual(parser.good_frames, 2)
+        self.assertGreaterEqual(parser.bad_frames, 1)
+
+    def test_keeps_partial_header(self):
+        parser = PMFrameParser()
+        frame = pm_frame(1.0, 2.0)
+        self.assertEqual(parser.feed(b'\x13\x37' + frame[:1]), [])
+        self.assertEqual(parser.feed(frame[1:]), [(1.0, 2.0)])
+
+
+class ReadingAveragerTest(unittest.TestCase):
+    def reading(self, value):
+        return dict(dict.fromkeys(ReadingAverager.FIELDS, value), id=value)
+
+    def test_averages_over_the_period(self):
+        averager = ReadingAverager(1.0)
+        averager.set_period(3)
+        self.assertIsNone(averager.add(self.reading(1.0)))
+        self.assertIsNone(averager.add(self.reading(2.0)))
+        averaged = averager.add(self.reading(6.0))
+        self.assertEqual(averaged['pm25'], 3.0)
+        # other fields come from the newest reading
+        self.assertEqual(averaged['id'], 6.0)
+
+    def test_period_change_restarts_the_average(self):
+        averager = ReadingAverager(1.0)
+        averager.set_period(3)
+        averager.add(self.reading(100.0))
+        averager.set_period(2)
+        self.assertIsNone(averager.add(self.reading(1.0)))
+        self.assertEqual(averager.add(self.reading(3.0))['pm25'], 2.0)
+
+
+class FakePMBackend:
+    """Serves the bytes put on ``data``, a read at a time."""
+
+    in_waiting = 0
+
+    def __init__(self):
+        self.data = queue.Queue()
+
+    def read(self, size=1):
+        try:
+            return self.data.get(timeout=0.01)
+        except queue.Empty:
+            return b''
+
+
+class TakeStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.pm = FakePMBackend()
+        self.sensor = SensorReader(self.pm, env_backend=None)
+        self.sensor.pm_reader.start()
+        self.addCleanup(self.sensor.pm_reader.stop)
+
+    def feed(self, data, good, bad):
+        self.pm.data.put(data)
+        deadline = time.monotonic() + 2
+        while self.sensor.pm_reader.stats != \
+                {"good_frames": good, "bad_frames": bad}:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_frame_counts_are_per_call(self):
+        self.feed(pm_frame(1.0, 2.0) * 3 + pm_frame(1.0, 2.0, checksum=0),
+                  good=3, bad=1)
+        self.sensor.env_sampler.last_read_secs = 0.01234
+        self.assertEqual(self.sensor.take_stats(),
+                         {"read_ms": 12.3, "pm_good": 3, "pm_bad": 1})
+        self.feed(pm_frame(3.0, 4.0) * 2, good=5, bad=1)
+        self.sensor.env_sampler.last_read_secs = 0.002
+        self.assertEqual(self.sensor.take_stats(),
+                         {"read_ms": 2.0, "pm_good": 2, "pm_bad": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
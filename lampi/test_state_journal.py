@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from state_journal import StateJournal
+
+DEFAULTS = {'pm25': 0.0, 'pm10': 0.0}
+
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'state')
+
+    def open(self):
+        # flushed by hand; the background flusher never gets to run
+        journal = StateJournal(self.path, DEFAULTS, max_staleness=3600)
+        self.addCleanup(journal._stop_event.set)
+        return journal
+
+    def crash(self, journal):
+        # stop without the final snapshot close() would write
+        journal._stop_event.set()
+        journal._flusher.join()
+        journal._journal.close()
+
+    def write_journal(self, text):
+        with open(self.path + '.journal', 'w') as f:
+            f.write(text)
+
+    def test_recovers_flushed_changes(self):
+        journal = self.open()
+        journal.update({'pm25': 1.5})
+        journal.flush()
+        journal.update({'pm10': 2.5})
+        journal.flush()
+        self.crash(journal)
+        self.assertEqual(self.open().snapshot(), {'pm25': 1.5, 'pm10': 2.5})
+
+    def test_unflushed_changes_are_lost(self):
+        journal = self.open()
+        journal.update({'pm25': 1.5})
+        self.crash(journal)
+        self.assertEqual(self.open().snapshot(), DEFAULTS)
+
+    def test_snapshot_and_journal(self):
+        journal = self.open()
+        journal.update({'pm25': 1.5})
+        journal.write_snapshot()
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+        journal.update({'pm10': 2.5})
+        journal.flush()
+        self.crash(journal)
+        self.assertEqual(self.open().snapshot(), {'pm25': 1.5, 'pm10': 2.5})
+
+    def test_ignores_torn_last_line(self):
+        self.write_journal('{"pm25": 1.5}\n{"pm25": 9, "pm1')
+        self.assertEqual(self.open().snapshot(),
+                         {'pm25': 1.5, 'pm10': 0.0})
+
+    def test_line_without_newline_is_torn(self):
+        self.write_journal('{"pm25": 1.5}\n{"pm25": 9}')
+        self.assertEqual(self.open()['pm25'], 1.5)
+
+    def test_appends_after_a_torn_line_survive(self):
+        self.write_journal('{"pm25": 1.5}\n{"pm25": 9, "pm1')
+        journal = self.open()
+        journal.update({'pm10': 2.5})
+        journal.flush()
+        self.crash(journal)
+        with open(self.path + '.journal') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines, [{'pm25': 1.5}, {'pm10': 2.5}])
+        self.assertEqual(self.open().snapshot(), {'pm25': 1.5, 'pm10': 2.5})
+
+    def test_corrupt_snapshot_falls_back_to_defaults(self):
+        with open(self.path + '.snapshot', 'w') as f:
+            f.write('{"pm25": ')
+        self.write_journal('{"pm10": 2.5}\n')
+        self.assertEqual(self.open().snapshot(), {'pm25': 0.0, 'pm10': 2.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
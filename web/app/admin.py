@@ -1,5 +1,45 @@
 from django.contrib import admin
-from app.models import SensorReading, Lampi
+from django.utils.html import format_html, format_html_join
+from app.models import SensorReading, Lampi, AlertRule, AlertFiring, \
+    SlowRequest
+from app.profiling import hottest_functions
 
 admin.site.register(SensorReading)
-admin.site.register(Lampi)
\ No newline at end of file
+admin.site.register(Lampi)
+admin.site.register(AlertRule)
+admin.site.register(AlertFiring)
+
+
+@admin.register(SlowRequest)
+class SlowRequestAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'view_name', 'path',
+                    'status_code', 'duration_ms', 'sql_count', 'sql_ms',
+                    'duplicate_queries', 'samples')
+    list_filter = ('view_name', 'status_code')
+    search_fields = ('path',)
+    ordering = ('-created_at',)
+    readonly_fields = ('created_at', 'method', 'path', 'view_name', 'params',
+                       'status_code', 'duration_ms', 'sql_count', 'sql_ms',
+                       'duplicate_queries', 'repeated_queries',
+                       'profile_path', 'samples', 'hottest')
+    exclude = ('duplicates',)
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Most repeated queries')
+    def repeated_queries(self, obj):
+        return format_html_join('', '<pre>{} x {}</pre>',
+                                ((count, sql)
+                                 for count, sql in obj.duplicates))
+
+    @admin.display(description='Hottest functions (samples on top)')
+    def hottest(self, obj):
+        if not obj.profile_path:
+            return '-'
+        try:
+            rows = hottest_functions(obj.profile_path)
+        except OSError as e:
+            return "Profile unreadable: {}".format(e)
+        return format_html('<pre>{}</pre>', "\n".join(
+            "{:6d}  {}".format(count, frame) for count, frame in rows))
@@ -0,0 +1,192 @@
+"""Alert rules, evaluated by the mqtt-daemon as readings arrive.
+
+Rules are indexed by device and metric, so a reading only touches the rules
+that watch it, and each (rule, device) pair keeps a handful of numbers:
+when the condition started holding, whether and when it last fired, the
+previous sample and for rate rules a smoothed rate.  A reading no newer
+than the previous sample, such as one the broker redelivers, is ignored.
+A rule fires once
+when its condition has held for ``duration_secs`` and re-arms when it stops
+holding, but fires again no sooner than ``cooldown_secs`` after the last
+time.
+
+Firings are queued on the ingest path; ``flush`` writes them from the
+daemon's main loop, and sinks send them from a worker thread, so neither
+the database nor a slow mail server holds up ingest.
+"""
+import json
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
+
+from app.models import AlertFiring, AlertRule, Lampi
+from app.mqtt_publisher import get_publisher, log_delivery
+
+ALERT_TOPIC = 'devices/{}/alerts'
+
+
+class RuleState:
+    __slots__ = ('since', 'fired', 'fired_t', 'last_t', 'last_v', 'rate')
+
+    def __init__(self):
+        self.since = None
+        self.fired = False
+        self.fired_t = None
+        self.last_t = None
+        self.last_v = None
+        # starts at zero so a rule cannot fire on the first few samples
+        self.rate = 0.0
+
+
+def _observed(rule, state, t, v):
+    """The value ``rule`` compares with its threshold."""
+    if rule.condition in (AlertRule.ABOVE, AlertRule.BELOW):
+        value = v
+    else:
+        # rising/falling: slope per hour, smoothed with a time-weighted
+        # exponential average so sensor noise between samples cancels out
+        if state.last_t is not None:
+            dt = t - state.last_t
+            slope = (v - state.last_v) / dt * 3600
+            alpha = 1 - math.exp(-dt / max(rule.rate_window_secs, 1))
+            state.rate += alpha * (slope - state.rate)
+        value = state.rate
+    state.last_t, state.last_v = t, v
+    return value
+
+
+def _holds(rule, value):
+    if rule.condition in (AlertRule.ABOVE, AlertRule.RISING):
+        return value > rule.threshold
+    if rule.condition == AlertRule.BELOW:
+        return value < rule.threshold
+    return value < -rule.threshold
+
+
+class AlertEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {device_id: {metric: [rule, ...]}}
+        self._index = {}
+        # {(rule id, device_id): RuleState}
+        self._states = {}
+        self._fired = []
+        self._sinks = {name: import_string(path)()
+                       for name, path in settings.ALERT_SINKS.items()}
+        self._notifier = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='alerts')
+        self.reload()
+
+    def reload(self):
+        """Re-read the enabled rules; state carries over for rules and
+        devices that are still watched."""
+        rules = list(AlertRule.objects.filter(enabled=True).filter(
+            Q(lampi__isnull=True) | Q(lampi__user=F('user'))))
+        user_ids = {rule.user_id for rule in rules if rule.lampi_id is None}
+        devices_by_user = {}
+        for device_id, user_id in Lampi.objects.filter(
+                user_id__in=user_ids).values_list('device_id', 'user_id'):
+            devices_by_user.setdefault(user_id, []).append(device_id)
+
+        index = {}
+        for rule in rules:
+            device_ids = [rule.lampi_id] if rule.lampi_id else \
+                devices_by_user.get(rule.user_id, [])
+            for device_id in device_ids:
+                index.setdefault(device_id, {}) \
+                    .setdefault(rule.metric, []).append(rule)
+        watched = {(rule.pk, device_id)
+                   for device_id, metrics in index.items()
+                   for metric_rules in metrics.values()
+                   for rule in metric_rules}
+        with self._lock:
+            self._index = index
+            self._states = {key: state for key, state in self._states.items()
+                            if key in watched}
+
+    def evaluate(self, reading):
+        """Feed one stored SensorReading to the rules watching its
+        device."""
+        metrics = self._index.get(reading.lampi_id)
+        if not metrics:
+            return
+        t = reading.timestamp.timestamp()
+        with self._lock:
+            for metric, rules in metrics.items():
+                v = getattr(reading, metric)
+                if v is None:
+                    continue
+                for rule in rules:
+                    key = (rule.pk, reading.lampi_id)
+                    state = self._states.get(key)
+                    if state is None:
+                        state = self._states[key] = RuleState()
+                    elif t <= state.last_t:
+                        # redelivered, or older than what the rule has seen
+                        continue
+                    value = _observed(rule, state, t, v)
+                    if not _holds(rule, value):
+                        state.since = None
+                        state.fired = False
+                        continue
+                    if state.since is None:
+                        state.since = t
+                    if not state.fired and \
+                            t - state.since >= rule.duration_secs and \
+                            (state.fired_t is None or
+                             t - state.fired_t >= rule.cooldown_secs):
+                        state.fired = True
+                        state.fired_t = t
+                        self._fired.append(AlertFiring(
+                            rule=rule, lampi_id=reading.lampi_id,
+                            fired_at=reading.timestamp, value=value))
+
+    def flush(self):
+        """Record queued firings and hand them to their sinks."""
+        with self._lock:
+            fired, self._fired = self._fired, []
+        if not fired:
+            return
+        AlertFiring.objects.bulk_create(fired)
+        for firing in fired:
+            print("Alert: {}".format(firing))
+            self._notifier.submit(self._notify, firing)
+
+    def _notify(self, firing):
+        sink = self._sinks.get(firing.rule.sink)
+        if sink is None:
+            print("No alert sink named {!r}".format(firing.rule.sink))
+            return
+        try:
+            sink.send(firing)
+        except Exception as e:
+            print("Alert notification failed: {}".format(e))
+            return
+        AlertFiring.objects.filter(pk=firing.pk).update(notified=True)
+
+
+class MQTTSink:
+    """Publishes each firing as JSON to ALERT_TOPIC on the broker."""
+
+    def send(self, firing):
+        delivery = get_publisher().publish(
+            ALERT_TOPIC.format(firing.lampi_id),
+            json.dumps(firing.as_dict()), qos=1)
+        delivery.add_done_callback(log_delivery(
+            "alert for {}".format(firing.lampi_id)))
+
+
+class EmailSink:
+    """Mails each firing to the rule's owner, if they have an address."""
+
+    def send(self, firing):
+        email = firing.rule.user.email
+        if not email:
+            return
+        send_mail("LAMPI alert: {}".format(firing.lampi_id), str(firing),
+                  None, [email])
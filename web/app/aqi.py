@@ -0,0 +1,59 @@
+"""EPA AQI for a single reading, for showing next to the latest values.
+
+The tables mirror lampi/aqi_engine.py.  The lamp shows a NowCast AQI over
+the last 12 hours; here it comes from one reading, which is close enough to
+label a device's current air but can jump with a single noisy sample.
+"""
+
+# (concentration low, concentration high, AQI low, AQI high), EPA 2024
+PM25_BREAKPOINTS = (
+    (0.0, 9.0, 0, 50),
+    (9.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 125.4, 151, 200),
+    (125.5, 225.4, 201, 300),
+    (225.5, 325.4, 301, 500),
+)
+PM10_BREAKPOINTS = (
+    (0, 54, 0, 50),
+    (55, 154, 51, 100),
+    (155, 254, 101, 150),
+    (255, 354, 151, 200),
+    (355, 424, 201, 300),
+    (425, 604, 301, 500),
+)
+
+AQI_CATEGORIES = (
+    # (upper AQI bound, name, badge class)
+    (50, "Good", "badge-success"),
+    (100, "Moderate", "badge-warning"),
+    (150, "Unhealthy for Sensitive Groups", "badge-warning"),
+    (200, "Unhealthy", "badge-error"),
+    (300, "Very Unhealthy", "badge-error"),
+    (500, "Hazardous", "badge-error"),
+)
+
+
+def aqi_from_concentration(concentration, breakpoints):
+    """Piecewise-linear EPA AQI; values above the table are capped."""
+    for c_lo, c_hi, i_lo, i_hi in breakpoints:
+        if concentration <= c_hi:
+            concentration = max(concentration, c_lo)
+            return round((i_hi - i_lo) / (c_hi - c_lo)
+                         * (concentration - c_lo) + i_lo)
+    return breakpoints[-1][3]
+
+
+def aqi_category(aqi):
+    for index, (upper, _, _) in enumerate(AQI_CATEGORIES):
+        if aqi <= upper:
+            return index
+    return len(AQI_CATEGORIES) - 1
+
+
+def reading_aqi(reading):
+    """``(aqi, category name, badge class)`` for a SensorReading."""
+    aqi = max(aqi_from_concentration(reading.pm25, PM25_BREAKPOINTS),
+              aqi_from_concentration(reading.pm10, PM10_BREAKPOINTS))
+    _, name, badge = AQI_CATEGORIES[aqi_category(aqi)]
+    return aqi, name, badge
@@ -0,0 +1,51 @@
+import hashlib
+
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
+
+from app.models import Lampi
+
+
+def device_data_version(device_id):
+    """``(version, changed_at)`` of the device's readings, or ``(None,
+    None)``.  Ingest, imports and compaction all bump the version through
+    ``Lampi.readings_changed``, and neither value ever goes backwards."""
+    version = Lampi.objects.filter(device_id=device_id) \
+        .values_list('data_version', 'data_changed_at').first()
+    return version or (None, None)
+
+
+class ReadingValidators:
+    """ETag and Last-Modified for a page built from one device's readings.
+
+    The ETag covers the device's data version, the user, the query string,
+    whether it is an HTMX fragment and anything in ``extra`` (such as the
+    device list shown around it); all of that costs one indexed query, so a
+    poll with nothing new is answered before any real work.
+    """
+
+    def __init__(self, request, device_id, *extra):
+        version, timestamp = device_data_version(device_id)
+        key = repr((request.user.pk, device_id, version,
+                    sorted(request.GET.lists()),
+                    bool(request.headers.get('HX-Request')), extra))
+        self.etag = quote_etag(hashlib.sha1(key.encode('utf-8')).hexdigest())
+        self.last_modified = int(timestamp.timestamp()) if timestamp else None
+
+    def not_modified(self, request):
+        """A 304 response if the client's copy is current, else None."""
+        response = get_conditional_response(request, etag=self.etag,
+                                            last_modified=self.last_modified)
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def apply(self, response):
+        response.headers['ETag'] = self.etag
+        if self.last_modified is not None:
+            response.headers['Last-Modified'] = http_date(self.last_modified)
+        # per-user pages: browsers may keep them but must revalidate
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('HX-Request', 'Cookie'))
+        return response
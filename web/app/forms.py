@@ -1,8 +1,8 @@
 from django import forms
 from django.contrib.auth.forms import AuthenticationForm
-from app.models import Lampi
-from config import settings
-from django.contrib.auth import get_user_model
+from app.models import Lampi, parked_user_id
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
 
@@ -27,20 +27,40 @@ class AddLampiForm(forms.Form):
     association_code = forms.CharField(label="Association Code", min_length=6,
                                        max_length=6)
 
+    def __init__(self, *args, user=None, **kwargs):
+        super(AddLampiForm, self).__init__(*args, **kwargs)
+        self.user = user
+
+    def _attempts_key(self):
+        return 'association-attempts:{}'.format(
+            self.user.pk if self.user else None)
+
     def clean(self):
         cleaned_data = super(AddLampiForm, self).clean()
-        print("received form with code {}".format(
-              cleaned_data['association_code']))
-        # look up device with start of association_code
-        uname = settings.DEFAULT_USER
-        parked_user = get_user_model().objects.get(username=uname)
-        devices = Lampi.objects.filter(
-            user=parked_user,
-            association_code__startswith=cleaned_data['association_code'])
-        if not devices:
+        code = cleaned_data.get('association_code')
+        if code is None:
+            return cleaned_data
+        print("received form with code {}".format(code))
+        # failed attempts are counted per user, so codes cannot be guessed
+        key = self._attempts_key()
+        if cache.get(key, 0) >= settings.ASSOCIATION_ATTEMPTS_MAX:
+            self.add_error('association_code',
+                           ValidationError("Too many attempts, try again "
+                                           "later", code='rate_limited'))
+            return cleaned_data
+        # indexed lookup on the short code of a parked device
+        device = Lampi.objects.filter(short_code=code.lower(),
+                                      user_id=parked_user_id()).first()
+        if device is None:
+            cache.add(key, 0, settings.ASSOCIATION_ATTEMPT_WINDOW_SECS)
+            try:
+                cache.incr(key)
+            except ValueError:
+                # expired between add and incr
+                pass
             self.add_error('association_code',
                            ValidationError("Invalid Association Code",
                                            code='invalid'))
         else:
-            cleaned_data['device'] = devices[0]
-        return cleaned_data
\ No newline at end of file
+            cleaned_data['device'] = device
+        return cleaned_data
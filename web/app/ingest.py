@@ -0,0 +1,130 @@
+import datetime
+import threading
+import time
+
+from django.db import transaction
+
+from app.models import Lampi, SensorReading
+
+# readings that arrive this much later than they were captured are a backlog
+# the broker queued while the daemon was away; catch-up mode ends once they
+# are fresh again, or once the backlog stops arriving
+CATCHUP_ENTER_LAG_SECS = 30.0
+CATCHUP_EXIT_LAG_SECS = 5.0
+CATCHUP_IDLE_SECS = 1.0
+CATCHUP_BATCH_SIZE = 500
+
+
+def captured_at(trace, received_at):
+    """Capture time of a reading: the device's, unless it is missing or in
+    the future."""
+    captured = trace.get('captured') if isinstance(trace, dict) else None
+    if not isinstance(captured, (int, float)) or captured > received_at:
+        return received_at
+    return captured
+
+
+def reading_from_payload(device_id, payload, captured):
+    return SensorReading(
+        timestamp=datetime.datetime.fromtimestamp(captured,
+                                                  datetime.timezone.utc),
+        pressure=payload.get('pressure'),
+        temperature=payload.get('temperature'),
+        humidity=payload.get('humidity'),
+        altitude=payload.get('altitude'),
+        pm25=payload.get('pm25'),
+        pm10=payload.get('pm10'),
+        lampi_id=device_id,
+    )
+
+
+class CatchUp:
+    """Drains a backlog of readings in large batches.
+
+    While active, readings are bulk-inserted CATCHUP_BATCH_SIZE at a time
+    and the per-reading extras (logging, latency tracing, presence updates)
+    are skipped or done once per batch.  Each drain is reported when it ends.
+
+    QoS 1 delivers at least once, so a backlog can repeat readings the
+    daemon stored but had not acknowledged when it stopped; a reading whose
+    device and capture time are already stored, or already in the batch,
+    is dropped.  ``on_stored`` is called with the readings each batch
+    stored, after they are committed.
+    """
+
+    def __init__(self, presence, batch_size=CATCHUP_BATCH_SIZE,
+                 on_stored=None):
+        self._presence = presence
+        self._on_stored = on_stored
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._batch = []
+        self.active = False
+        self.last_drain = None
+
+    def should_buffer(self, lag):
+        return self.active or lag > CATCHUP_ENTER_LAG_SECS
+
+    def add(self, reading, lag):
+        with self._lock:
+            if not self.active:
+                print("Catching up on a backlog ({:.0f} s behind)"
+                      .format(lag))
+                self.active = True
+                self._started = time.monotonic()
+                self._received = 0
+                self._written = 0
+            self._batch.append(reading)
+            self._received += 1
+            self._last_add = time.monotonic()
+            if len(self._batch) >= self._batch_size:
+                self._flush()
+            if lag < CATCHUP_EXIT_LAG_SECS:
+                self._finish()
+
+    def check_idle(self):
+        """Called periodically; ends catch-up once the backlog dries up."""
+        with self._lock:
+            if self.active and \
+                    time.monotonic() - self._last_add >= CATCHUP_IDLE_SECS:
+                self._finish()
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        # one query for the devices in the batch instead of one per reading
+        device_ids = {reading.lampi_id for reading in batch}
+        known = set(Lampi.objects.filter(device_id__in=device_ids)
+                    .values_list('device_id', flat=True))
+        # redeliveries are recent readings, so they are still rows
+        stored = set(SensorReading.objects.filter(
+            lampi_id__in=known,
+            timestamp__gte=min(reading.timestamp for reading in batch),
+            timestamp__lte=max(reading.timestamp for reading in batch),
+        ).values_list('lampi_id', 'timestamp'))
+        rows = []
+        for reading in batch:
+            key = (reading.lampi_id, reading.timestamp)
+            if reading.lampi_id in known and key not in stored:
+                stored.add(key)
+                rows.append(reading)
+        with transaction.atomic():
+            SensorReading.objects.bulk_create(rows)
+            Lampi.readings_changed(known)
+        for device_id in known:
+            self._presence.seen(device_id)
+        self._written += len(rows)
+        if self._on_stored is not None and rows:
+            self._on_stored(rows)
+
+    def _finish(self):
+        # time spent waiting to notice the backlog had ended is not draining
+        idle = time.monotonic() - self._last_add
+        self._flush()
+        elapsed = time.monotonic() - self._started - idle
+        self.last_drain = (self._written, elapsed)
+        self.active = False
+        print("Caught up: {} readings ({} stored) in {:.1f} s, {:.0f}/s"
+              .format(self._received, self._written, elapsed,
+                      self._received / elapsed if elapsed else 0))
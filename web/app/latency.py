@@ -0,0 +1,74 @@
+import math
+
+# Readings carry a trace added on the device (see lampi/air_quality_common):
+#   {"captured": <epoch secs>, "hops": [[<hop>, <epoch secs>], ...]}
+# The daemon appends its own hops and records one latency per segment
+# between consecutive hops, named "<previous hop>-><hop>", plus the total.
+# The MQTT bridge cannot stamp messages, so its time shows up in the
+# "service_pub->daemon_recv" segment.  Device and server clocks are only as
+# close as NTP keeps them.
+TRACE_KEY = 'trace'
+HOP_CAPTURED = 'captured'
+HOP_DAEMON_RECV = 'daemon_recv'
+HOP_DB_COMMIT = 'db_commit'
+SEGMENT_TOTAL = 'total'
+
+# log-spaced buckets, about 9% wide, from 10 us upwards
+BUCKET_BASE = 2 ** (1 / 8)
+BUCKET_MIN_SECS = 1e-5
+
+
+def trace_segments(trace):
+    """Return ``[(segment name, seconds), ...]`` for a completed trace."""
+    hops = [(HOP_CAPTURED, trace['captured'])] + \
+        [(name, t) for name, t in trace['hops']]
+    segments = [('{}->{}'.format(prev_name, name), t - prev_t)
+                for (prev_name, prev_t), (name, t) in zip(hops, hops[1:])]
+    segments.append((SEGMENT_TOTAL, hops[-1][1] - hops[0][1]))
+    return segments
+
+
+def bucket_index(secs):
+    return int(math.log(max(secs, BUCKET_MIN_SECS) / BUCKET_MIN_SECS,
+                        BUCKET_BASE))
+
+
+def bucket_upper_secs(index):
+    return BUCKET_MIN_SECS * BUCKET_BASE ** (index + 1)
+
+
+class LatencyHistogram:
+    """Sparse log-bucketed histogram; cheap to add to and to merge."""
+
+    def __init__(self, buckets=None, count=0, total_secs=0.0):
+        self.buckets = {int(k): v for k, v in (buckets or {}).items()}
+        self.count = count
+        self.total_secs = total_secs
+
+    def add(self, secs):
+        index = bucket_index(secs)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total_secs += secs
+
+    def merge(self, other):
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count += other.count
+        self.total_secs += other.total_secs
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given quantile."""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return bucket_upper_secs(index)
+        return bucket_upper_secs(max(self.buckets))
+
+    @property
+    def mean(self):
+        return self.total_secs / self.count if self.count else None
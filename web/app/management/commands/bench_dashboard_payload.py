@@ -0,0 +1,107 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from bokeh.embed import components
+from bokeh.layouts import gridplot
+from bokeh.models import ColumnDataSource
+from bokeh.plotting import figure
+from django.core.management.base import BaseCommand
+
+from app.management.commands.bench_reading_storage import synthetic_hour
+from app.timeseries import READING_FIELDS
+from app.views import DASHBOARD_METRICS, dashboard_grid
+
+# Times what BokehJS does with the embedded document before drawing:
+# JSON.parse of docs_json, then base64 + gunzip of every binary array.
+NODE_PARSE = r"""
+const fs = require('fs');
+const zlib = require('zlib');
+const script = fs.readFileSync(process.argv[1], 'utf8');
+const literal = script.match(/const docs_json = ('.*?');\n/s)[1];
+const docsJson = eval(literal);
+function decode(node) {
+  if (Array.isArray(node)) { node.forEach(decode); return; }
+  if (node === null || typeof node !== 'object') return;
+  if (node.type === 'bytes' && typeof node.data === 'string') {
+    let buf = Buffer.from(node.data, 'base64');
+    if (buf[0] === 0x1f && buf[1] === 0x8b) buf = zlib.gunzipSync(buf);
+    node.data = buf;
+    return;
+  }
+  Object.values(node).forEach(decode);
+}
+const runs = 5;
+let best = Infinity;
+for (let i = 0; i < runs; i++) {
+  const start = process.hrtime.bigint();
+  decode(JSON.parse(docsJson));
+  best = Math.min(best, Number(process.hrtime.bigint() - start) / 1e6);
+}
+console.log(best.toFixed(1));
+"""
+
+
+def legacy_grid(readings):
+    """The dashboard as it was: one source per chart, plain lists."""
+    timestamps = readings['timestamp'].astype(object).tolist()
+    figs = []
+    for title, field, unit, fmt in DASHBOARD_METRICS:
+        cds = ColumnDataSource(data=dict(ts=timestamps,
+                                         val=readings[field].tolist()))
+        p = figure(height=240, x_axis_type="datetime",
+                   toolbar_location=None, sizing_mode="stretch_width")
+        p.line(source=cds, x="ts", y="val", line_width=2)
+        figs.append(p)
+    return gridplot(figs, ncols=2, sizing_mode="stretch_width")
+
+
+class Command(BaseCommand):
+    help = ('Compare dashboard HTML payload size and parse time for six '
+            'per-chart sources versus one shared binary source')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--rate', type=int, default=1,
+                            help='Readings per second (default: 1)')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(1)
+        state = {'pm25': 10.0}
+        hours = [synthetic_hour(hour, options['rate'], rng, state)
+                 for hour in range(options['days'] * 24)]
+        readings = {'timestamp': np.concatenate(
+            [ts for ts, _ in hours]).astype('datetime64[us]')}
+        for field in READING_FIELDS:
+            readings[field] = np.concatenate([c[field] for _, c in hours])
+        self.stdout.write("{:,} readings".format(len(readings['timestamp'])))
+
+        node = shutil.which('node')
+        if node is None:
+            self.stdout.write("node not found; skipping parse times")
+        self.stdout.write("{:<28} {:>14} {:>10} {:>10}".format(
+            "layout", "HTML bytes", "build ms", "parse ms"))
+        for name, build in (("six sources, lists", legacy_grid),
+                            ("shared source, binary",
+                             lambda r: dashboard_grid(r)[0])):
+            start = time.perf_counter()
+            script, div = components(build(readings))
+            build_ms = (time.perf_counter() - start) * 1000
+            parse_ms = self._parse_ms(node, script) if node else float('nan')
+            self.stdout.write("{:<28} {:>14,} {:>10.0f} {:>10.1f}".format(
+                name, len(script) + len(div), build_ms, parse_ms))
+
+    def _parse_ms(self, node, script):
+        with tempfile.NamedTemporaryFile('w', suffix='.js',
+                                         delete=False) as f:
+            f.write(script)
+        try:
+            result = subprocess.run([node, '-e', NODE_PARSE, f.name],
+                                    capture_output=True, text=True,
+                                    check=True)
+            return float(result.stdout)
+        finally:
+            os.unlink(f.name)
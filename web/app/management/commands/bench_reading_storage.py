@@ -0,0 +1,198 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from app.timeseries import (READING_FIELDS, CHUNK_SECS, encode_chunk,
+                            decode_chunk)
+
+# schemas as Django creates them for SensorReading and ReadingChunk on SQLite
+ROW_SCHEMA = (
+    'CREATE TABLE app_sensorreading (id integer NOT NULL PRIMARY KEY '
+    'AUTOINCREMENT, timestamp datetime NOT NULL, pressure real NOT NULL, '
+    'temperature real NOT NULL, humidity real NOT NULL, altitude real NOT '
+    'NULL, pm25 real NOT NULL, pm10 real NOT NULL, lampi_id varchar(12) NOT '
+    'NULL)',
+    'CREATE INDEX app_sensorreading_lampi_id ON app_sensorreading '
+    '(lampi_id)',
+    'CREATE INDEX app_sensorreading_lampi_ts ON app_sensorreading '
+    '(lampi_id, timestamp)',
+)
+CHUNK_SCHEMA = (
+    'CREATE TABLE app_readingchunk (id integer NOT NULL PRIMARY KEY '
+    'AUTOINCREMENT, chunk_start datetime NOT NULL, count integer unsigned '
+    'NOT NULL, data BLOB NOT NULL, lampi_id varchar(12) NOT NULL)',
+    'CREATE UNIQUE INDEX unique_reading_chunk ON app_readingchunk '
+    '(lampi_id, chunk_start)',
+)
+DEVICE_ID = 'b827eb000001'
+START_US = 1735689600 * 1000000  # 2025-01-01
+WINDOWS = (('1 hour', 3600), ('1 day', 86400), ('1 week', 7 * 86400),
+           ('30 days', 30 * 86400))
+
+
+def _format_ts(us):
+    # Django's SQLite datetime text format
+    return np.datetime_as_string(us.astype('datetime64[us]')).astype(object)
+
+
+def synthetic_hour(hour, rate, rng, state):
+    """One hour of smooth, slightly noisy 1/rate-second readings."""
+    n = CHUNK_SECS * rate
+    ts = START_US + hour * CHUNK_SECS * 1000000 + \
+        np.arange(n, dtype=np.int64) * (1000000 // rate) + \
+        rng.integers(0, 4000, n)
+    day = (ts / 1e6 % 86400) / 86400 * 2 * np.pi
+    state['pm25'] = max(0.0, state['pm25'] + rng.normal(0, 0.5))
+    pressure = 1013 + 5 * np.sin(day / 7 + hour / 500) + rng.normal(0, 0.02, n)
+    columns = {
+        'pressure': pressure,
+        'temperature': 20 + 5 * np.sin(day) + rng.normal(0, 0.01, n),
+        'humidity': 50 + 10 * np.cos(day) + rng.normal(0, 0.05, n),
+        'altitude': 44330 * (1 - (pressure / 1013.25) ** 0.1903),
+        # the SDS011 reports 0.1 ug/m3 steps
+        'pm25': np.round(np.abs(state['pm25']
+                                + np.cumsum(rng.normal(0, 0.05, n))), 1),
+        'pm10': np.round(np.abs(1.5 * state['pm25']
+                                + np.cumsum(rng.normal(0, 0.08, n))), 1),
+    }
+    return ts, columns
+
+
+def _db_bytes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return (pages - free) * page_size
+
+
+class Command(BaseCommand):
+    help = ('Compare storage size and range-scan speed of the row table and '
+            'compressed chunks on synthetic data, in scratch SQLite files')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--rate', type=int, default=1,
+                            help='Readings per second (default: 1)')
+        parser.add_argument('--scans', type=int, default=5,
+                            help='Random range scans per window size')
+
+    def handle(self, *args, **options):
+        rate = options['rate']
+        hours = options['days'] * 24
+        rng = np.random.default_rng(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            rows_db = sqlite3.connect(os.path.join(tmp, 'rows.sqlite3'))
+            chunks_db = sqlite3.connect(os.path.join(tmp, 'chunks.sqlite3'))
+            for conn, schema in ((rows_db, ROW_SCHEMA),
+                                 (chunks_db, CHUNK_SCHEMA)):
+                for statement in schema:
+                    conn.execute(statement)
+
+            self.stdout.write("Writing {} hours of {} Hz readings...".format(
+                hours, rate))
+            state = {'pm25': 10.0}
+            encode_secs = 0.0
+            for hour in range(hours):
+                ts, columns = synthetic_hour(hour, rate, rng, state)
+                rows_db.executemany(
+                    'INSERT INTO app_sensorreading (timestamp, pressure, '
+                    'temperature, humidity, altitude, pm25, pm10, lampi_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    zip(_format_ts(ts),
+                        *(columns[field].tolist() for field in READING_FIELDS),
+                        [DEVICE_ID] * len(ts)))
+                start = time.perf_counter()
+                data = encode_chunk(ts, columns)
+                encode_secs += time.perf_counter() - start
+                chunks_db.execute(
+                    'INSERT INTO app_readingchunk (chunk_start, count, data, '
+                    'lampi_id) VALUES (?, ?, ?, ?)',
+                    (_format_ts(ts[:1] - ts[:1] % (CHUNK_SECS * 1000000))[0],
+                     len(ts), data, DEVICE_ID))
+                if hour == 0:
+                    column_bytes = self._column_bytes(ts, columns)
+            rows_db.commit()
+            chunks_db.commit()
+
+            samples = hours * CHUNK_SECS * rate
+            row_bytes = _db_bytes(rows_db)
+            chunk_bytes = _db_bytes(chunks_db)
+            self.stdout.write("{:,} readings".format(samples))
+            self.stdout.write("rows:   {:>14,} bytes  {:6.1f} B/reading"
+                              .format(row_bytes, row_bytes / samples))
+            self.stdout.write("chunks: {:>14,} bytes  {:6.1f} B/reading  "
+                              "({:.1f}x smaller, encoded at {:,.0f} "
+                              "readings/s)".format(
+                                  chunk_bytes, chunk_bytes / samples,
+                                  row_bytes / chunk_bytes,
+                                  samples / encode_secs))
+            self.stdout.write("chunk bytes/reading by column (first hour): "
+                              + ", ".join("{} {:.2f}".format(k, v)
+                                          for k, v in column_bytes.items()))
+
+            self.stdout.write("{:<10} {:>12} {:>12} {:>8}".format(
+                "range", "rows ms", "chunks ms", "speedup"))
+            span_secs = hours * CHUNK_SECS
+            for name, secs in WINDOWS:
+                if secs > span_secs:
+                    continue
+                row_secs = chunk_secs = 0.0
+                for _ in range(options['scans']):
+                    lo = START_US + random.randrange(
+                        0, span_secs - secs + 1) * 1000000
+                    hi = lo + secs * 1000000
+                    row_secs += self._scan_rows(rows_db, lo, hi)
+                    chunk_secs += self._scan_chunks(chunks_db, lo, hi)
+                self.stdout.write("{:<10} {:>12.1f} {:>12.1f} {:>7.1f}x"
+                                  .format(name,
+                                          row_secs / options['scans'] * 1000,
+                                          chunk_secs / options['scans'] * 1000,
+                                          row_secs / chunk_secs))
+            rows_db.close()
+            chunks_db.close()
+
+    def _column_bytes(self, ts, columns):
+        # size of each column compressed on its own, to show where bytes go
+        one = dict.fromkeys(READING_FIELDS, np.zeros(len(ts)))
+        base = len(encode_chunk(np.zeros(len(ts), dtype=np.int64), one))
+        sizes = {'timestamp': len(encode_chunk(ts, one)) - base}
+        for field in READING_FIELDS:
+            sizes[field] = len(encode_chunk(
+                np.zeros(len(ts), dtype=np.int64),
+                dict(one, **{field: columns[field]}))) - base
+        return {k: v / len(ts) for k, v in sizes.items()}
+
+    def _scan_rows(self, conn, lo, hi):
+        start = time.perf_counter()
+        bounds = _format_ts(np.array([lo, hi], dtype=np.int64))
+        rows = conn.execute(
+            'SELECT timestamp, pressure, temperature, humidity, altitude, '
+            'pm25, pm10 FROM app_sensorreading WHERE lampi_id = ? AND '
+            'timestamp >= ? AND timestamp < ? ORDER BY timestamp',
+            (DEVICE_ID, bounds[0], bounds[1])).fetchall()
+        columns = list(zip(*rows))
+        arrays = {'timestamp': np.array(columns[0], dtype='datetime64[us]')}
+        for i, field in enumerate(READING_FIELDS, 1):
+            arrays[field] = np.array(columns[i], dtype=np.float64)
+        return time.perf_counter() - start
+
+    def _scan_chunks(self, conn, lo, hi):
+        start = time.perf_counter()
+        bounds = _format_ts(np.array([lo - lo % (CHUNK_SECS * 1000000), hi],
+                                     dtype=np.int64))
+        parts = [decode_chunk(data) for (data,) in conn.execute(
+            'SELECT data FROM app_readingchunk WHERE lampi_id = ? AND '
+            'chunk_start >= ? AND chunk_start < ? ORDER BY chunk_start',
+            (DEVICE_ID, bounds[0], bounds[1]))]
+        ts = np.concatenate([part[0] for part in parts])
+        keep = (ts >= lo) & (ts < hi)
+        arrays = {'timestamp': ts[keep].astype('datetime64[us]')}
+        for field in READING_FIELDS:
+            arrays[field] = np.concatenate(
+                [part[1][field] for part in parts])[keep]
+        return time.perf_counter() - start
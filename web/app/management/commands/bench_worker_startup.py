@@ -0,0 +1,125 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from app.models import Lampi
+
+# Runs in a fresh interpreter.  "spawn" loads the app and serves one request,
+# like a uWSGI worker with lazy-apps; "fork" loads the app once, as the
+# uWSGI master does, then forks workers that each serve one request.
+# Each worker prints one JSON line; "ready" counts from the fork, or for a
+# spawned worker from interpreter start.
+WORKER = r"""
+import io, json, os, sys, time
+started = time.perf_counter()
+mode, workers, path, query, session = sys.argv[1:6]
+sys.path.insert(0, os.getcwd())
+from config.wsgi import application
+
+def memory():
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields['Rss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+def serve(since):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost', 'HTTP_COOKIE': 'sessionid=' + session,
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0), 'wsgi.multithread': False,
+        'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+    status = []
+    request_start = time.perf_counter()
+    response = application(environ, lambda s, h, e=None: status.append(s))
+    b''.join(response)
+    response.close()
+    done = time.perf_counter()
+    rss, uss = memory()
+    print(json.dumps({'status': status[0], 'ready_ms': (done - since) * 1000,
+                      'request_ms': (done - request_start) * 1000,
+                      'rss_kb': rss, 'uss_kb': uss}), flush=True)
+
+if mode == 'spawn':
+    serve(started)
+else:
+    from django.db import connections
+    connections.close_all()
+    for _ in range(int(workers)):
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            serve(forked)
+            os._exit(0)
+        os.waitpid(pid, 0)
+"""
+
+
+class Command(BaseCommand):
+    help = ('Measure time to first request and per-worker memory for '
+            'workers forked from a preloaded master, with and without the '
+            'config/wsgi.py warm-up, and for workers that load the app '
+            'themselves')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--path', default='/dashboard/')
+        parser.add_argument('--device',
+                            help='Device to chart (default: any device)')
+
+    def handle(self, *args, **options):
+        device = Lampi.objects.filter(device_id=options['device']).first() \
+            if options['device'] else Lampi.objects.first()
+        if device is None:
+            raise CommandError("Need a device to request")
+        client = Client()
+        client.force_login(User.objects.get(pk=device.user_id))
+        session = client.cookies['sessionid'].value
+        query = 'device=' + device.device_id
+
+        self.stdout.write("{:<24} {:>10} {:>11} {:>9} {:>9}".format(
+            "workers", "ready ms", "request ms", "RSS MB", "USS MB"))
+        for name, mode, warm in (
+                ("spawned (lazy-apps)", 'spawn', '0'),
+                ("forked, no warm-up", 'fork', '0'),
+                ("forked, warmed up", 'fork', '1')):
+            env = dict(os.environ, LAMPI_WSGI_WARMUP=warm)
+            results = []
+            if mode == 'spawn':
+                for _ in range(options['workers']):
+                    results += self._run(env, mode, 1, options['path'],
+                                         query, session)
+            else:
+                results = self._run(env, mode, options['workers'],
+                                    options['path'], query, session)
+            failed = [r['status'] for r in results
+                      if not r['status'].startswith('200')]
+            if failed:
+                raise CommandError("{}: got {}".format(name, failed[0]))
+            self.stdout.write("{:<24} {:>10.0f} {:>11.0f} {:>9.1f} {:>9.1f}"
+                              .format(name, *self._mean(results)))
+
+    def _run(self, env, mode, workers, path, query, session):
+        result = subprocess.run(
+            [sys.executable, '-c', WORKER, mode, str(workers), path, query,
+             session], env=env, capture_output=True, text=True, check=True)
+        return [json.loads(line) for line in result.stdout.splitlines()
+                if line.startswith('{')]
+
+    def _mean(self, results):
+        n = len(results)
+        return (sum(r['ready_ms'] for r in results) / n,
+                sum(r['request_ms'] for r in results) / n,
+                sum(r['rss_kb'] for r in results) / n / 1024,
+                sum(r['uss_kb'] for r in results) / n / 1024)
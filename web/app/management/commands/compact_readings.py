@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.timeseries import compact_readings
+
+
+class Command(BaseCommand):
+    help = ('Pack sensor readings from hours that are over into compressed '
+            'chunks (the mqtt-daemon does this periodically when '
+            'READING_CHUNKS_ENABLED is set)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='devices',
+                            help='Only this device (may be repeated)')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        readings, chunks = compact_readings(device_ids=options['devices'])
+        self.stdout.write("Compacted {} readings into {} chunks in {:.1f} s"
+                          .format(readings, chunks,
+                                  time.monotonic() - start))
@@ -0,0 +1,250 @@
+import csv
+import datetime
+import gzip
+import itertools
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from app.models import Lampi, ReadingImport, SensorReading
+from app.timeseries import READING_FIELDS, compact_readings
+
+COLUMNS = ('timestamp',) + READING_FIELDS
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+
+# The record readers yield None for a record that cannot be read at all, so
+# it is counted as invalid and the record count used to resume stays right.
+
+def _csv_records(f, default_device):
+    reader = csv.reader(f)
+    header = next(reader, None) or []
+    index = {name: i for i, name in enumerate(header)}
+    missing = [name for name in COLUMNS if name not in index]
+    if missing:
+        raise CommandError("Missing CSV columns: {}".format(
+            ", ".join(missing)))
+    columns = [index[name] for name in COLUMNS]
+    device = index.get('device_id')
+    for row in reader:
+        try:
+            fields = (row[device] if device is not None else default_device,
+                      *(row[i] for i in columns))
+        except IndexError:
+            # a short row
+            yield None
+            continue
+        yield fields
+
+
+def _ndjson_records(f, default_device):
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            fields = (record.get('device_id', default_device),
+                      *(record.get(name) for name in COLUMNS))
+        except (json.JSONDecodeError, AttributeError):
+            # not JSON, or not an object
+            yield None
+            continue
+        yield fields
+
+
+def parse_timestamp(value):
+    """An aware datetime from ISO 8601 text (naive means UTC) or epoch
+    seconds."""
+    if isinstance(value, str):
+        try:
+            dt = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            value = float(value)
+        else:
+            return dt if dt.tzinfo else dt.replace(
+                tzinfo=datetime.timezone.utc)
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+
+
+class Command(BaseCommand):
+    help = ('Bulk-load sensor readings from CSV or NDJSON files, optionally '
+            'gzipped.  Columns are those of the history CSV export, plus an '
+            'optional device_id; an interrupted import resumes where it '
+            'stopped when run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--device',
+                            help='Device for files without a device_id '
+                                 'column (default: the file name, as the '
+                                 'export names it)')
+        parser.add_argument('--format', choices=('csv', 'ndjson'),
+                            help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=50000,
+                            help='Readings per transaction')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore saved progress and import the '
+                                 'files from the start')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='SQLite only: drop the reading indexes '
+                                 'during the load and rebuild them after')
+        parser.add_argument('--compact', action='store_true',
+                            help='Pack the imported hours into chunks '
+                                 'afterwards')
+
+    def handle(self, *args, **options):
+        for path in options['files']:
+            if not os.path.isfile(path):
+                raise CommandError("No such file: {}".format(path))
+        if options['defer_indexes'] and connection.vendor != 'sqlite':
+            raise CommandError("--defer-indexes needs SQLite")
+
+        self._known = set(Lampi.objects.values_list('device_id', flat=True))
+        self._unknown = {}
+        self._invalid = 0
+        self._imported_devices = set()
+        opts = SensorReading._meta
+        quote = connection.ops.quote_name
+        names = [quote(opts.get_field(name).column)
+                 for name in COLUMNS + ('lampi',)]
+        self._sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            quote(opts.db_table), ', '.join(names),
+            ', '.join(['%s'] * len(names)))
+
+        indexes = []
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                # commits are rare at this batch size, so the win is in
+                # keeping index pages cached
+                cursor.execute('PRAGMA cache_size = -262144')
+                cursor.execute('PRAGMA temp_store = MEMORY')
+            if options['defer_indexes']:
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = "
+                    "'index' AND tbl_name = %s AND sql IS NOT NULL",
+                    [opts.db_table])
+                indexes = cursor.fetchall()
+                for name, _ in indexes:
+                    cursor.execute('DROP INDEX {}'.format(quote(name)))
+        try:
+            for path in options['files']:
+                self._import_file(path, options)
+        finally:
+            if indexes:
+                start = time.monotonic()
+                with connection.cursor() as cursor:
+                    for _, sql in indexes:
+                        cursor.execute(sql)
+                self.stdout.write("Rebuilt {} indexes in {:.1f} s".format(
+                    len(indexes), time.monotonic() - start))
+
+        for device_id, count in sorted(self._unknown.items()):
+            self.stdout.write("Skipped {:,} readings for unknown device {}"
+                              .format(count, device_id))
+        if self._invalid:
+            self.stdout.write("Skipped {:,} invalid readings".format(
+                self._invalid))
+        if options['compact'] and self._imported_devices:
+            start = time.monotonic()
+            readings, chunks = compact_readings(
+                device_ids=sorted(self._imported_devices))
+            self.stdout.write("Compacted {:,} readings into {:,} chunks in "
+                              "{:.1f} s".format(readings, chunks,
+                                                time.monotonic() - start))
+
+    def _import_file(self, path, options):
+        source = os.path.abspath(path)
+        size = os.path.getsize(path)
+        progress, _ = ReadingImport.objects.get_or_create(
+            source=source, defaults={'size': size})
+        if options['restart'] or progress.size != size:
+            progress.size = size
+            progress.records = 0
+            progress.finished = False
+            progress.save()
+        if progress.finished:
+            self.stdout.write("{}: already imported ({:,} records)".format(
+                path, progress.records))
+            return
+
+        fmt = options['format'] or ('ndjson' if '.ndjson' in path or
+                                    '.jsonl' in path else 'csv')
+        device = options['device'] or \
+            os.path.basename(path).split('.')[0]
+        start = time.monotonic()
+        done = progress.records
+        stored = 0
+        with _open(path) as f:
+            records = (_csv_records if fmt == 'csv'
+                       else _ndjson_records)(f, device)
+            if done:
+                self.stdout.write("{}: resuming after {:,} records".format(
+                    path, done))
+                next(itertools.islice(records, done - 1, done), None)
+            while True:
+                batch = list(itertools.islice(records,
+                                              options['batch_size']))
+                if not batch:
+                    break
+                rows = self._rows(batch)
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.executemany(self._sql, rows)
+                    Lampi.readings_changed({row[-1] for row in rows})
+                    done += len(batch)
+                    ReadingImport.objects.filter(pk=progress.pk).update(
+                        records=done)
+                stored += len(rows)
+                elapsed = time.monotonic() - start
+                self.stdout.write("{}: {:,} records, {:,.0f} readings/s"
+                                  .format(path, done, stored / elapsed))
+        ReadingImport.objects.filter(pk=progress.pk).update(finished=True)
+        elapsed = time.monotonic() - start
+        self.stdout.write("{}: stored {:,} readings in {:.1f} s ({:,.0f}/s)"
+                          .format(path, stored, elapsed,
+                                  stored / elapsed if elapsed else 0))
+
+    def _db_timestamp(self):
+        if connection.vendor == 'sqlite' and \
+                connection.timezone_name == 'UTC':
+            # what adapt_datetimefield_value produces, minus its per-call
+            # timezone checks, which are most of the cost of a row
+            def to_db(value):
+                dt = parse_timestamp(value)
+                if dt.utcoffset():
+                    dt = dt.astimezone(datetime.timezone.utc)
+                return dt.replace(tzinfo=None).isoformat(' ')
+            return to_db
+        adapt = connection.ops.adapt_datetimefield_value
+        return lambda value: adapt(parse_timestamp(value))
+
+    def _rows(self, batch):
+        to_db = self._db_timestamp()
+        known = self._known
+        rows = []
+        append = rows.append
+        for record in batch:
+            if record is None:
+                self._invalid += 1
+                continue
+            device_id = record[0]
+            if device_id not in known:
+                self._unknown[device_id] = self._unknown.get(device_id, 0) + 1
+                continue
+            try:
+                append((to_db(record[1]), float(record[2]), float(record[3]),
+                        float(record[4]), float(record[5]), float(record[6]),
+                        float(record[7]), device_id))
+            except (TypeError, ValueError, OverflowError):
+                self._invalid += 1
+                continue
+            self._imported_devices.add(device_id)
+        return rows
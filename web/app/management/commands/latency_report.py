@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from app.models import HopLatencyHistogram
+from app.latency import LatencyHistogram, SEGMENT_TOTAL
+
+
+class Command(BaseCommand):
+    help = 'Report p50/p99 latency per hop from the mqtt-daemon histograms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=60,
+                            help='How far back to look (default: 60)')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timezone.timedelta(minutes=options['minutes'])
+        merged = {}
+        rows = HopLatencyHistogram.objects.filter(
+            window_start__gte=since).order_by('id')
+        for row in rows.iterator():
+            hist = LatencyHistogram(row.buckets, row.count, row.total_secs)
+            merged.setdefault(row.segment, LatencyHistogram()).merge(hist)
+
+        if not merged:
+            self.stdout.write("No latency samples in the last {} minutes"
+                              .format(options['minutes']))
+            return
+
+        self.stdout.write("{:<32} {:>8} {:>10} {:>10} {:>10}".format(
+            "segment", "count", "mean ms", "p50 ms", "p99 ms"))
+        # hops in path order (as written), with the end-to-end total last
+        segments = sorted(merged, key=lambda s: s == SEGMENT_TOTAL)
+        for segment in segments:
+            hist = merged[segment]
+            self.stdout.write("{:<32} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}"
+                              .format(segment, hist.count,
+                                      hist.mean * 1000,
+                                      hist.quantile(0.5) * 1000,
+                                      hist.quantile(0.99) * 1000))
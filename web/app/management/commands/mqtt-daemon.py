@@ -1,16 +1,53 @@
-import re
+import functools
+import time
+import threading
+import traceback
 from paho.mqtt.client import Client
 from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from app.models import Lampi, SensorReading
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from app.models import Lampi, HopLatencyHistogram, DeviceHealth
+from app.mqtt_publisher import get_publisher
+from app.presence import (PresenceTracker, broker_device_id,
+                          PRESENCE_FLUSH_SECS)
+from app.ingest import CatchUp, captured_at, reading_from_payload
+from app.alerts import AlertEngine
+from app.timeseries import compact_readings
+from app.latency import (LatencyHistogram, trace_segments, TRACE_KEY,
+                         HOP_DAEMON_RECV, HOP_DB_COMMIT)
 import json
 
 
-MQTT_BROKER_RE_PATTERN = (r'\$sys\/broker\/connection\/'
-                          r'(?P<device_id>[0-9a-f]*)_broker/state')
-
 SENSOR_DATA_TOPIC_PATTERN = 'devices/+/lampi/changed'
+TELEMETRY_TOPIC_PATTERN = 'devices/+/lampi/telemetry'
+
+# per-segment latency histograms are written out once per window
+LATENCY_FLUSH_SECS = 60
+
+# how often to look for devices nobody is watching any more
+WATCH_EXPIRY_CHECK_SECS = 30
+
+
+def _logged(func):
+    """Run ``func``, printing rather than raising what it raises.
+
+    An exception out of a paho callback ends paho's network thread without
+    a word, and one out of a periodic task would end the daemon, so a bad
+    message or a failing query costs only that call.  A connection broken
+    by the error is closed so the next query opens a new one.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            print("Error in {}:".format(func.__qualname__))
+            traceback.print_exc()
+            close_old_connections()
+    return wrapper
+
 
 class Command(BaseCommand):
     help = 'Long-running Daemon Process to Integrate MQTT Messages with Django'
@@ -28,17 +65,62 @@ class Command(BaseCommand):
             new_user.is_active = False
             new_user.save()
 
+    def _record_trace(self, trace):
+        try:
+            segments = trace_segments(trace)
+        except (KeyError, TypeError, ValueError):
+            return
+        for segment, secs in segments:
+            self._latency.setdefault(segment, LatencyHistogram()).add(secs)
+        if time.time() - self._latency_window_start >= LATENCY_FLUSH_SECS:
+            self._flush_latency()
+
+    def _flush_latency(self):
+        window_start = timezone.now() - timezone.timedelta(
+            seconds=time.time() - self._latency_window_start)
+        HopLatencyHistogram.objects.bulk_create([
+            HopLatencyHistogram(segment=segment,
+                                window_start=window_start,
+                                count=hist.count,
+                                total_secs=hist.total_secs,
+                                buckets=hist.buckets)
+            for segment, hist in self._latency.items()
+        ])
+        self._latency = {}
+        self._latency_window_start = time.time()
+
+    @_logged
     def _on_connect(self, client, userdata, flags, rc):
+        if flags.get('session present'):
+            print("Resumed broker session; queued readings follow")
         self.client.message_callback_add('$SYS/broker/connection/+/state',
                                          self._device_broker_status_change)
         self.client.subscribe('$SYS/broker/connection/+/state')
         
         self.client.message_callback_add(SENSOR_DATA_TOPIC_PATTERN, self._handle_sensor_reading)
-        self.client.subscribe(SENSOR_DATA_TOPIC_PATTERN)
+        self.client.subscribe(SENSOR_DATA_TOPIC_PATTERN, qos=1)
 
+        self.client.message_callback_add(TELEMETRY_TOPIC_PATTERN,
+                                         self._handle_telemetry)
+        self.client.subscribe(TELEMETRY_TOPIC_PATTERN)
+
+    @_logged
+    def _handle_telemetry(self, client, userdata, message):
+        device_id = message.topic.split('/')[1]
+        try:
+            record = json.loads(message.payload.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"Error decoding telemetry: {e}")
+            return
+        # only the key is needed, so skip fetching the Lampi row
+        if not Lampi.objects.filter(device_id=device_id).exists():
+            print(f"No Lampi found with device ID {device_id}")
+            return
+        DeviceHealth.from_record(Lampi(device_id=device_id), record).save()
+
+    @_logged
     def _handle_sensor_reading(self, client, userdata, message):
-        print(f"RECV: Sensor data on '{message.topic}': {message.payload}")
-        
+        received_at = time.time()
         device_id = message.topic.split('/')[1]
         
         try:
@@ -46,51 +128,127 @@ class Command(BaseCommand):
         except (json.JSONDecodeError, UnicodeDecodeError) as e:
             print(f"Error decoding payload: {e}")
             return
-        
-        try:
-            lampi = Lampi.objects.get(device_id=device_id)
-        except Lampi.DoesNotExist:
+
+        trace = payload.get(TRACE_KEY)
+        captured = captured_at(trace, received_at)
+        lag = received_at - captured
+        reading = reading_from_payload(device_id, payload, captured)
+        if self._catch_up.should_buffer(lag):
+            # backlog from the persistent session: batched, no tracing
+            self._catch_up.add(reading, lag)
+            return
+
+        print(f"RECV: Sensor data on '{message.topic}': {message.payload}")
+        # only the key is needed, so skip fetching the Lampi row
+        if not Lampi.objects.filter(device_id=device_id).exists():
             print(f"No Lampi found with device ID {device_id}")
             return
+        self._presence.seen(device_id)
         
         # Create a new SensorReading
-        SensorReading.objects.create(
-            pressure=payload.get('pressure'),
-            temperature=payload.get('temperature'),
-            humidity=payload.get('humidity'),
-            altitude=payload.get('altitude'),
-            pm25=payload.get('pm25'),
-            pm10=payload.get('pm10'),
-            lampi=lampi
-        )
+        with transaction.atomic():
+            reading.save()
+            Lampi.readings_changed([device_id])
         print("Successfully created SensorReading")
+        self._evaluate_alerts([reading])
+
+        if isinstance(trace, dict):
+            trace.setdefault('hops', []).append([HOP_DAEMON_RECV, received_at])
+            trace['hops'].append([HOP_DB_COMMIT, time.time()])
+            self._record_trace(trace)
 
-    def _create_mqtt_client_and_loop_forever(self):
-        self.client = Client()
+    def _evaluate_alerts(self, readings):
+        # only stored readings, so redeliveries the catch-up drops never
+        # reach the rules; a failing rule must not cost the reading
+        for reading in readings:
+            _logged(self._alerts.evaluate)(reading)
+
+    def _create_mqtt_client_and_loop_forever(self, clean_session=False):
+        # with a persistent session the broker queues QoS 1 readings for
+        # this client ID while the daemon is down or being redeployed
+        if clean_session:
+            self.client = Client()
+        else:
+            self.client = Client(client_id=settings.MQTT_DAEMON_CLIENT_ID,
+                                 clean_session=False)
         self.client.on_connect = self._on_connect
-        self.client.connect('localhost', port=50001)
-        self.client.loop_forever()
+        self.client.connect(settings.MQTT_BROKER_HOST,
+                            port=settings.MQTT_BROKER_PORT)
+        # MQTT callbacks run on the network thread, periodic work on this
+        # one; loop_forever reconnects by itself and only returns after
+        # disconnect(), so the thread ending means paho itself failed
+        network = threading.Thread(target=self.client.loop_forever,
+                                   name='mqtt-network', daemon=True)
+        network.start()
+        stop = threading.Event()
+        last_expiry_check = last_compaction = last_rules_reload = \
+            time.monotonic()
+        try:
+            while not stop.wait(PRESENCE_FLUSH_SECS):
+                # exit and let the supervisor restart us
+                if not network.is_alive():
+                    raise CommandError("MQTT network thread has exited")
+                _logged(self._catch_up.check_idle)()
+                _logged(self._presence.flush)()
+                _logged(self._alerts.flush)()
+                if time.monotonic() - last_rules_reload >= \
+                        settings.ALERT_RULES_RELOAD_SECS:
+                    last_rules_reload = time.monotonic()
+                    _logged(self._alerts.reload)()
+                if time.monotonic() - last_expiry_check >= \
+                        WATCH_EXPIRY_CHECK_SECS:
+                    last_expiry_check = time.monotonic()
+                    _logged(self._expire_watched_devices)()
+                if settings.READING_CHUNKS_ENABLED and \
+                        not self._catch_up.active and \
+                        time.monotonic() - last_compaction >= \
+                        settings.READING_COMPACT_INTERVAL_SECS:
+                    last_compaction = time.monotonic()
+                    _logged(self._compact_readings)()
+        finally:
+            self.client.disconnect()
+            network.join(timeout=5)
 
+    def _compact_readings(self):
+        start = time.monotonic()
+        readings, chunks = compact_readings()
+        if readings:
+            print("Compacted {} readings into {} chunks in {:.1f} s".format(
+                readings, chunks, time.monotonic() - start))
+
+    def _expire_watched_devices(self):
+        # drop devices back to the background rate once their lease ends
+        expired = Lampi.objects.filter(watched_until__lt=timezone.now())
+        msgs = []
+        for device in expired.only('device_id'):
+            print("No longer watched: {}".format(device.device_id))
+            msgs.append(device.sample_rate_msg(
+                settings.SAMPLE_PERIOD_BACKGROUND))
+        expired.update(watched_until=None)
+        get_publisher().publish_many(msgs)
+
+    @_logged
     def _device_broker_status_change(self, client, userdata, message):
-        print("RECV: '{}' on '{}'".format(message.payload, message.topic))
+        # runs for every bridge in a reconnect storm: memory only, the
+        # presence table and association messages are batched in flush()
+        device_id = broker_device_id(message.topic)
+        if device_id is None:
+            return
         # message payload has to treated as type "bytes" in Python 3
-        if message.payload == b'1':
-            # broker connected
-            results = re.search(MQTT_BROKER_RE_PATTERN, message.topic.lower())
-            device_id = results.group('device_id')
-            try:
-                device = Lampi.objects.get(device_id=device_id)
-                print("Found {}".format(device))
-            except Lampi.DoesNotExist:
-                # this is a new device - create new record for it
-                new_device = Lampi(device_id=device_id)
-                uname = settings.DEFAULT_USER
-                new_device.user = User.objects.get(username=uname)
-                new_device.save()
-                print("Created {}".format(new_device))
-                # send association MQTT message
-                new_device.publish_unassociated_msg()
+        self._presence.connection_changed(device_id, message.payload == b'1')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clean-session', action='store_true',
+                            help='Do not keep a broker session; readings '
+                                 'published while the daemon is down are '
+                                 'lost')
 
     def handle(self, *args, **options):
+        self._latency = {}
+        self._latency_window_start = time.time()
+        self._presence = PresenceTracker()
+        self._alerts = AlertEngine()
+        self._catch_up = CatchUp(self._presence,
+                                 on_stored=self._evaluate_alerts)
         self._create_default_user_if_needed()
-        self._create_mqtt_client_and_loop_forever()
+        self._create_mqtt_client_and_loop_forever(options['clean_session'])
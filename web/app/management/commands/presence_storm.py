@@ -0,0 +1,101 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from paho.mqtt.client import MQTTMessage
+
+from app.presence import (PresenceTracker, publish_many,
+                          PRESENCE_FLUSH_SECS)
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _status_message(device_id, online):
+    message = MQTTMessage(
+        topic='$SYS/broker/connection/{}_broker/state'.format(
+            device_id).encode('utf-8'))
+    message.payload = b'1' if online else b'0'
+    return message
+
+
+class Command(BaseCommand):
+    help = ('Simulate every bridge reconnecting at once and report how long '
+            'the daemon callback thread is busy and how long flushes take')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=5000)
+        parser.add_argument('--flaps', type=int, default=1,
+                            help='Offline/online cycles per device '
+                                 '(default: 1)')
+        parser.add_argument('--publish', action='store_true',
+                            help='Send association messages to the broker '
+                                 'as well as counting them')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the simulated devices instead of '
+                                 'rolling them back')
+
+    def handle(self, *args, **options):
+        published = []
+
+        def publish(msgs):
+            published.extend(msgs)
+            if options['publish']:
+                publish_many(msgs)
+
+        tracker = PresenceTracker(publish_many=publish)
+        # same code path as the daemon's $SYS callback
+        from importlib import import_module
+        daemon = import_module('app.management.commands.mqtt-daemon')
+        command = daemon.Command()
+        command._presence = tracker
+
+        device_ids = ['{:012x}'.format(0xfe0000000000 + i)
+                      for i in range(options['devices'])]
+        messages = []
+        for _ in range(options['flaps']):
+            messages += [_status_message(d, False) for d in device_ids]
+            messages += [_status_message(d, True) for d in device_ids]
+
+        callback_secs = []
+
+        def storm():
+            for message in messages:
+                start = time.perf_counter()
+                command._device_broker_status_change(None, None, message)
+                callback_secs.append(time.perf_counter() - start)
+
+        try:
+            with transaction.atomic():
+                command._create_default_user_if_needed()
+                storm_thread = threading.Thread(target=storm)
+                start = time.perf_counter()
+                storm_thread.start()
+                flush_secs = []
+                while storm_thread.is_alive():
+                    storm_thread.join(PRESENCE_FLUSH_SECS)
+                    tracker.flush()
+                    flush_secs.append(tracker.last_flush_secs)
+                tracker.flush()
+                flush_secs.append(tracker.last_flush_secs)
+                total = time.perf_counter() - start
+                if not options['keep']:
+                    raise _Rollback()
+        except _Rollback:
+            pass
+
+        callback_secs.sort()
+        n = len(callback_secs)
+        self.stdout.write("{} status messages from {} devices in {:.2f} s"
+                          .format(n, len(device_ids), total))
+        self.stdout.write("callback p50 {:.1f} us, p99 {:.1f} us, "
+                          "max {:.1f} us".format(
+                              callback_secs[n // 2] * 1e6,
+                              callback_secs[int(n * 0.99)] * 1e6,
+                              callback_secs[-1] * 1e6))
+        self.stdout.write("{} flushes, slowest {:.1f} ms, {} association "
+                          "messages".format(tracker.flushes,
+                                            max(flush_secs) * 1000,
+                                            len(published)))
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_sensorreading_altitude'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HopLatencyHistogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.CharField(max_length=64)),
+                ('window_start', models.DateTimeField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_secs', models.FloatField(default=0)),
+                ('buckets', models.JSONField(default=dict)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_hoplatencyhistogram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceHealth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sample_rate', models.FloatField()),
+                ('expected_rate', models.FloatField()),
+                ('jitter_ms', models.FloatField(null=True)),
+                ('read_latency_ms', models.FloatField(null=True)),
+                ('queue_depth', models.PositiveIntegerField(default=0)),
+                ('reconnects', models.PositiveIntegerField(default=0)),
+                ('flush_ms', models.FloatField(null=True)),
+                ('cpu_temp', models.FloatField(null=True)),
+                ('load', models.FloatField(null=True)),
+                ('mem_free_mb', models.PositiveIntegerField(null=True)),
+                ('disk_free_mb', models.PositiveIntegerField(null=True)),
+                ('lampi', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='health_records', to='app.lampi')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['lampi', 'timestamp'], name='app_deviceh_lampi_i_e1d906_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_devicehealth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lampi',
+            name='watched_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
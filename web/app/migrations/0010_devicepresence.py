@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_lampi_watched_until'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DevicePresence',
+            fields=[
+                ('lampi', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='presence', serialize=False, to='app.lampi')),
+                ('online', models.BooleanField(default=False)),
+                ('last_seen', models.DateTimeField()),
+                ('last_change', models.DateTimeField()),
+            ],
+        ),
+    ]
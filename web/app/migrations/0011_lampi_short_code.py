@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_short_codes(apps, schema_editor):
+    # parked devices keep the code they are already showing; if two share a
+    # prefix only the first gets it, and the daemon issues the other a new
+    # code the next time it connects
+    Lampi = apps.get_model('app', 'Lampi')
+    taken = set()
+    parked = Lampi.objects.filter(user__username=settings.DEFAULT_USER)
+    for device in parked.order_by('created_at'):
+        code = device.association_code[:6]
+        if code not in taken:
+            taken.add(code)
+            device.short_code = code
+            device.save(update_fields=['short_code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_devicepresence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lampi',
+            name='short_code',
+            field=models.CharField(blank=True, max_length=6, null=True, unique=True),
+        ),
+        migrations.RunPython(populate_short_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_sensorreading_capture_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk_start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='sensorreading',
+            index=models.Index(fields=['lampi', 'timestamp'], name='app_sensorr_lampi_i_a72fb2_idx'),
+        ),
+        migrations.AddField(
+            model_name='readingchunk',
+            name='lampi',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='reading_chunks', to='app.lampi'),
+        ),
+        migrations.AddConstraint(
+            model_name='readingchunk',
+            constraint=models.UniqueConstraint(fields=('lampi', 'chunk_start'), name='unique_reading_chunk'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_readingchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readingchunk',
+            name='rollup',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
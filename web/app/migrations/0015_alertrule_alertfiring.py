@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_readingchunk_rollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(choices=[('pressure', 'Pressure'), ('temperature', 'Temperature'), ('humidity', 'Humidity'), ('altitude', 'Altitude'), ('pm25', 'PM2.5'), ('pm10', 'PM10')], max_length=16)),
+                ('condition', models.CharField(choices=[('above', 'above'), ('below', 'below'), ('rising', 'rising faster than (per hour)'), ('falling', 'falling faster than (per hour)')], max_length=8)),
+                ('threshold', models.FloatField()),
+                ('duration_secs', models.PositiveIntegerField(default=0)),
+                ('rate_window_secs', models.PositiveIntegerField(default=900)),
+                ('sink', models.CharField(default='mqtt', max_length=16)),
+                ('enabled', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('lampi', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to='app.lampi')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AlertFiring',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fired_at', models.DateTimeField()),
+                ('value', models.FloatField()),
+                ('notified', models.BooleanField(default=False)),
+                ('lampi', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_firings', to='app.lampi')),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='firings', to='app.alertrule')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['lampi', 'fired_at'], name='app_alertfi_lampi_i_2d384d_idx')],
+            },
+        ),
+    ]
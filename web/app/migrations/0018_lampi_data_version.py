@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_readingimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lampi',
+            name='data_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lampi',
+            name='data_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
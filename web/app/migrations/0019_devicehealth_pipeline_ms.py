@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_lampi_data_version'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='devicehealth',
+            old_name='read_latency_ms',
+            new_name='pipeline_ms',
+        ),
+        migrations.AddField(
+            model_name='devicehealth',
+            name='pm_bad_frames',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='devicehealth',
+            name='pm_good_frames',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='devicehealth',
+            name='read_ms',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_devicehealth_pipeline_ms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertrule',
+            name='cooldown_secs',
+            field=models.PositiveIntegerField(default=900),
+        ),
+    ]
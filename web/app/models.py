@@ -1,16 +1,37 @@
 from django.db import models
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.contrib.auth import get_user_model
-import paho.mqtt.publish
+from app.mqtt_publisher import get_publisher
 from uuid import uuid4
 import json
 
 DEFAULT_USER = 'parked_device_user'
 
+# devices show the first SHORT_CODE_LENGTH characters of their association
+# code; parked devices keep them in Lampi.short_code, unique and indexed
+SHORT_CODE_LENGTH = 6
+
+_parked_user_id = None
+# lease ends Lampi.mark_watched last wrote or read, per process
+_watch_leases = {}
+
+
 def get_parked_user():
     return get_user_model().objects.get_or_create(username=DEFAULT_USER)[0]
 
 
+def parked_user_id():
+    # the parked user is never deleted, so its id is cached per process
+    global _parked_user_id
+    if _parked_user_id is None:
+        _parked_user_id = get_parked_user().pk
+    return _parked_user_id
+
+
 def generate_association_code():
     return uuid4().hex
 
@@ -22,7 +43,17 @@ class Lampi(models.Model):
                              on_delete=models.SET(get_parked_user))
     association_code = models.CharField(max_length=32, unique=True,
                                         default=generate_association_code)
+    # association_code[:SHORT_CODE_LENGTH] while the device is parked, so
+    # AddLampiForm can look it up by index; cleared once associated
+    short_code = models.CharField(max_length=SHORT_CODE_LENGTH, unique=True,
+                                  null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # while in the future someone is looking at live data for this device
+    watched_until = models.DateTimeField(null=True, blank=True)
+    # bumped whenever the device's readings are added to or rewritten, for
+    # app.conditional's ETag and Last-Modified
+    data_version = models.PositiveBigIntegerField(default=0)
+    data_changed_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return "{}: {}".format(self.device_id, self.name)
@@ -30,39 +61,132 @@ class Lampi(models.Model):
     def _generate_device_association_topic(self):
         return 'devices/{}/lamp/associated'.format(self.device_id)
 
+    def _generate_device_sample_rate_topic(self):
+        return 'devices/{}/lamp/sample_rate'.format(self.device_id)
+
+    @classmethod
+    def issue_association_codes(cls, devices):
+        """Give each device a fresh association code whose short code no
+        parked device is using.  Does not save the devices."""
+        pending = list(devices)
+        taken = set()
+        while pending:
+            for device in pending:
+                device.association_code = generate_association_code()
+                device.short_code = \
+                    device.association_code[:SHORT_CODE_LENGTH]
+            codes = [device.short_code for device in pending]
+            taken.update(cls.objects.filter(short_code__in=codes)
+                         .values_list('short_code', flat=True))
+            # regenerate codes that are in use or repeated within the batch
+            retry = []
+            for device in pending:
+                if device.short_code in taken:
+                    retry.append(device)
+                else:
+                    taken.add(device.short_code)
+            pending = retry
+
+    @classmethod
+    def mark_watched(cls, devices, device_id):
+        """Extend the watch lease of ``device_id`` if it is one of
+        ``devices`` (the viewer's own), switching it to the fast rate if
+        nobody was watching it.
+
+        Pages poll this every second, so it reads before it writes and
+        only writes when the lease starts or is half used up; in between,
+        the lease end this process last saw answers without a query.
+        """
+        now = timezone.now()
+        lease = timezone.timedelta(seconds=settings.WATCH_LEASE_SECS)
+        known_until = _watch_leases.get(device_id)
+        if known_until is not None and known_until > now + lease / 2:
+            return
+        row = devices.filter(device_id=device_id) \
+            .values_list('device_id', 'watched_until').first()
+        if row is None:
+            return
+        watched_until = row[1]
+        if watched_until is not None and watched_until >= now + lease / 2:
+            _watch_leases[device_id] = watched_until
+            return
+        rows = cls.objects.filter(device_id=device_id)
+        if watched_until is None or watched_until < now:
+            # the filter makes sure one request starts the watch
+            started = rows.filter(
+                Q(watched_until__isnull=True) | Q(watched_until__lt=now)
+            ).update(watched_until=now + lease)
+            if started:
+                cls(device_id=device_id).publish_sample_rate_msg(
+                    settings.SAMPLE_PERIOD_WATCHED)
+        else:
+            rows.update(watched_until=now + lease)
+        _watch_leases[device_id] = now + lease
+
+    @classmethod
+    def readings_changed(cls, device_ids):
+        """Bump the data version of ``device_ids``.  Call it in the same
+        transaction as the change, or after it, never before: a page
+        rendered in between would be cached under the new version."""
+        now = timezone.now()
+        # Last-Modified must not go back if the clock does
+        cls.objects.filter(device_id__in=device_ids).update(
+            data_version=F('data_version') + 1,
+            data_changed_at=Greatest(Coalesce('data_changed_at', Value(now)),
+                                     Value(now)))
+
+    def sample_rate_msg(self, period):
+        return {'topic': self._generate_device_sample_rate_topic(),
+                'payload': json.dumps({'period': period}),
+                'qos': 1,
+                'retain': True}
+
+    def publish_sample_rate_msg(self, period):
+        return get_publisher().publish_many([self.sample_rate_msg(period)])[0]
+
+    def unassociated_msg(self):
+        return {'topic': self._generate_device_association_topic(),
+                'payload': json.dumps({'associated': False,
+                                       'code': self.association_code}),
+                'qos': 2,
+                'retain': True}
+
     def publish_unassociated_msg(self):
-        # send association MQTT message
-        assoc_msg = {}
-        assoc_msg['associated'] = False
-        assoc_msg['code'] = self.association_code
-        paho.mqtt.publish.single(
-            self._generate_device_association_topic(),
-            json.dumps(assoc_msg),
-            qos=2,
-            retain=True,
-            hostname="localhost",
-            port=50001,
-            )
+        return get_publisher().publish_many([self.unassociated_msg()])[0]
 
     def associate_and_publish_associated_msg(self,  user):
-        # update Lampi instance with new user
+        # update Lampi instance with new user; the short code is free again
         self.user = user
+        self.short_code = None
         self.save()
-        # publish associated message
-        assoc_msg = {}
-        assoc_msg['associated'] = True
-        paho.mqtt.publish.single(
+        # publish associated message; the broker confirms it later
+        return get_publisher().publish(
             self._generate_device_association_topic(),
-            json.dumps(assoc_msg),
+            json.dumps({'associated': True}),
             qos=2,
-            retain=True,
-            hostname="localhost",
-            port=50001,
-            )
-        
-        
+            retain=True)
+
+
+class DevicePresence(models.Model):
+    # bridge connection state per device, maintained by the mqtt-daemon
+    lampi = models.OneToOneField(
+        Lampi,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='presence'
+    )
+    online = models.BooleanField(default=False)
+    last_seen = models.DateTimeField()
+    last_change = models.DateTimeField()
+
+    def __str__(self):
+        return "{}: {}".format(self.lampi_id,
+                               "online" if self.online else "offline")
+
+
 class SensorReading(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # capture time when the device sent one, so queued readings keep theirs
+    timestamp = models.DateTimeField(default=timezone.now)
     pressure = models.FloatField()
     temperature = models.FloatField()
     humidity = models.FloatField()
@@ -73,4 +197,219 @@ class SensorReading(models.Model):
         Lampi,
         on_delete=models.CASCADE,
         related_name='sensor_readings'
-    )
\ No newline at end of file
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=['lampi', 'timestamp'])]
+
+
+class ReadingChunk(models.Model):
+    # an hour of one device's readings packed by app.timeseries; rows are
+    # compacted into these once their hour is over
+    lampi = models.ForeignKey(
+        Lampi,
+        on_delete=models.CASCADE,
+        related_name='reading_chunks',
+        # covered by the (lampi, chunk_start) constraint
+        db_index=False
+    )
+    chunk_start = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    # per-minute counts and sums for resampling long ranges without decoding
+    # ``data``; null for chunks written before it was added
+    rollup = models.BinaryField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['lampi', 'chunk_start'],
+                                    name='unique_reading_chunk'),
+        ]
+
+    def __str__(self):
+        return "{} @ {}: {} readings".format(self.lampi_id, self.chunk_start,
+                                             self.count)
+
+
+class HopLatencyHistogram(models.Model):
+    # one row per trace segment per flush window, written by the mqtt-daemon
+    segment = models.CharField(max_length=64)
+    window_start = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+    total_secs = models.FloatField(default=0)
+    # sparse {bucket index: count}, see app.latency
+    buckets = models.JSONField(default=dict)
+
+    def __str__(self):
+        return "{} @ {}: {} samples".format(self.segment, self.window_start,
+                                             self.count)
+
+
+class DeviceHealth(models.Model):
+    # periodic health record published by each device (lampi/telemetry);
+    # optional fields are null when the device could not measure them
+    lampi = models.ForeignKey(
+        Lampi,
+        on_delete=models.CASCADE,
+        related_name='health_records'
+    )
+    timestamp = models.DateTimeField(default=timezone.now)
+    sample_rate = models.FloatField()
+    expected_rate = models.FloatField()
+    jitter_ms = models.FloatField(null=True)
+    # capture to air_quality_service; the sensor read itself is read_ms
+    pipeline_ms = models.FloatField(null=True)
+    read_ms = models.FloatField(null=True)
+    pm_good_frames = models.PositiveIntegerField(null=True)
+    pm_bad_frames = models.PositiveIntegerField(null=True)
+    queue_depth = models.PositiveIntegerField(default=0)
+    reconnects = models.PositiveIntegerField(default=0)
+    flush_ms = models.FloatField(null=True)
+    cpu_temp = models.FloatField(null=True)
+    load = models.FloatField(null=True)
+    mem_free_mb = models.PositiveIntegerField(null=True)
+    disk_free_mb = models.PositiveIntegerField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['lampi', 'timestamp'])]
+
+    @classmethod
+    def from_record(cls, lampi, record):
+        return cls(
+            lampi=lampi,
+            sample_rate=record.get('rate', 0.0),
+            expected_rate=record.get('expected_rate', 0.0),
+            jitter_ms=record.get('jitter_ms'),
+            pipeline_ms=record.get('pipeline_ms'),
+            read_ms=record.get('read_ms'),
+            pm_good_frames=record.get('pm_good_frames'),
+            pm_bad_frames=record.get('pm_bad_frames'),
+            queue_depth=record.get('queue', 0),
+            reconnects=record.get('reconnects', 0),
+            flush_ms=record.get('flush_ms'),
+            cpu_temp=record.get('cpu_temp'),
+            load=record.get('load'),
+            mem_free_mb=record.get('mem_mb'),
+            disk_free_mb=record.get('disk_mb'),
+        )
+
+
+class AlertRule(models.Model):
+    # evaluated on ingest by app.alerts.AlertEngine in the mqtt-daemon
+    ABOVE = 'above'
+    BELOW = 'below'
+    RISING = 'rising'
+    FALLING = 'falling'
+    CONDITIONS = [
+        (ABOVE, 'above'),
+        (BELOW, 'below'),
+        (RISING, 'rising faster than (per hour)'),
+        (FALLING, 'falling faster than (per hour)'),
+    ]
+    METRICS = [
+        ('pressure', 'Pressure'),
+        ('temperature', 'Temperature'),
+        ('humidity', 'Humidity'),
+        ('altitude', 'Altitude'),
+        ('pm25', 'PM2.5'),
+        ('pm10', 'PM10'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='alert_rules')
+    # null: every device the user owns
+    lampi = models.ForeignKey(Lampi, on_delete=models.CASCADE, null=True,
+                              blank=True, related_name='alert_rules')
+    metric = models.CharField(max_length=16, choices=METRICS)
+    condition = models.CharField(max_length=8, choices=CONDITIONS)
+    threshold = models.FloatField()
+    # the condition must hold this long before the rule fires
+    duration_secs = models.PositiveIntegerField(default=0)
+    # smoothing time constant of the rate for rising/falling rules
+    rate_window_secs = models.PositiveIntegerField(default=900)
+    # after firing, the rule stays quiet this long even if the condition
+    # clears and holds again, so a value hovering at the threshold does
+    # not send a stream of alerts
+    cooldown_secs = models.PositiveIntegerField(default=900)
+    # a key of settings.ALERT_SINKS
+    sink = models.CharField(max_length=16, default='mqtt')
+    enabled = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} {} {} for {} s ({})".format(
+            self.get_metric_display(), self.get_condition_display(),
+            self.threshold, self.duration_secs,
+            self.lampi_id or "all devices")
+
+
+class AlertFiring(models.Model):
+    rule = models.ForeignKey(AlertRule, on_delete=models.CASCADE,
+                             related_name='firings')
+    lampi = models.ForeignKey(Lampi, on_delete=models.CASCADE,
+                              related_name='alert_firings')
+    # capture time of the reading that fired the rule
+    fired_at = models.DateTimeField()
+    # the reading, or the rate per hour for rising/falling rules
+    value = models.FloatField()
+    notified = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['lampi', 'fired_at'])]
+
+    def __str__(self):
+        return "{}: {} is {:.1f} ({})".format(
+            self.lampi_id, self.rule.get_metric_display(), self.value,
+            self.rule)
+
+    def as_dict(self):
+        return {
+            'device_id': self.lampi_id,
+            'rule': self.rule_id,
+            'metric': self.rule.metric,
+            'condition': self.rule.condition,
+            'threshold': self.rule.threshold,
+            'value': self.value,
+            'fired_at': self.fired_at.timestamp(),
+        }
+
+
+class SlowRequest(models.Model):
+    # requests over REQUEST_PROFILE_THRESHOLD_MS, saved by app.profiling
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=8)
+    path = models.CharField(max_length=255)
+    view_name = models.CharField(max_length=100, blank=True)
+    # the query string, as lists of values
+    params = models.JSONField(default=dict)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    sql_count = models.PositiveIntegerField()
+    sql_ms = models.FloatField()
+    # executions that repeated an earlier query with the same parameters,
+    # and [[count, sql], ...] for the most repeated
+    duplicate_queries = models.PositiveIntegerField(default=0)
+    duplicates = models.JSONField(default=list)
+    # collapsed stacks sampled after the threshold passed, if any
+    profile_path = models.CharField(max_length=255, blank=True)
+    samples = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "{} {} ({:.0f} ms)".format(self.method, self.path,
+                                          self.duration_ms)
+
+
+class ReadingImport(models.Model):
+    # progress of manage.py import_readings per source file; saved in the
+    # transaction of each batch, so a restarted import resumes exactly
+    # after the last committed one
+    source = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    records = models.BigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{}: {} records{}".format(self.source, self.records,
+                                         ", finished" if self.finished
+                                         else "")
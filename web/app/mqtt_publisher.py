@@ -0,0 +1,119 @@
+import os
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN, \
+    error_string
+
+
+class PublishError(Exception):
+    pass
+
+
+class MQTTPublisher:
+    """One long-lived broker connection for everything a process publishes.
+
+    ``publish`` never waits for the broker: it hands the message to paho,
+    whose network thread sends it, and returns a ``Future`` that completes
+    when the broker acknowledges it.  Messages published while the
+    connection is down stay in paho's outbound queue and are sent after
+    it reconnects.
+    """
+
+    def __init__(self, host=None, port=None, max_queued=None):
+        self._host = host or settings.MQTT_BROKER_HOST
+        self._port = port or settings.MQTT_BROKER_PORT
+        self._max_queued = max_queued or settings.MQTT_PUBLISH_QUEUE_MAX
+        self._lock = threading.RLock()
+        self._client = None
+        # mid -> Future, until the broker acknowledges the message
+        self._pending = {}
+
+    def _connect(self):
+        client = Client()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        client.max_queued_messages_set(self._max_queued)
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        # returns straight away, the network thread connects and reconnects
+        client.connect_async(self._host, port=self._port)
+        client.loop_start()
+        return client
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print("Publisher connection refused: {}".format(rc))
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            print("Publisher lost broker connection, {} messages pending"
+                  .format(len(self._pending)))
+
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            future = self._pending.pop(mid, None)
+        if future is not None:
+            future.set_result(mid)
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        future = Future()
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+            info = self._client.publish(topic, payload, qos=qos,
+                                        retain=retain)
+            # NO_CONN just means queued until the connection is back
+            if info.rc not in (MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN) or \
+                    (qos == 0 and info.rc == MQTT_ERR_NO_CONN):
+                future.set_exception(PublishError(
+                    "{}: {}".format(topic, error_string(info.rc))))
+            else:
+                self._pending[info.mid] = future
+        return future
+
+    def publish_many(self, msgs):
+        """Publish a batch of ``{'topic', 'payload', 'qos', 'retain'}``
+        dicts; returns one future per message."""
+        return [self.publish(msg['topic'], msg.get('payload'),
+                             qos=msg.get('qos', 1),
+                             retain=msg.get('retain', False))
+                for msg in msgs]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.disconnect()
+                self._client.loop_stop()
+                self._client = None
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """The process-wide publisher; a forked worker gets its own."""
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = MQTTPublisher()
+            _publisher_pid = os.getpid()
+        return _publisher
+
+
+def log_delivery(description):
+    """Done-callback for a publish future that reports the outcome."""
+    def callback(future):
+        if future.exception() is not None:
+            print("Failed to deliver {}: {}".format(description,
+                                                   future.exception()))
+        else:
+            print("Delivered {}".format(description))
+    return callback
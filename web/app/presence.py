@@ -0,0 +1,161 @@
+import threading
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from app.models import Lampi, DevicePresence, parked_user_id
+from app.mqtt_publisher import get_publisher
+
+# how often pending presence changes are written out
+PRESENCE_FLUSH_SECS = 1.0
+# last-seen times of devices whose state did not change are only written
+# this often, so steady sensor traffic costs one upsert per device per minute
+LAST_SEEN_FLUSH_SECS = 60.0
+
+
+def broker_device_id(topic):
+    """Device id from '$SYS/broker/connection/<device id>_broker/state'."""
+    parts = topic.split('/')
+    if len(parts) != 5 or not parts[3].endswith('_broker'):
+        return None
+    return parts[3][:-len('_broker')].lower()
+
+
+def publish_many(msgs):
+    return get_publisher().publish_many(msgs)
+
+
+class PresenceTracker:
+    """Online/offline state and last-seen time per device.
+
+    ``connection_changed`` and ``seen`` are called from MQTT callbacks and
+    only touch memory; ``flush`` is called periodically from another thread
+    and turns everything that changed since the previous flush into a few
+    bulk queries and one batch of association messages, however many
+    bridges reconnected in between.
+    """
+
+    def __init__(self, publish_many=publish_many):
+        self._publish_many = publish_many
+        self._lock = threading.Lock()
+        # device id -> [online, last seen, last change]
+        self._devices = {}
+        self._changed = set()
+        self._seen = set()
+        self._last_seen_flush = time.monotonic()
+        self.flushes = 0
+        self.last_flush_secs = 0.0
+
+    def connection_changed(self, device_id, online, now=None):
+        now = now or timezone.now()
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                self._devices[device_id] = [online, now, now]
+                self._changed.add(device_id)
+            else:
+                if state[0] != online:
+                    state[0] = online
+                    state[2] = now
+                    self._changed.add(device_id)
+                state[1] = now
+                self._seen.add(device_id)
+
+    def seen(self, device_id, now=None):
+        now = now or timezone.now()
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                # traffic from a device whose bridge state we missed
+                self._devices[device_id] = [True, now, now]
+                self._changed.add(device_id)
+            else:
+                state[1] = now
+                self._seen.add(device_id)
+
+    def is_online(self, device_id):
+        with self._lock:
+            state = self._devices.get(device_id)
+            return bool(state and state[0])
+
+    def _take_pending(self):
+        with self._lock:
+            pending = set(self._changed)
+            self._changed.clear()
+            if time.monotonic() - self._last_seen_flush >= \
+                    LAST_SEEN_FLUSH_SECS:
+                pending |= self._seen
+                self._seen.clear()
+                self._last_seen_flush = time.monotonic()
+            else:
+                self._seen -= pending
+            return {device_id: tuple(self._devices[device_id])
+                    for device_id in pending}
+
+    def _requeue(self, pending):
+        # the states in _devices are at least as new as the ones taken
+        with self._lock:
+            self._changed.update(pending)
+
+    def flush(self):
+        pending = self._take_pending()
+        if not pending:
+            return
+        start = time.monotonic()
+        try:
+            new_devices, reissued = self._write(pending)
+        except Exception:
+            # try these again next time rather than lose them
+            self._requeue(pending)
+            raise
+        if new_devices:
+            print("Created {} new devices".format(len(new_devices)))
+        if reissued:
+            print("Issued new association codes to {} devices".format(
+                len(reissued)))
+        if new_devices or reissued:
+            # retained, so a device that is already gone sees it next time
+            self._publish_many([device.unassociated_msg()
+                                for device in new_devices + reissued])
+        self.flushes += 1
+        self.last_flush_secs = time.monotonic() - start
+
+    def _write(self, pending):
+        # looked up each time, so devices added or deleted in the admin
+        # since the last flush are neither missed nor upserted into
+        known = set(Lampi.objects.filter(device_id__in=pending)
+                    .values_list('device_id', flat=True))
+        new_ids = [device_id for device_id, (online, _, _) in pending.items()
+                   if online and device_id not in known]
+        online_ids = [device_id for device_id, (online, _, _)
+                      in pending.items() if online and device_id in known]
+        new_devices = []
+        reissued = []
+        with transaction.atomic():
+            if online_ids:
+                # parked devices without a short code (their owner was
+                # deleted, or theirs collided) get a fresh association code
+                reissued = list(Lampi.objects.filter(
+                    device_id__in=online_ids, user_id=parked_user_id(),
+                    short_code__isnull=True))
+                if reissued:
+                    Lampi.issue_association_codes(reissued)
+                    Lampi.objects.bulk_update(
+                        reissued, ['association_code', 'short_code'])
+            if new_ids:
+                new_devices = [Lampi(device_id=device_id,
+                                     user_id=parked_user_id())
+                               for device_id in new_ids]
+                Lampi.issue_association_codes(new_devices)
+                Lampi.objects.bulk_create(new_devices)
+                known.update(new_ids)
+            rows = [DevicePresence(lampi_id=device_id, online=online,
+                                   last_seen=last_seen,
+                                   last_change=last_change)
+                    for device_id, (online, last_seen, last_change)
+                    in pending.items() if device_id in known]
+            DevicePresence.objects.bulk_create(
+                rows, update_conflicts=True, unique_fields=['lampi'],
+                update_fields=['online', 'last_seen', 'last_change'])
+        return new_devices, reissued
@@ -0,0 +1,210 @@
+"""Opt-in per-request SQL accounting and slow-request profiling.
+
+With REQUEST_PROFILING set, every request counts its SQL queries, their
+total time, and executions that repeat an earlier query exactly (same SQL,
+same parameters).  The totals go out in a Server-Timing header.  Query time
+is time spent in ``execute``; fetching a large result happens afterwards
+and shows up in the profile instead.
+
+One sampler thread per process watches the requests in flight.  Once a
+request has run for REQUEST_PROFILE_THRESHOLD_MS it samples that request's
+stack every REQUEST_PROFILE_INTERVAL_MS until it finishes; until then it
+sleeps, so a request under the threshold costs a dict entry and the query
+wrapper.  Requests that end over the threshold are saved as SlowRequest
+rows, and their samples written to REQUEST_PROFILE_DIR in collapsed-stack
+format (``frame;frame;... count`` per line, as read by flamegraph.pl and
+speedscope).
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
+
+from app.models import SlowRequest
+
+# most repeated queries kept per slow request
+DUPLICATES_KEPT = 10
+
+
+class RequestStats:
+    """Per-request query totals; also the connection's execute wrapper."""
+
+    __slots__ = ('started', 'queries', 'sql_secs', 'statements', 'samples')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_secs = 0.0
+        self.statements = Counter()
+        self.samples = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_secs += time.perf_counter() - start
+            self.queries += 1
+            if not many:
+                self.statements[sql, repr(params)] += 1
+
+    @property
+    def duplicates(self):
+        """``[(count, sql), ...]`` for queries run more than once."""
+        return sorted(((count, sql) for (sql, _), count
+                       in self.statements.items() if count > 1),
+                      reverse=True)
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{} ({}:{})".format(code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Sampler(threading.Thread):
+    def __init__(self, threshold, interval):
+        super().__init__(name='request-profiler', daemon=True)
+        self._threshold = threshold
+        self._interval = interval
+        # {thread id: RequestStats} for requests in flight; the lock also
+        # covers their samples, so once remove() returns a request's
+        # samples are its own to read
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def add(self, stats):
+        with self._lock:
+            self._active[threading.get_ident()] = stats
+        self._wake.set()
+
+    def remove(self):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            now = time.perf_counter()
+            due = min(stats.started for _, stats in active) + \
+                self._threshold - now
+            if due > 0:
+                # nothing is slow yet
+                time.sleep(max(due, self._interval))
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stats in active:
+                    frame = frames.get(thread_id)
+                    if frame is None or \
+                            now - stats.started < self._threshold or \
+                            self._active.get(thread_id) is not stats:
+                        continue
+                    if stats.samples is None:
+                        stats.samples = Counter()
+                    stats.samples[_collapse(frame)] += 1
+            del frames
+            time.sleep(self._interval)
+
+
+_sampler = None
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    # threads do not survive a fork, so each worker starts its own
+    global _sampler, _sampler_pid
+    if _sampler is not None and _sampler_pid == os.getpid():
+        return _sampler
+    with _sampler_lock:
+        if _sampler is None or _sampler_pid != os.getpid():
+            sampler = Sampler(settings.REQUEST_PROFILE_THRESHOLD_MS / 1000,
+                              settings.REQUEST_PROFILE_INTERVAL_MS / 1000)
+            sampler.start()
+            _sampler, _sampler_pid = sampler, os.getpid()
+        return _sampler
+
+
+class RequestProfilingMiddleware:
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = settings.REQUEST_PROFILE_THRESHOLD_MS / 1000
+
+    def __call__(self, request):
+        sampler = get_sampler()
+        stats = RequestStats()
+        sampler.add(stats)
+        try:
+            with connection.execute_wrapper(stats):
+                response = self.get_response(request)
+        finally:
+            sampler.remove()
+        elapsed = time.perf_counter() - stats.started
+
+        response.headers['Server-Timing'] = \
+            'db;dur={:.1f};desc="{} queries", total;dur={:.1f}'.format(
+                stats.sql_secs * 1000, stats.queries, elapsed * 1000)
+        if elapsed >= self.threshold:
+            self._record(request, response, stats, elapsed)
+        return response
+
+    def _record(self, request, response, stats, elapsed):
+        match = request.resolver_match
+        view_name = match.view_name if match else ''
+        duplicates = stats.duplicates
+        profile_path = ''
+        samples = sum(stats.samples.values()) if stats.samples else 0
+        if samples:
+            os.makedirs(settings.REQUEST_PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(
+                settings.REQUEST_PROFILE_DIR, "{}-{}-{}.txt".format(
+                    timezone.now().strftime('%Y%m%dT%H%M%S%f'),
+                    view_name.replace(':', '-') or 'unresolved',
+                    os.getpid()))
+            with open(profile_path, 'w') as f:
+                for stack, count in stats.samples.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        SlowRequest.objects.create(
+            method=request.method,
+            path=request.path[:255],
+            view_name=view_name,
+            params={key: values for key, values in request.GET.lists()},
+            status_code=response.status_code,
+            duration_ms=elapsed * 1000,
+            sql_count=stats.queries,
+            sql_ms=stats.sql_secs * 1000,
+            duplicate_queries=sum(count - 1 for count, _ in duplicates),
+            duplicates=duplicates[:DUPLICATES_KEPT],
+            profile_path=profile_path,
+            samples=samples,
+        )
+
+
+def hottest_functions(profile_path, limit=15):
+    """``[(samples, frame), ...]`` for the frames most often on top of the
+    stack in a saved profile."""
+    leaves = Counter()
+    with open(profile_path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            leaves[stack.rpartition(';')[2]] += int(count)
+    return [(count, frame) for frame, count in leaves.most_common(limit)]
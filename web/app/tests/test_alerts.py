@@ -0,0 +1,94 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from app.alerts import AlertEngine
+from app.models import AlertFiring, AlertRule, Lampi, SensorReading
+
+T0 = datetime.datetime(2026, 3, 1, 10, tzinfo=datetime.timezone.utc)
+
+
+class AlertEngineTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='owner')
+        self.device = Lampi.objects.create(device_id='b827eb000001',
+                                           user=user)
+        self.rule = AlertRule.objects.create(
+            user=user, lampi=self.device, metric='pm25',
+            condition=AlertRule.ABOVE, threshold=35, duration_secs=60,
+            cooldown_secs=600)
+        self.engine = AlertEngine()
+        # sinks run on a worker thread; only the recorded firings matter here
+        self.engine._notifier = mock.Mock()
+
+    def feed(self, *samples):
+        """Feed ``(seconds after T0, pm25)`` samples; returns the seconds at
+        which the rule fired."""
+        for seconds, pm25 in samples:
+            self.engine.evaluate(SensorReading(
+                lampi=self.device, pm25=pm25,
+                timestamp=T0 + datetime.timedelta(seconds=seconds)))
+        before = set(AlertFiring.objects.values_list('pk', flat=True))
+        self.engine.flush()
+        return [(firing.fired_at - T0).total_seconds() for firing in
+                AlertFiring.objects.exclude(pk__in=before)
+                .order_by('fired_at')]
+
+    def test_fires_once_condition_has_held(self):
+        self.assertEqual(self.feed((0, 50), (30, 50), (59, 50)), [])
+        self.assertEqual(self.feed((60, 50), (90, 50), (120, 60)), [60])
+        self.assertEqual(self.engine._notifier.submit.call_count, 1)
+
+    def test_brief_excursion_does_not_fire(self):
+        self.assertEqual(self.feed((0, 50), (30, 10), (60, 50), (100, 50)),
+                         [])
+
+    def test_rearms_after_clearing_and_cooldown(self):
+        self.assertEqual(self.feed((0, 50), (60, 50)), [60])
+        # clears and holds again inside the cooldown: quiet
+        self.assertEqual(self.feed((120, 10), (180, 50), (300, 50)), [])
+        # still holding once the cooldown is over
+        self.assertEqual(self.feed((660, 50)), [660])
+        # cleared, held again after the cooldown
+        self.assertEqual(self.feed((700, 10), (1300, 50), (1360, 50)),
+                         [1360])
+
+    def test_rising_rule_uses_smoothed_rate(self):
+        rule = AlertRule.objects.create(
+            user=self.rule.user, lampi=self.device, metric='pm25',
+            condition=AlertRule.RISING, threshold=60, rate_window_secs=300,
+            cooldown_secs=0)
+        self.rule.delete()
+        self.engine.reload()
+        # one noisy jump is smoothed away
+        self.assertEqual(self.feed((0, 10), (60, 14), (120, 10)), [])
+        # a steady climb of 120 per hour fires
+        fired = self.feed(*((120 + 60 * i, 10 + 2 * i)
+                            for i in range(1, 30)))
+        self.assertEqual(len(fired), 1)
+        self.assertEqual(AlertFiring.objects.get().rule, rule)
+
+    def test_redelivered_readings_do_not_advance_state(self):
+        # a redelivery of the reading at 0 would restart the duration
+        self.assertEqual(self.feed((0, 50), (30, 10), (0, 50), (60, 50)),
+                         [])
+        self.assertEqual(self.feed((120, 50)), [120])
+
+    def test_redelivered_readings_do_not_skew_rates(self):
+        AlertRule.objects.create(
+            user=self.rule.user, lampi=self.device, metric='pm25',
+            condition=AlertRule.RISING, threshold=60, rate_window_secs=300)
+        self.engine.reload()
+        self.feed((0, 10), (60, 11))
+        rates = [state.rate for state in self.engine._states.values()]
+        self.feed((0, 10), (60, 11), (30, 90))
+        self.assertEqual(
+            [state.rate for state in self.engine._states.values()], rates)
+
+    def test_reload_drops_disabled_rules(self):
+        self.rule.enabled = False
+        self.rule.save()
+        self.engine.reload()
+        self.assertEqual(self.feed((0, 50), (60, 50)), [])
@@ -0,0 +1,62 @@
+import importlib.util
+import os
+import types
+import unittest
+
+from django.test import SimpleTestCase
+
+from app import aqi
+
+# the device's AQI engine, whose tables app.aqi mirrors
+AQI_ENGINE_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, 'lampi',
+    'aqi_engine.py')
+
+
+def _load_aqi_engine():
+    spec = importlib.util.spec_from_file_location('lampi_aqi_engine',
+                                                  AQI_ENGINE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@unittest.skipUnless(os.path.exists(AQI_ENGINE_PATH),
+                     "lampi/ is not checked out next to web/")
+class TablesMatchDeviceTest(SimpleTestCase):
+    """The web and the lamp must agree on the AQI for the same air."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.engine = _load_aqi_engine()
+
+    def test_breakpoints(self):
+        self.assertEqual(aqi.PM25_BREAKPOINTS, self.engine.PM25_BREAKPOINTS)
+        self.assertEqual(aqi.PM10_BREAKPOINTS, self.engine.PM10_BREAKPOINTS)
+
+    def test_categories(self):
+        self.assertEqual([category[:2] for category in aqi.AQI_CATEGORIES],
+                         list(self.engine.AQI_CATEGORIES))
+
+    def test_same_aqi(self):
+        for pm25 in (0, 4.5, 9.0, 9.05, 12, 35.4, 55.5, 150, 325.4, 900):
+            self.assertEqual(
+                aqi.aqi_from_concentration(pm25, aqi.PM25_BREAKPOINTS),
+                self.engine.aqi_from_concentration(
+                    pm25, self.engine.PM25_BREAKPOINTS))
+        for value in range(0, 520, 7):
+            self.assertEqual(aqi.aqi_category(value),
+                             self.engine.aqi_category(value))
+
+
+class ReadingAqiTest(SimpleTestCase):
+    def test_worse_pollutant_wins(self):
+        reading = types.SimpleNamespace(pm25=5.0, pm10=200.0)
+        self.assertEqual(aqi.reading_aqi(reading),
+                         (123, "Unhealthy for Sensitive Groups",
+                          "badge-warning"))
+
+    def test_capped_above_table(self):
+        reading = types.SimpleNamespace(pm25=1000.0, pm10=0.0)
+        self.assertEqual(aqi.reading_aqi(reading)[:2], (500, "Hazardous"))
@@ -0,0 +1,87 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from app import models
+from app.models import Lampi, SensorReading
+from app.timeseries import compact_readings
+
+READING = dict(pm25=10.0, pm10=20.0, temperature=21.0, humidity=40.0,
+               pressure=1013.0, altitude=100.0)
+
+
+@mock.patch.object(Lampi, 'publish_sample_rate_msg')
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        models._watch_leases.clear()
+        self.user = User.objects.create_user('owner', password='pw')
+        self.device = Lampi.objects.create(device_id='b827eb000001',
+                                           user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse('history') + '?device=b827eb000001'
+
+    def add_reading(self, at):
+        SensorReading.objects.create(lampi=self.device, timestamp=at,
+                                     **READING)
+        Lampi.readings_changed([self.device.device_id])
+
+    def test_unchanged_page_is_not_modified(self, publish):
+        self.add_reading(timezone.now())
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        again = self.client.get(self.url,
+                                HTTP_IF_NONE_MATCH=first.headers['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers['ETag'], first.headers['ETag'])
+
+    def test_new_reading_changes_etag(self, publish):
+        self.add_reading(timezone.now())
+        first = self.client.get(self.url)
+        self.add_reading(timezone.now())
+        again = self.client.get(self.url,
+                                HTTP_IF_NONE_MATCH=first.headers['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again.headers['ETag'], first.headers['ETag'])
+
+    def test_compaction_changes_etag(self, publish):
+        now = timezone.now()
+        for minutes in (300, 240, 180, 1):
+            self.add_reading(now - datetime.timedelta(minutes=minutes))
+        first = self.client.get(self.url)
+        self.assertEqual(compact_readings(now=now)[0], 3)
+        again = self.client.get(self.url,
+                                HTTP_IF_NONE_MATCH=first.headers['ETag'])
+        self.assertEqual(again.status_code, 200)
+
+    def test_etag_depends_on_fragment_and_query(self, publish):
+        self.add_reading(timezone.now())
+        etag = self.client.get(self.url).headers['ETag']
+        fragment = self.client.get(self.url, HTTP_HX_REQUEST='true',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(fragment.status_code, 200)
+        paged = self.client.get(self.url + '&page=2',
+                                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(paged.status_code, 200)
+
+    def test_last_modified_never_goes_back(self, publish):
+        self.add_reading(timezone.now())
+        changed_at = Lampi.objects.get(pk=self.device.pk).data_changed_at
+        past = changed_at - datetime.timedelta(hours=1)
+        with mock.patch('django.utils.timezone.now', return_value=past):
+            Lampi.readings_changed([self.device.device_id])
+        device = Lampi.objects.get(pk=self.device.pk)
+        self.assertEqual(device.data_changed_at, changed_at)
+        self.assertEqual(device.data_version, 2)
+
+    def test_other_users_etag_differs(self, publish):
+        self.add_reading(timezone.now())
+        etag = self.client.get(self.url).headers['ETag']
+        other = User.objects.create_user('other', password='pw')
+        Lampi.objects.create(device_id='b827eb000002', user=other)
+        self.client.force_login(other)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response.status_code, 304)
@@ -0,0 +1,74 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from app.ingest import CatchUp, captured_at, reading_from_payload
+from app.models import Lampi, SensorReading
+
+T0 = 1772359200.0
+PAYLOAD = dict(pm25=10.0, pm10=20.0, temperature=21.0, humidity=40.0,
+               pressure=1013.0, altitude=100.0)
+
+
+class CatchUpTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='owner')
+        self.device = Lampi.objects.create(device_id='b827eb000001',
+                                           user=user)
+        self.presence = mock.Mock()
+        self.on_stored = mock.Mock()
+        self.catch_up = CatchUp(self.presence, batch_size=4,
+                                on_stored=self.on_stored)
+
+    def reading(self, seconds, device_id='b827eb000001'):
+        return reading_from_payload(device_id, PAYLOAD, T0 + seconds)
+
+    def stored(self):
+        return sorted(timestamp.timestamp() - T0 for timestamp in
+                      SensorReading.objects.values_list('timestamp',
+                                                        flat=True))
+
+    def test_drains_in_batches(self):
+        for seconds in range(10):
+            self.catch_up.add(self.reading(seconds), lag=60)
+        self.assertEqual(SensorReading.objects.count(), 8)
+        self.catch_up.add(self.reading(10), lag=1)
+        self.assertFalse(self.catch_up.active)
+        self.assertEqual(self.stored(), list(range(11)))
+        self.assertEqual(self.catch_up.last_drain[0], 11)
+        self.assertEqual(Lampi.objects.get().data_version, 3)
+        self.presence.seen.assert_called_with('b827eb000001')
+
+    def test_redelivered_readings_are_dropped(self):
+        # stored before the daemon stopped, but never acknowledged
+        SensorReading.objects.bulk_create([self.reading(0),
+                                           self.reading(1)])
+        for seconds in (0, 1, 2, 2, 3):
+            self.catch_up.add(self.reading(seconds), lag=60)
+        self.catch_up.add(self.reading(3), lag=1)
+        self.assertEqual(self.stored(), [0, 1, 2, 3])
+        self.assertEqual(self.catch_up.last_drain[0], 2)
+        # only what was stored goes on to the alert rules
+        stored = [reading.timestamp.timestamp() - T0
+                  for call in self.on_stored.call_args_list
+                  for reading in call.args[0]]
+        self.assertEqual(stored, [2, 3])
+
+    def test_unknown_devices_are_skipped(self):
+        self.catch_up.add(self.reading(0, 'b827eb0000ff'), lag=60)
+        self.catch_up.add(self.reading(0), lag=1)
+        self.assertEqual(list(SensorReading.objects.values_list(
+            'lampi_id', flat=True)), ['b827eb000001'])
+
+
+class CapturedAtTest(SimpleTestCase):
+    def test_device_time_unless_missing_or_in_the_future(self):
+        self.assertEqual(captured_at({'captured': T0}, T0 + 5), T0)
+        self.assertEqual(captured_at({'captured': T0 + 9}, T0 + 5), T0 + 5)
+        self.assertEqual(captured_at({'captured': 'x'}, T0), T0)
+        self.assertEqual(captured_at(None, T0), T0)
+        self.assertEqual(reading_from_payload('d', {}, T0).timestamp,
+                         datetime.datetime.fromtimestamp(
+                             T0, datetime.timezone.utc))
@@ -0,0 +1,82 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.test import TestCase
+
+from app import models
+from app.models import DevicePresence, Lampi, parked_user_id
+from app.presence import PresenceTracker, broker_device_id
+
+T0 = datetime.datetime(2026, 3, 1, 10, tzinfo=datetime.timezone.utc)
+
+
+def at(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+class PresenceTrackerTest(TestCase):
+    def setUp(self):
+        # cached per process, but each test makes the parked user anew
+        models._parked_user_id = None
+        parked_user_id()
+        user = User.objects.create(username='owner')
+        Lampi.objects.create(device_id='b827eb000001', user=user)
+        self.published = []
+        self.tracker = PresenceTracker(publish_many=self.published.extend)
+
+    def test_flaps_between_flushes_are_one_upsert(self):
+        for i in range(50):
+            self.tracker.connection_changed('b827eb000001', i % 2 == 0,
+                                            now=at(i))
+        self.tracker.connection_changed('b827eb000001', True, now=at(50))
+        with self.assertNumQueries(5):
+            # known devices, reissue check and upsert, plus the savepoint
+            self.tracker.flush()
+        presence = DevicePresence.objects.get()
+        self.assertTrue(presence.online)
+        self.assertEqual(presence.last_change, at(50))
+        self.assertEqual(presence.last_seen, at(50))
+        self.assertEqual(self.tracker.flushes, 1)
+
+    def test_nothing_changed_skips_the_database(self):
+        self.tracker.connection_changed('b827eb000001', True, now=at(0))
+        self.tracker.flush()
+        self.tracker.seen('b827eb000001', now=at(1))
+        with self.assertNumQueries(0):
+            self.tracker.flush()
+
+    def test_new_device_is_parked_with_a_code(self):
+        self.tracker.connection_changed('b827eb0000ff', True, now=at(0))
+        self.tracker.flush()
+        device = Lampi.objects.get(device_id='b827eb0000ff')
+        self.assertEqual(device.user_id, parked_user_id())
+        self.assertEqual(device.short_code, device.association_code[:6])
+        self.assertEqual([msg['topic'] for msg in self.published],
+                         ['devices/b827eb0000ff/lamp/associated'])
+
+    def test_device_deleted_before_flush(self):
+        self.tracker.connection_changed('b827eb000001', True, now=at(0))
+        self.tracker.flush()
+        self.tracker.connection_changed('b827eb000001', False, now=at(1))
+        Lampi.objects.filter(device_id='b827eb000001').delete()
+        self.tracker.flush()
+        self.assertFalse(DevicePresence.objects.exists())
+        self.assertFalse(Lampi.objects.exists())
+
+    def test_failed_flush_is_retried(self):
+        self.tracker.connection_changed('b827eb000001', True, now=at(0))
+        with mock.patch.object(DevicePresence.objects, 'bulk_create',
+                               side_effect=DatabaseError('locked')):
+            with self.assertRaises(DatabaseError):
+                self.tracker.flush()
+        self.assertFalse(DevicePresence.objects.exists())
+        self.tracker.flush()
+        self.assertTrue(DevicePresence.objects.get().online)
+
+    def test_broker_device_id(self):
+        self.assertEqual(broker_device_id(
+            '$SYS/broker/connection/B827EB000001_broker/state'),
+            'b827eb000001')
+        self.assertIsNone(broker_device_id('$SYS/broker/connection/x/state'))
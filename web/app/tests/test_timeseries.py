@@ -0,0 +1,135 @@
+import datetime
+import math
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from app.models import Lampi, ReadingChunk, SensorReading
+from app.timeseries import (READING_FIELDS, ReadingSequence,
+                            compact_readings, datetime_to_us, decode_chunk,
+                            encode_chunk, read_range, us_to_datetime)
+
+T0 = datetime.datetime(2026, 3, 1, 10, tzinfo=datetime.timezone.utc)
+
+
+class ChunkEncodingTest(SimpleTestCase):
+    def round_trip(self, ts, columns):
+        decoded_ts, decoded = decode_chunk(encode_chunk(ts, columns))
+        np.testing.assert_array_equal(decoded_ts, ts)
+        for field in READING_FIELDS:
+            # bit for bit, so NaNs and signed zeros survive too
+            self.assertEqual(
+                np.asarray(columns[field], dtype=np.float64).tobytes(),
+                decoded[field].tobytes(), field)
+
+    def test_exact_floats(self):
+        rng = np.random.default_rng(41)
+        n = 500
+        ts = datetime_to_us(T0) + np.cumsum(
+            rng.integers(900000, 1100000, n))
+        columns = {field: rng.normal(20, 5, n) for field in READING_FIELDS}
+        columns['pm25'] = np.round(columns['pm25'], 1)
+        self.round_trip(ts, columns)
+
+    def test_special_values(self):
+        values = [0.0, -0.0, math.nan, math.inf, -math.inf, 1e-310,
+                  1.7976931348623157e308, 0.1 + 0.2]
+        ts = np.arange(len(values), dtype=np.int64) * 1000000
+        self.round_trip(ts, {field: values for field in READING_FIELDS})
+
+    def test_irregular_and_repeated_timestamps(self):
+        ts = np.array([-5, 0, 0, 7, 1000000, 999999999999, 2 ** 52],
+                      dtype=np.int64)
+        self.round_trip(ts, {field: np.arange(len(ts), dtype=float)
+                             for field in READING_FIELDS})
+
+    def test_single_reading_and_field_subset(self):
+        data = encode_chunk([42], {field: [1.5] for field in READING_FIELDS})
+        ts, columns = decode_chunk(data, fields=('pm25',))
+        self.assertEqual(ts.tolist(), [42])
+        self.assertEqual(list(columns), ['pm25'])
+
+    def test_rejects_other_data(self):
+        with self.assertRaises(ValueError):
+            decode_chunk(b'LQC0' + bytes(20))
+
+
+class ChunkedReadsTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='owner')
+        self.device = Lampi.objects.create(device_id='b827eb000001',
+                                           user=user)
+
+    def add(self, *seconds):
+        SensorReading.objects.bulk_create([
+            SensorReading(lampi=self.device,
+                          timestamp=T0 + datetime.timedelta(seconds=s),
+                          **{field: s + i / 10
+                             for i, field in enumerate(READING_FIELDS)})
+            for s in seconds])
+
+    def timestamps(self, readings):
+        return [(t - T0).total_seconds() for t in readings]
+
+    def test_compaction_keeps_newest_row(self):
+        self.add(*range(0, 7200, 600), 7300)
+        self.assertEqual(compact_readings(now=T0 + datetime.timedelta(
+            hours=3)), (12, 2))
+        self.assertEqual(list(SensorReading.objects.values_list(
+            'timestamp', flat=True)), [T0 + datetime.timedelta(seconds=7300)])
+
+    def test_read_range_across_rows_and_chunks(self):
+        self.add(*range(0, 7200, 60))
+        compact_readings(now=T0 + datetime.timedelta(hours=1, minutes=30))
+        self.add(*range(7200, 7500, 60))
+        self.assertTrue(ReadingChunk.objects.exists())
+        self.assertTrue(SensorReading.objects.exists())
+        readings = read_range(self.device.device_id)
+        expected = list(range(0, 7500, 60))
+        self.assertEqual((readings['timestamp'] - np.datetime64(
+            T0.replace(tzinfo=None), 's')).astype('m8[s]').astype(int)
+            .tolist(), expected)
+        self.assertEqual(readings['pm25'].tolist(),
+                         [s + 0.4 for s in expected])
+
+    def test_read_range_bounds(self):
+        self.add(*range(0, 7200, 60))
+        compact_readings(now=T0 + datetime.timedelta(hours=3))
+        readings = read_range(self.device.device_id,
+                              T0 + datetime.timedelta(seconds=3000),
+                              T0 + datetime.timedelta(seconds=3900))
+        self.assertEqual(len(readings['timestamp']), 15)
+
+    def test_sequence_order_across_rows_and_chunks(self):
+        self.add(*range(0, 7200, 60))
+        compact_readings(now=T0 + datetime.timedelta(hours=2))
+        self.add(*range(7200, 7500, 60))
+        sequence = ReadingSequence(self.device.device_id)
+        self.assertEqual(len(sequence), 125)
+        expected = list(range(7440, -60, -60))
+        # pages that start and end in rows, in chunks and across both
+        got = []
+        for lo in range(0, 125, 7):
+            got += self.timestamps(r['timestamp'] for r in sequence[lo:lo + 7])
+        self.assertEqual(got, expected)
+        self.assertEqual(sequence[4]['pm10'], 7200 + 0.5)
+        self.assertEqual(sequence[5]['pm10'], 7140 + 0.5)
+
+    def test_sequence_with_late_rows_for_compacted_hours(self):
+        # hours 0 and 2 compacted, hour 1 empty
+        self.add(*range(0, 3600, 60), *range(7200, 10800, 60), 10800)
+        compact_readings(now=T0 + datetime.timedelta(hours=3))
+        # these arrive after their hours were compacted
+        self.add(30, 3630, 7230)
+        sequence = ReadingSequence(self.device.device_id)
+        got = self.timestamps(r['timestamp'] for r in sequence[0:len(sequence)])
+        self.assertEqual(len(got), 124)
+        self.assertEqual(got, sorted(got, reverse=True))
+        self.assertEqual(got[:3], [10800, 10740, 10680])
+        self.assertEqual(sequence[len(sequence) - 2]['timestamp'],
+                         T0 + datetime.timedelta(seconds=30))
+
+    def test_us_round_trip(self):
+        moment = T0 + datetime.timedelta(microseconds=123457)
+        self.assertEqual(us_to_datetime(datetime_to_us(moment)), moment)
@@ -0,0 +1,82 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from app import models
+from app.models import Lampi, SensorReading
+from app.timeseries import compact_readings
+
+READING = dict(pm25=10.0, pm10=20.0, temperature=21.0, humidity=40.0,
+               pressure=1013.0, altitude=100.0)
+
+
+@mock.patch.object(Lampi, 'publish_sample_rate_msg')
+class ReadingDetailTest(TestCase):
+    def setUp(self):
+        models._watch_leases.clear()
+        self.user = User.objects.create_user('owner', password='pw')
+        self.device = Lampi.objects.create(device_id='b827eb000001',
+                                           user=self.user)
+        self.client.force_login(self.user)
+
+    def test_detail_survives_compaction(self, publish):
+        now = timezone.now()
+        old = SensorReading.objects.create(
+            lampi=self.device, timestamp=now - datetime.timedelta(hours=3),
+            **READING)
+        SensorReading.objects.create(lampi=self.device, timestamp=now,
+                                     **READING)
+        by_id = self.client.get(reverse('reading_detail_by_id',
+                                        args=[old.pk]))
+        self.assertEqual(by_id.status_code, 302)
+        detail_url = by_id.headers['Location']
+        self.assertEqual(self.client.get(detail_url).status_code, 200)
+
+        compact_readings(now=now)
+        self.assertFalse(SensorReading.objects.filter(pk=old.pk).exists())
+        self.assertEqual(self.client.get(detail_url).status_code, 200)
+        self.assertEqual(self.client.get(reverse(
+            'reading_detail_by_id', args=[old.pk])).status_code, 404)
+
+    def test_other_users_device_is_not_found(self, publish):
+        other = User.objects.create_user('other', password='pw')
+        self.client.force_login(other)
+        url = reverse('reading_detail', args=[self.device.device_id, 0])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+@mock.patch.object(Lampi, 'publish_sample_rate_msg')
+class MarkWatchedTest(TestCase):
+    def setUp(self):
+        models._watch_leases.clear()
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        Lampi.objects.create(device_id='b827eb000001', user=self.owner)
+
+    def watched_until(self):
+        return Lampi.objects.get(device_id='b827eb000001').watched_until
+
+    def test_only_the_owner_starts_a_watch(self, publish):
+        Lampi.mark_watched(Lampi.objects.filter(user=self.other),
+                           'b827eb000001')
+        self.assertIsNone(self.watched_until())
+        publish.assert_not_called()
+        Lampi.mark_watched(Lampi.objects.filter(user=self.owner),
+                           'b827eb000001')
+        self.assertIsNotNone(self.watched_until())
+        publish.assert_called_once()
+
+    def test_polls_within_the_lease_do_not_write(self, publish):
+        devices = Lampi.objects.filter(user=self.owner)
+        Lampi.mark_watched(devices, 'b827eb000001')
+        with self.assertNumQueries(0):
+            Lampi.mark_watched(devices, 'b827eb000001')
+        models._watch_leases.clear()
+        # another process: reads the lease but leaves it alone
+        with self.assertNumQueries(1):
+            Lampi.mark_watched(devices, 'b827eb000001')
+        publish.assert_called_once()
@@ -8,7 +8,13 @@ urlpatterns = [
   path('logout/', auth_views.LogoutView.as_view(), name='logout'),
   path('', views.index, name='index'),
 	path('history/', views.history, name='history'),
+  path('history/export/', views.export_readings, name='export_readings'),
   path('dashboard/', views.dashboard, name='dashboard'),
-  path('reading/<int:reading_id>/', views.reading_detail, name='reading_detail'),
+  path('compare/', views.compare, name='compare'),
+  path('reading/<int:reading_id>/', views.reading_detail_by_id, name='reading_detail_by_id'),
+  path('reading/<str:device_id>/<int:timestamp_us>/', views.reading_detail, name='reading_detail'),
+  path('readings/since/', views.readings_since, name='readings_since'),
   path('add/', views.AddLampiView.as_view(), name='add'),
+  path('fleet/', views.fleet_overview, name='fleet_overview'),
+  path('fleet/health/', views.fleet_health, name='fleet_health'),
 ]
@@ -1,19 +1,32 @@
+import csv
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.utils import timezone
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, redirect, render
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
 from django.utils.dateparse import parse_date
-from app.models import Lampi, SensorReading
-from bokeh.models import ColumnDataSource, HoverTool
-from bokeh.embed import components
-from bokeh.plotting import figure
+from django.db.models import OuterRef, Subquery
+from app.models import Lampi, SensorReading, DeviceHealth
+from app.aqi import reading_aqi
+from app.conditional import ReadingValidators
+from app.timeseries import (read_range, resample_devices, ReadingSequence,
+                            READING_FIELDS, datetime_to_us, us_to_datetime)
 from math import pi
-from bokeh.layouts import gridplot
-from django.http import HttpResponseForbidden
+import numpy as np
+from django.http import (Http404, HttpResponseForbidden,
+                         HttpResponseBadRequest, JsonResponse,
+                         StreamingHttpResponse)
+from django.urls import reverse
 from django.contrib.auth.mixins import LoginRequiredMixin
 from app.forms import AddLampiForm
+from app.mqtt_publisher import log_delivery
 from django.views import generic
 
+# Bokeh takes most of a second to import, so it is imported where charts
+# are built rather than by every process that loads the URLconf; web
+# workers get it preloaded by app.warmup.
+
 
 @login_required
 def index(request):
@@ -23,6 +36,12 @@ def index(request):
         "device",
         devices.first().device_id if devices.exists() else None
     )
+    if device_id:
+        Lampi.mark_watched(devices, device_id)
+    validators = ReadingValidators(request, device_id, _device_list(devices))
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
     # fetch the most recent reading
     reading = SensorReading.objects.filter(
         lampi__device_id=device_id
@@ -32,6 +51,9 @@ def index(request):
         "devices": devices,
         "device_id": device_id,
         "reading": reading,
+        # detail pages are keyed on (device, timestamp), which survives the
+        # row being compacted into a chunk
+        "reading_us": datetime_to_us(reading.timestamp) if reading else None,
     }
 
     template = (
@@ -39,32 +61,90 @@ def index(request):
         if request.htmx
         else "index.html"
     )
-    return render(request, template, context)
+    return validators.apply(render(request, template, context))
+
+def _device_list(devices):
+    # part of the validators for pages that show the device picker
+    return tuple(devices.values_list('device_id', 'name'))
+
+
+def _live_config(device_id, source, timestamps, columns, rollover):
+    """Settings for partials/live-chart.html, which appends readings newer
+    than ``cursor`` to ``source`` as they arrive."""
+    return {
+        "url": reverse("readings_since"),
+        "device": device_id,
+        "source_id": source.id,
+        "element_id": "live-" + source.id,
+        "cursor": int(timestamps[-1].astype(np.int64)) if len(timestamps)
+        else 0,
+        "columns": columns,
+        "rollover": rollover,
+        "poll_ms": LIVE_POLL_MS,
+    }
+
+
+@login_required
+def readings_since(request):
+    """Readings newer than the ``since`` cursor, for live charts.
+
+    Answers ``{"cursor": ..., "data": {"timestamp": [ms], field: [...]}}``,
+    or ``"data": null`` when there is nothing new; the cursor is opaque to
+    the page and is sent back with the next poll.
+    """
+    device = request.GET.get("device")
+    if not Lampi.objects.filter(user=request.user, device_id=device).exists():
+        return HttpResponseForbidden("You don't have permission to view "
+                                     "this device")
+    try:
+        since = int(request.GET.get("since", ""))
+    except ValueError:
+        return HttpResponseBadRequest("since must be a cursor")
+    fields = [field for field in request.GET.getlist("field")
+              if field in READING_FIELDS] or list(READING_FIELDS)
+
+    # one index lookup when nothing is new, whatever the history length
+    latest = SensorReading.objects.filter(lampi_id=device) \
+        .order_by("-timestamp").values_list("timestamp", flat=True).first()
+    if latest is None or datetime_to_us(latest) <= since:
+        return JsonResponse({"cursor": since, "data": None})
+
+    readings = read_range(device, us_to_datetime(since + 1), fields=fields)
+    timestamps = readings["timestamp"].astype(np.int64)
+    if not len(timestamps):
+        return JsonResponse({"cursor": since, "data": None})
+    data = {"timestamp": (timestamps / 1000).tolist()}
+    data.update((field, readings[field].tolist()) for field in fields)
+    return JsonResponse({"cursor": int(timestamps[-1]), "data": data})
+
+
+def _date_range(start_date_str, end_date_str):
+    """Aware [start, end) datetimes for inclusive dates; None if unset."""
+    start = end = None
+    sd = parse_date(start_date_str) if start_date_str else None
+    if sd:
+        start = timezone.make_aware(datetime.combine(sd, datetime.min.time()))
+    ed = parse_date(end_date_str) if end_date_str else None
+    if ed:
+        end = timezone.make_aware(datetime.combine(ed + timedelta(days=1),
+                                                   datetime.min.time()))
+    return start, end
+
 
 @login_required
 def history(request):
     devices = Lampi.objects.filter(user=request.user)
     device = request.GET.get("device", devices.first().device_id)
-    
-    print(device)
-
-    sensor_readings = SensorReading.objects.filter(lampi=device).order_by('-timestamp')
-
-    start_date_str = request.GET.get('start_date', '')
-    if start_date_str:
-        sd = parse_date(start_date_str)
-        if sd:
-            sensor_readings = sensor_readings.filter(
-                timestamp__date__gte=sd
-            )
-
-    end_date_str = request.GET.get('end_date', '')
-    if end_date_str:
-        ed = parse_date(end_date_str)
-        if ed:
-            sensor_readings = sensor_readings.filter(
-                timestamp__date__lte=ed
-            )
+
+    validators = ReadingValidators(request, device, _device_list(devices))
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    start, end = _date_range(request.GET.get('start_date', ''),
+                             request.GET.get('end_date', ''))
+    # newest first, decoding only the chunks the page touches
+    sensor_readings = ReadingSequence(device, start, end)
 
     paginator = Paginator(sensor_readings, 100)
     page_number = request.GET.get('page', 1)
@@ -78,53 +158,94 @@ def history(request):
 
     # HTMX fragment
     if request.headers.get('HX-Request'):
-        return render(
+        return validators.apply(render(
             request,
             'partials/sensor-readings-rows.html',
             context
-        )
+        ))
 
-    return render(request, 'history.html', context)
+    return validators.apply(render(request, 'history.html', context))
+
+
+class _Echo:
+    # csv.writer target that hands each row back for streaming
+    def write(self, value):
+        return value
 
 
 @login_required
-def dashboard(request):
+def export_readings(request):
     devices = Lampi.objects.filter(user=request.user)
     device = request.GET.get("device", devices.first().device_id)
-
-    readings = (
-        SensorReading.objects
-        .filter(lampi=device)
-        .order_by("-timestamp")
-    )
-    timestamps = [r.timestamp for r in readings]
-
-    metrics = [
-        ("Temperature", "temperature", "°C", "0.0"),
-        ("Pressure", "pressure", "hPa", "0.0"),
-        ("Humidity", "humidity", "%", "0.0"),
-        ("Altitude", "altitude", "m", "0.0"),
-        ("PM2.5", "pm25", "µg/m³", "0.0"),
-        ("PM10", "pm10", "µg/m³", "0.0"),
-    ]
+    if not devices.filter(device_id=device).exists():
+        return HttpResponseForbidden("You don't have permission to export "
+                                     "this device")
+    start, end = _date_range(request.GET.get('start_date', ''),
+                             request.GET.get('end_date', ''))
+    readings = read_range(device, start, end)
+
+    def rows():
+        writer = csv.writer(_Echo())
+        yield writer.writerow(('timestamp',) + READING_FIELDS)
+        timestamps = np.datetime_as_string(readings['timestamp'],
+                                           timezone='UTC')
+        columns = [readings[field].tolist() for field in READING_FIELDS]
+        for i, ts in enumerate(timestamps.tolist()):
+            yield writer.writerow([ts] + [column[i] for column in columns])
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    response['Content-Disposition'] = \
+        'attachment; filename="{}.csv"'.format(device)
+    return response
+
+
+# (title, reading field, unit, number format) for each dashboard chart
+DASHBOARD_METRICS = (
+    ("Temperature", "temperature", "°C", "0.0"),
+    ("Pressure", "pressure", "hPa", "0.0"),
+    ("Humidity", "humidity", "%", "0.0"),
+    ("Altitude", "altitude", "m", "0.0"),
+    ("PM2.5", "pm25", "µg/m³", "0.0"),
+    ("PM10", "pm10", "µg/m³", "0.0"),
+)
+
+
+def dashboard_grid(readings):
+    """The six dashboard charts for ``read_range`` arrays, and their source.
+
+    All charts draw from one ColumnDataSource, so the timestamps are sent
+    once, and the NumPy columns go out base64-encoded instead of as decimal
+    text.  float32 is plenty for plotting and halves the value columns.
+    The charts share an x range and a crosshair, so panning, zooming and
+    hovering one moves them all.
+    """
+    from bokeh.layouts import gridplot
+    from bokeh.models import ColumnDataSource, CrosshairTool, HoverTool, Span
+    from bokeh.plotting import figure
+
+    data = {"ts": readings["timestamp"]}
+    for _, field, _, _ in DASHBOARD_METRICS:
+        data[field] = readings[field].astype(np.float32)
+    cds = ColumnDataSource(data=data)
+    # one overlay shared by every chart's crosshair tool links them
+    crosshair = Span(dimension="height", line_color="#999", line_width=1)
 
     figs = []
-    for title, field, unit, fmt in metrics:
-        values = [getattr(r, field) for r in readings]
-        cds = ColumnDataSource(data=dict(ts=timestamps, val=values))
-
+    for title, field, unit, fmt in DASHBOARD_METRICS:
         p = figure(
             height=240,
             x_axis_type="datetime",
             toolbar_location=None,
             sizing_mode="stretch_width",
         )
+        if figs:
+            p.x_range = figs[0].x_range
 
         # minimal styling
         p.line(
             source=cds,
             x="ts",
-            y="val",
+            y=field,
             line_width=2,
             line_color="#0072B2",
         )
@@ -150,38 +271,222 @@ def dashboard(request):
         hover = HoverTool(
             tooltips=[
                 ("Time", "@ts{%F %T}"),
-                (title, f"@val{{0,{fmt}}}{unit}"),
+                (title, f"@{field}{{0,{fmt}}}{unit}"),
             ],
             formatters={"@ts": "datetime"},
             mode="vline",
         )
-        p.add_tools(hover)
+        p.add_tools(hover, CrosshairTool(overlay=crosshair))
 
         figs.append(p)
 
     # 2-column responsive grid
-    grid = gridplot(figs, ncols=2, sizing_mode="stretch_width")
+    return gridplot(figs, ncols=2, sizing_mode="stretch_width"), cds
+
+
+@login_required
+def dashboard(request):
+    devices = Lampi.objects.filter(user=request.user)
+    device = request.GET.get("device", devices.first().device_id)
+    Lampi.mark_watched(devices, device)
+    # skip the range read and the Bokeh work when nothing changed
+    validators = ReadingValidators(request, device, _device_list(devices))
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+
+    from bokeh.embed import components
+
+    readings = read_range(device)
+    grid, source = dashboard_grid(readings)
 
     script, div = components(grid)
+    columns = {"ts": "timestamp"}
+    columns.update((field, field) for _, field, _, _ in DASHBOARD_METRICS)
     context = {
         "devices": devices,
         "device": device,
         "bokeh_script": script,
         "bokeh_div": div,
+        "live": _live_config(device, source, readings["timestamp"], columns,
+                             max(len(readings["timestamp"]),
+                                 LIVE_ROLLOVER_POINTS)),
     }
 
     template = "partials/sensor-readings-plot.html" if request.htmx \
                else "dashboard.html"
+    return validators.apply(render(request, template, context))
+
+# comparison chart: points per device, range choices in days, and how many
+# devices to show when none are picked
+COMPARE_POINTS = 1000
+COMPARE_DAYS = (1, 7, 30, 90)
+COMPARE_DEFAULT_DEVICES = 10
+
+
+def comparison_chart(grid, series, title, unit, fmt):
+    """One line per device on shared axes; ``series`` is a list of
+    ``(label, values)`` on the ``grid`` timestamps."""
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.palettes import Category10
+    from bokeh.plotting import figure
+
+    data = {"ts": grid}
+    for i, (_, values) in enumerate(series):
+        data[f"d{i}"] = values.astype(np.float32)
+    cds = ColumnDataSource(data=data)
+
+    p = figure(
+        height=420,
+        x_axis_type="datetime",
+        toolbar_location="above",
+        sizing_mode="stretch_width",
+    )
+    colors = Category10[10]
+    for i, (label, _) in enumerate(series):
+        line = p.line(
+            source=cds,
+            x="ts",
+            y=f"d{i}",
+            line_width=2,
+            line_color=colors[i % len(colors)],
+            legend_label=label,
+        )
+        p.add_tools(HoverTool(
+            renderers=[line],
+            tooltips=[
+                ("Device", label),
+                ("Time", "@ts{%F %T}"),
+                (title, f"@d{i}{{0,{fmt}}}{unit}"),
+            ],
+            formatters={"@ts": "datetime"},
+        ))
+
+    p.outline_line_color = None
+    p.background_fill_color = None
+    p.min_border = 20
+    for ax in (p.xaxis, p.yaxis):
+        ax.axis_line_color = None
+        ax.major_tick_line_color = None
+        ax.major_label_text_font_size = "9pt"
+        ax.major_label_text_color = "#555"
+    p.xaxis.major_label_orientation = pi / 4
+    p.title.text = f"{title} ({unit})"
+    p.title.text_font_size = "12pt"
+    p.title.text_color = "#333"
+    if series:
+        p.legend.click_policy = "hide"
+        p.legend.location = "top_left"
+    return p
+
+
+@login_required
+def compare(request):
+    devices = Lampi.objects.filter(user=request.user)
+    names = {d.device_id: str(d) for d in devices}
+    selected = [device_id for device_id in request.GET.getlist("device")
+                if device_id in names] or \
+        list(names)[:COMPARE_DEFAULT_DEVICES]
+    metrics = {field: (title, unit, fmt)
+               for title, field, unit, fmt in DASHBOARD_METRICS}
+    metric = request.GET.get("metric")
+    if metric not in metrics:
+        metric = "temperature"
+    try:
+        days = int(request.GET.get("days", 7))
+    except ValueError:
+        days = 7
+    if days not in COMPARE_DAYS:
+        days = 7
+
+    from bokeh.embed import components
+
+    end = timezone.now()
+    grid, means = resample_devices(selected, metric,
+                                   end - timedelta(days=days), end,
+                                   COMPARE_POINTS)
+    title, unit, fmt = metrics[metric]
+    script, div = components(comparison_chart(
+        grid, [(names[device_id], means[device_id])
+               for device_id in selected], title, unit, fmt))
+
+    context = {
+        "devices": devices,
+        "selected": selected,
+        "metrics": DASHBOARD_METRICS,
+        "metric": metric,
+        "day_choices": COMPARE_DAYS,
+        "days": days,
+        "bokeh_script": script,
+        "bokeh_div": div,
+    }
+    template = "partials/compare-plot.html" if request.htmx \
+               else "compare.html"
     return render(request, template, context)
 
+# readings on the reading detail chart
+DETAIL_POINTS = 1000
+# live charts poll this often, and keep at least this many points
+LIVE_POLL_MS = 2000
+LIVE_ROLLOVER_POINTS = 86400
+
+
+def _latest_readings(device_id, field, count, since):
+    """The newest ``count`` readings of ``field`` after ``since``.
+
+    Reads back from now, starting with the span ``count`` readings take
+    at the watched rate and sizing each further span from the rate seen so
+    far, so only about the span that is plotted is decoded rather than
+    everything since ``since``.
+    """
+    now = timezone.now()
+    start = max(now - timedelta(seconds=count *
+                                settings.SAMPLE_PERIOD_WATCHED), since)
+    end = None
+    parts = []
+    total = 0
+    while True:
+        part = read_range(device_id, start, end, fields=(field,))
+        parts.append(part)
+        total += len(part['timestamp'])
+        if total >= count or start <= since:
+            break
+        end = start
+        if total:
+            # the rest at the rate seen so far, with some slack
+            start = max(end - (now - end) * (1.25 * (count - total) / total),
+                        since)
+        else:
+            start = since
+    parts.reverse()
+    return {key: np.concatenate([part[key] for part in parts])[-count:]
+            for key in ('timestamp', field)}
+
+
 @login_required
-def reading_detail(request, reading_id):
-    # Get the specific reading
-    reading = SensorReading.objects.get(id=reading_id)
+def reading_detail_by_id(request, reading_id):
+    # links from before detail pages were keyed on the timestamp; the row
+    # may since have been compacted away
+    reading = get_object_or_404(SensorReading, id=reading_id,
+                                lampi__user=request.user)
+    url = reverse('reading_detail', args=(reading.lampi_id,
+                                          datetime_to_us(reading.timestamp)))
+    query = request.GET.urlencode()
+    return redirect(f"{url}?{query}" if query else url)
+
 
-    # Security check - only allow access to readings from user's devices
-    if reading.lampi.user != request.user:
-        return HttpResponseForbidden("You don't have permission to view this reading")
+@login_required
+def reading_detail(request, device_id, timestamp_us):
+    # only the user's own devices; the reading may be a row or in a chunk
+    device = get_object_or_404(Lampi, device_id=device_id, user=request.user)
+    at = us_to_datetime(timestamp_us)
+    found = read_range(device.device_id, at,
+                       at + timedelta(microseconds=1))
+    if not len(found['timestamp']):
+        raise Http404("No reading at that time")
+    reading = SensorReading(
+        lampi=device, timestamp=at,
+        **{field: float(found[field][0]) for field in READING_FIELDS})
 
     # Get the selected metric from query parameters
     metric = request.GET.get("metric", "temperature")
@@ -197,19 +502,24 @@ def reading_detail(request, reading_id):
     }
     
     # Get parameters for the selected metric
-    params = metric_params.get(metric, metric_params['temperature'])
+    if metric not in metric_params:
+        metric = 'temperature'
+    params = metric_params[metric]
     field = params['field']
     
-    # Get more readings for historical graph (about a day's worth but limit to 1000)
+    # Get more readings for historical graph (about a day's worth but limit
+    # to the latest 1000, which the live updates then keep rolling)
     time_threshold = timezone.now() - timezone.timedelta(days=1)
-    historical_readings = SensorReading.objects.filter(
-        lampi=reading.lampi,
-        timestamp__gte=time_threshold
-    ).order_by('timestamp')[:1000]
+    historical_readings = _latest_readings(reading.lampi_id, metric,
+                                           DETAIL_POINTS, time_threshold)
     
     # Create the Bokeh plot
-    timestamps = [r.timestamp for r in historical_readings]
-    values = [getattr(r, metric) for r in historical_readings]
+    from bokeh.embed import components
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.plotting import figure
+
+    timestamps = historical_readings["timestamp"]
+    values = historical_readings[metric]
     
     cds = ColumnDataSource(data=dict(ts=timestamps, val=values))
     
@@ -275,10 +585,96 @@ def reading_detail(request, reading_id):
         'unit': params['unit'],
         'bokeh_script': script,
         'bokeh_div': div,
+        'live': _live_config(reading.lampi_id, cds, timestamps,
+                             {'ts': 'timestamp', 'val': metric},
+                             DETAIL_POINTS),
     }
     
     return render(request, 'reading_detail.html', context)
 
+# fleet health: how far back to look, and what counts as degraded
+FLEET_HEALTH_WINDOW = timezone.timedelta(minutes=15)
+DEGRADED_RATE_FRACTION = 0.9
+
+@login_required
+def fleet_health(request):
+    # staff see every device, everyone else their own
+    devices = Lampi.objects.all() if request.user.is_staff \
+        else Lampi.objects.filter(user=request.user)
+    since = timezone.now() - FLEET_HEALTH_WINDOW
+    records = (
+        DeviceHealth.objects
+        .filter(lampi__in=devices, timestamp__gte=since)
+        .select_related('lampi')
+        .order_by('lampi_id', 'timestamp')
+    )
+
+    # oldest and newest record in the window per device
+    first, latest = {}, {}
+    for record in records:
+        first.setdefault(record.lampi_id, record)
+        latest[record.lampi_id] = record
+
+    rows = []
+    for device_id, record in latest.items():
+        degraded = record.sample_rate < \
+            record.expected_rate * DEGRADED_RATE_FRACTION
+        backlog_growing = record.queue_depth > first[device_id].queue_depth
+        rows.append({
+            'record': record,
+            'degraded': degraded,
+            'backlog_growing': backlog_growing,
+            'queue_delta': record.queue_depth - first[device_id].queue_depth,
+        })
+    # devices that need attention first
+    rows.sort(key=lambda r: (not (r['degraded'] or r['backlog_growing']),
+                             r['record'].lampi_id))
+
+    context = {
+        'rows': rows,
+        'window_minutes': int(FLEET_HEALTH_WINDOW.total_seconds() // 60),
+    }
+    return render(request, 'fleet_health.html', context)
+
+# devices per page on the fleet overview
+FLEET_PAGE_SIZE = 100
+
+@login_required
+def fleet_overview(request):
+    devices = Lampi.objects.filter(user=request.user)
+    # newest reading per device as a correlated subquery on the (lampi,
+    # timestamp) index, so a page costs the same however much history the
+    # devices have
+    latest = SensorReading.objects.filter(lampi=OuterRef('pk')) \
+        .order_by('-timestamp').values('id')[:1]
+    page = Paginator(
+        devices.select_related('presence')
+        .annotate(latest_reading_id=Subquery(latest))
+        .order_by('name', 'device_id'),
+        FLEET_PAGE_SIZE,
+    ).get_page(request.GET.get('page', 1))
+    readings = SensorReading.objects.in_bulk(
+        [device.latest_reading_id for device in page
+         if device.latest_reading_id is not None])
+
+    rows = []
+    for device in page:
+        reading = readings.get(device.latest_reading_id)
+        rows.append({
+            'device': device,
+            'presence': getattr(device, 'presence', None),
+            'reading': reading,
+            'aqi': reading_aqi(reading) if reading else None,
+        })
+
+    context = {
+        'rows': rows,
+        'page': page,
+        'total': page.paginator.count,
+        'online': devices.filter(presence__online=True).count(),
+    }
+    return render(request, 'fleet_overview.html', context)
+
 class AddLampiView(LoginRequiredMixin, generic.FormView):
     template_name = 'addlampi.html'
     form_class = AddLampiForm
@@ -288,8 +684,17 @@ class AddLampiView(LoginRequiredMixin, generic.FormView):
         context = super(AddLampiView, self).get_context_data(**kwargs)
         return context
 
+    def get_form_kwargs(self):
+        kwargs = super(AddLampiView, self).get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+
     def form_valid(self, form):
         device = form.cleaned_data['device']
-        device.associate_and_publish_associated_msg(self.request.user)
+        # the redirect does not wait for the broker to confirm delivery
+        delivery = device.associate_and_publish_associated_msg(
+            self.request.user)
+        delivery.add_done_callback(log_delivery(
+            "association of {}".format(device.device_id)))
 
         return super(AddLampiView, self).form_valid(form)
\ No newline at end of file
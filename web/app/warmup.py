@@ -0,0 +1,48 @@
+"""Work a web worker would otherwise do on its first requests.
+
+config/wsgi.py calls ``warm_up`` once the application is loaded.  Under
+uWSGI that happens in the master before it forks the workers, so the
+imports and caches primed here are shared copy-on-write rather than
+rebuilt by each worker after every spawn or reload.
+"""
+import numpy as np
+from django.db import connections
+from django.template.loader import get_template
+from django.urls import get_resolver
+
+from app.timeseries import READING_FIELDS
+
+# the pages behind the main views and their HTMX fragments
+TEMPLATES = (
+    'index.html',
+    'dashboard.html',
+    'history.html',
+    'compare.html',
+    'reading_detail.html',
+    'fleet_overview.html',
+    'partials/sensor-readings-grid.html',
+    'partials/sensor-readings-plot.html',
+    'partials/sensor-readings-rows.html',
+    'partials/compare-plot.html',
+)
+
+
+def warm_up():
+    # importing the URLconf imports every view module
+    get_resolver().url_patterns
+
+    from bokeh.embed import components
+    from app.views import dashboard_grid
+
+    # the first chart pays for Bokeh's lazily built property and
+    # serializer tables
+    empty = {'timestamp': np.empty(0, dtype='datetime64[us]'),
+             **{field: np.empty(0) for field in READING_FIELDS}}
+    components(dashboard_grid(empty)[0])
+
+    # compiled once and kept when the cached template loader is in use
+    for name in TEMPLATES:
+        get_template(name)
+
+    # connections must not be shared with forked workers
+    connections.close_all()
@@ -51,6 +51,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "app.profiling.RequestProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "config.urls"
@@ -128,6 +129,48 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 DEFAULT_USER = 'parked_device_user'
 
+# Demand-driven sampling: seconds between device readings while someone has
+# a live view of the device open, and otherwise.  A view keeps the device
+# "watched" for WATCH_LEASE_SECS after its last request.
+SAMPLE_PERIOD_WATCHED = 1
+SAMPLE_PERIOD_BACKGROUND = 60
+WATCH_LEASE_SECS = 120
+
+# Broker used by the mqtt-daemon and the per-process publisher, and how many
+# unacknowledged messages the publisher holds while it is disconnected.
+MQTT_BROKER_HOST = 'localhost'
+MQTT_BROKER_PORT = 50001
+MQTT_PUBLISH_QUEUE_MAX = 10000
+# fixed client ID of the mqtt-daemon's persistent broker session
+MQTT_DAEMON_CLIENT_ID = 'lampi-mqtt-daemon'
+
+# Compressed reading storage: when enabled the mqtt-daemon packs each hour
+# of readings into a ReadingChunk once the hour is over (see app.timeseries).
+READING_CHUNKS_ENABLED = False
+READING_COMPACT_INTERVAL_SECS = 300
+
+# Failed association codes allowed per user per window (counted in the
+# default cache, which is per process unless a shared cache is configured).
+ASSOCIATION_ATTEMPTS_MAX = 10
+ASSOCIATION_ATTEMPT_WINDOW_SECS = 600
+
+# Alert rules: how often the mqtt-daemon picks up rule changes, and the
+# notification sinks AlertRule.sink can name (see app.alerts).
+ALERT_RULES_RELOAD_SECS = 30
+ALERT_SINKS = {
+    'mqtt': 'app.alerts.MQTTSink',
+    'email': 'app.alerts.EmailSink',
+}
+
+# Request profiling (app.profiling): off unless REQUEST_PROFILING is 1, true,
+# yes or on in the environment.  Requests over the threshold are sampled
+# every interval, saved as SlowRequest rows and browsable in the admin.
+REQUEST_PROFILING = os.environ.get('REQUEST_PROFILING', '').lower() in (
+    '1', 'true', 'yes', 'on')
+REQUEST_PROFILE_THRESHOLD_MS = 500
+REQUEST_PROFILE_INTERVAL_MS = 5
+REQUEST_PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+
 STATIC_ROOT= os.path.join(BASE_DIR, "static")
 
 LOGIN_REDIRECT_URL = '/dashboard'
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
 application = get_wsgi_application()
+
+# uWSGI loads this module once in the master and forks the workers from it,
+# so whatever is warmed up here is shared instead of paid for per worker
+if os.environ.get("LAMPI_WSGI_WARMUP", "1") != "0":
+    from app.warmup import warm_up
+
+    warm_up()